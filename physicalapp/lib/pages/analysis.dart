@@ -70,14 +70,15 @@ Future<void> fetchActivityData() async {
   final userId = prefs.getInt('user_id');
 
   final response = await http.get(
-    Uri.parse('${dotenv.env['BASE_URL']}/activities/past_week/$userId'),
+    Uri.parse('${dotenv.env['BASE_URL']}/analytics/week/$userId'),
   );
 
   if (response.statusCode == 200) {
-    final List<dynamic> activityList = jsonDecode(response.body);
+    // the server sums up the past week
+    final Map<String, dynamic> week = jsonDecode(response.body);
 
     // default value when no activities in the past week
-    if (activityList.isEmpty) {
+    if (week['runs'] == 0) {
       setState(() {
         completeness = 0.0;
         exp_weight_loss = 8.0 * 1.0 * 3600 / 360 * 1.05 / 7700 * weight!;
@@ -88,7 +89,12 @@ Future<void> fetchActivityData() async {
 
     // do have act
     show_hashtags = true;
-    final states = summarizeActivities(activityList);
+    final Map<String, dynamic> states = {
+      'round_week': week['runs'],
+      'dist_week': week['distance_km'],
+      'avg_pace_week': week['avg_pace_seconds_per_km'],
+      'last_run_time': week['last_run_time'],
+    };
 
     setState(() {
       doneWeek = states;
@@ -8,26 +8,6 @@ import 'history_day.dart';
 import '../main.dart'; // To use MainPage
 import 'analysis.dart'; // To use ReportCardPage
 
-// Data model for an individual activity record from backend (simplified for this page)
-// This should ideally be a shared model if used across multiple files.
-// Copying relevant parts from history_day.dart to avoid dependency on its internal models
-class ActivityDataForHistoryPage {
-  final DateTime startTime;
-  final String? goalState;
-
-  ActivityDataForHistoryPage({
-    required this.startTime,
-    this.goalState,
-  });
-
-  factory ActivityDataForHistoryPage.fromJson(Map<String, dynamic> json) {
-    return ActivityDataForHistoryPage(
-      startTime: DateTime.parse(json['start_time']),
-      goalState: json['goal_state'],
-    );
-  }
-}
-
 class HistoryPage extends StatefulWidget {
   // Username is now passed from parent.
   // If not passed, it will be loaded from SharedPreferences.
@@ -87,7 +67,7 @@ class _HistoryPageState extends State<HistoryPage> {
     }
   }
 
-  // Fetch all activities for the current user
+  // Fetch the per-day goal summary of the displayed month for the current user
   Future<void> _fetchAllActivities(int userId) async {
     setState(() {
       _isLoadingActivities = true;
@@ -95,26 +75,27 @@ class _HistoryPageState extends State<HistoryPage> {
       _dailyActivityGoals = {}; // Clear previous data
     });
 
-    // Construct the URL to fetch all activities for a specific user
+    // The backend returns one entry per day with counts of each goal_state
     // Make sure dotenv is loaded in main.dart
-    final url = Uri.parse('${dotenv.env['BASE_URL']}/activities/$userId');
+    final month = DateFormat('yyyy-MM').format(_currentMonth);
+    final url = Uri.parse('${dotenv.env['BASE_URL']}/activities/calendar/$userId?month=$month');
 
     try {
       final response = await http.get(url);
 
       if (response.statusCode == 200) {
-        List<dynamic> jsonList = json.decode(response.body);
+        final Map<String, dynamic> calendar = json.decode(response.body);
         Map<DateTime, List<String?>> tempDailyGoals = {};
 
-        // Process each activity to group by date and store goal states
-        for (var activityJson in jsonList) {
-          final activity = ActivityDataForHistoryPage.fromJson(activityJson);
-          // Normalize date to remove time component for daily grouping
-          final dateKey = DateTime(activity.startTime.year, activity.startTime.month, activity.startTime.day);
-          if (!tempDailyGoals.containsKey(dateKey)) {
-            tempDailyGoals[dateKey] = [];
-          }
-          tempDailyGoals[dateKey]!.add(activity.goalState);
+        // Expand the counts into the goal states used for coloring the day
+        for (var dayJson in calendar['days']) {
+          final day = DateTime.parse(dayJson['date']);
+          final dateKey = DateTime(day.year, day.month, day.day);
+          tempDailyGoals[dateKey] = [
+            if (dayJson['completed'] > 0) 'completed',
+            if (dayJson['missed'] > 0) 'missed',
+            if (dayJson['other'] > 0) null,
+          ];
         }
 
         setState(() {
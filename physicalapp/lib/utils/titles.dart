@@ -63,43 +63,3 @@ String getUserTitle({
       return 'Unknown';
   }
 }
-
-Map<String, dynamic> summarizeActivities(List<dynamic> activityList) {
-  final now = DateTime.now();
-  final sevendaysago = now.subtract(Duration(days: 7));
-  int runCountThisWeek = 0;
-  double totalDistance = 0.0;
-  int totalDurationSeconds = 0;
-  DateTime? lastRunTime;
-  print(sevendaysago);
-
-  for (var activity in activityList) {
-    final startTime = DateTime.parse(activity['start_time']);
-    final distance = (activity['distance_km'] ?? 0).toDouble();
-    final duration_seconds = (activity['duration_seconds'] ?? 0).toInt();
-
-    // 本週活動
-    if (startTime.isAfter(sevendaysago)) {
-      runCountThisWeek++;
-      totalDistance += distance;
-      totalDurationSeconds = duration_seconds + totalDurationSeconds;
-    }
-
-    // 更新最近一次跑步時間
-    if (lastRunTime == null || startTime.isAfter(lastRunTime)) {
-      lastRunTime = startTime;
-    }
-  }
-
-  int avgPace = 0;
-  if (totalDistance > 0) {
-    avgPace = (totalDurationSeconds / totalDistance).round();
-  }
-
-  return {
-    'round_week': runCountThisWeek,
-    'dist_week': totalDistance,
-    'avg_pace_week': avgPace,
-    'last_run_time': lastRunTime?.toIso8601String() ?? 'N/A',
-  };
-}
@@ -0,0 +1,111 @@
+# archive.py
+# Hot/cold tiering of the activity table.
+#
+# `flask archive-activities` moves activities that started more than ARCHIVE_AFTER_DAYS
+# ago from Activity to ArchivedActivity, a table with the same columns and ids. Activity
+# then only holds the recent runs, so the indexes and pages that every recent read and
+# every insert touch stay small however long the histories get.
+#
+# Reads build their statement through activities_select(). One whose time range lies
+# within the last ARCHIVE_MIN_AGE_DAYS reads Activity alone, since nothing that recent
+# is ever archived; one that reaches further back reads both tables, merged in SQL.
+# Either way the result is the same as if no row had moved, so archiving doesn't change
+# any response and doesn't need to invalidate cached ones.
+from datetime import datetime, timedelta
+
+from sqlalchemy import asc, case, delete, desc, func, insert, select, union_all
+
+from database import db, Activity, ArchivedActivity
+
+# Lower bound on the archive horizon; reads of the last ARCHIVE_MIN_AGE_DAYS skip the archive
+ARCHIVE_MIN_AGE_DAYS = 30
+ARCHIVE_CHUNK_SIZE = 1000
+
+ACTIVITY_TABLES = (Activity, ArchivedActivity)
+
+# Compares below any stored start_time
+EARLIEST = datetime(1, 1, 1)
+
+
+def reaches_archive(since):
+    """Whether a read of activities that started at or after since (None: no lower
+    bound) may find some of them archived."""
+    return since is None or since < datetime.utcnow() - timedelta(days=ARCHIVE_MIN_AGE_DAYS)
+
+
+def same_columns(model, columns):
+    """Activity columns -> the columns of the same name on model."""
+    return [getattr(model, column.key) for column in columns]
+
+
+def _ordering(source, order_by):
+    """Order by clauses for names ('-name' descending) on a model."""
+    return [getattr(source, name[1:]).desc() if name.startswith('-') else getattr(source, name)
+            for name in order_by]
+
+
+def _result_ordering(order_by):
+    """Order by clauses for names ('-name' descending) of a union's result columns."""
+    # By name rather than through a wrapping subquery's columns: building those column
+    # collections costs more per request than running the query
+    return [desc(name[1:]) if name.startswith('-') else asc(name) for name in order_by]
+
+
+def all_activities(build):
+    """Subquery of the rows of build(model) over both activity tables."""
+    return union_all(*(build(model) for model in ACTIVITY_TABLES)).subquery()
+
+
+def activities_select(build, since=None, order_by=(), limit=None):
+    """Statement reading activities from Activity, and from ArchivedActivity as well
+    when since (the earliest start_time the read can return, None: unbounded) reaches
+    back that far.
+
+    build(model) returns the select for one table (Activity or ArchivedActivity), with
+    plain columns only. order_by and limit apply to the merged rows; order_by names
+    result columns, '-name' for descending.
+    """
+    if not reaches_archive(since):
+        return build(Activity).order_by(*_ordering(Activity, order_by)).limit(limit)
+    if limit is None:
+        return union_all(*(build(model) for model in ACTIVITY_TABLES)).order_by(*_result_ordering(order_by))
+
+    # Each table contributes at most limit rows, read in index order
+    hot = build(Activity).order_by(*_ordering(Activity, order_by)).limit(limit).cte('hot')
+    cold = build(ArchivedActivity)
+    if order_by[:1] == ('-start_time',):
+        # Archived rows only make the cut if they are no older than the last of a full
+        # page of recent rows; usually none are, and the range seek finds nothing
+        page_end = select(case((func.count() >= limit, func.min(hot.c.start_time)))).scalar_subquery()
+        cold = cold.where(ArchivedActivity.start_time >= func.coalesce(page_end, EARLIEST))
+    cold = cold.order_by(*_ordering(ArchivedActivity, order_by)).limit(limit)
+    return union_all(select(hot), select(cold.subquery())).order_by(*_result_ordering(order_by)).limit(limit)
+
+
+def archive_activities(before, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """Move the activities that started before `before` to ArchivedActivity on the
+    selected database, one chunk per transaction. Returns the number moved."""
+    max_id = db.session.scalar(select(func.max(Activity.id)))
+    if max_id is None:
+        return 0
+    columns = [column.key for column in Activity.__table__.columns]
+
+    moved = 0
+    last_id = 0
+    while True:
+        # SQLite gives a new row the highest id + 1, so the row holding the highest id
+        # stays: otherwise the next insert could reuse an archived id
+        ids = db.session.scalars(
+            select(Activity.id).where(Activity.id > last_id, Activity.id < max_id, Activity.start_time < before)
+            .order_by(Activity.id).limit(chunk_size)
+        ).all()
+        if not ids:
+            break
+        # Copy and delete in one transaction: readers see each row in exactly one table
+        db.session.execute(insert(ArchivedActivity).from_select(
+            columns, select(*Activity.__table__.columns).where(Activity.id.in_(ids))))
+        db.session.execute(delete(Activity).where(Activity.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+        last_id = ids[-1]
+    return moved
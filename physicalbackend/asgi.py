@@ -0,0 +1,227 @@
+# asgi.py
+# Async serving mode. Run it with an ASGI server instead of `python server.py`:
+#   uvicorn asgi:app --host 127.0.0.1 --port 5000
+#
+# The read-heavy per-user endpoints (/goal, /user_type, /activities*) run as coroutines
+# on an async SQLAlchemy engine, so a request waiting for the database holds a
+# connection but no thread, and one worker serves many concurrent clients. Every other
+# request, including all writes, goes to the Flask app on a thread pool of
+# ASYNC_WSGI_THREADS threads.
+#
+# Both paths run in one process and share server.py's statements, response bodies,
+# response cache, user context cache, session tokens, shards and compression settings,
+# so a client can't tell which one answered.
+import asyncio
+import os
+import time
+from collections import namedtuple
+from urllib.parse import parse_qsl
+
+from a2wsgi import WSGIMiddleware
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException, InternalServerError
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.routing import Map, Rule
+
+import dbprofile
+from auth import bearer_token, user_context_statement, user_context_from_row
+from compression import encoded_etag
+from metrics import request_latency, response_size, logger
+from server import create_app, db, shards, session_tokens, response_cache, user_contexts, post_write_queue, compressor
+from server import POST_WRITE_WAIT_SECONDS, BadArgument, goal_body, user_type_body
+from server import activities_read, activity_changes_read, past_week_read, activities_by_date_read, calendar_read
+
+# Async driver per database backend
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+flask_app = create_app({'ASYNC_WSGI_THREADS': int(os.environ.get('ASYNC_WSGI_THREADS', 10))})
+
+Request = namedtuple('Request', ['method', 'path', 'query_string', 'args', 'headers'])
+Reply = namedtuple('Reply', ['status', 'body', 'mimetype', 'etag'])
+
+
+def async_url(url):
+    """url with the async driver of its backend."""
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No async driver for {backend} databases')
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def json_reply(obj, status=200):
+    # Serialized by Flask's JSON provider, so bodies are byte-for-byte those of the sync path
+    response = flask_app.json.response(obj)
+    return Reply(status, response.get_data(), response.mimetype, None)
+
+
+async def goal(session, context, user_id, args):
+    return json_reply(goal_body(context))
+
+
+async def user_type(session, context, user_id, args):
+    body = user_type_body(context)
+    if body is None:
+        return json_reply({'message': 'Trait not found'}, 404)
+    return json_reply(body)
+
+
+def read_view(read):
+    """Async view running a (statement, render) read of server.py."""
+    async def view(session, context, user_id, args, **url_args):
+        statement, render = read(user_id, args=args, **url_args)
+        return json_reply(render(await session.execute(statement)))
+    return view
+
+
+# Flask endpoint -> async view. Routes, cache settings and read-your-writes waits are
+# taken from the Flask view functions.
+ASYNC_VIEWS = {
+    'api.get_goal': goal,
+    'api.get_user_type': user_type,
+    'api.get_user_activities': read_view(activities_read),
+    'api.get_activity_changes': read_view(activity_changes_read),
+    'api.get_past_week_activities': read_view(past_week_read),
+    'api.get_activities_by_date': read_view(activities_by_date_read),
+    'api.get_activity_calendar': read_view(calendar_read),
+}
+
+
+class AsyncApp:
+    def __init__(self, wsgi_app):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=wsgi_app.config['ASYNC_WSGI_THREADS'])
+        self.url_map = Map([Rule(rule.rule, endpoint=rule.endpoint)
+                            for rule in wsgi_app.url_map.iter_rules() if rule.endpoint in ASYNC_VIEWS])
+        self.urls = self.url_map.bind('localhost')
+        self.rules = {rule.endpoint: rule.rule for rule in self.url_map.iter_rules()}
+        self.slow_request_seconds = wsgi_app.config['SLOW_REQUEST_MS'] / 1000
+
+        # One async engine per configured engine (the default database and every shard)
+        self.engines = {}
+        with wsgi_app.app_context():
+            for key, engine in db.engines.items():
+                self.engines[key] = create_async_engine(
+                    async_url(engine.url), **dbprofile.async_engine_options(engine.url, wsgi_app.config))
+                dbprofile.listen_pragmas(self.engines[key].sync_engine, wsgi_app.config)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            try:
+                endpoint, url_args = self.urls.match(scope['path'], method='GET')
+            except HTTPException:
+                # Not found, redirects (e.g. trailing slashes) etc. are left to Flask
+                endpoint = None
+            if endpoint is not None:
+                await self.handle(scope, send, endpoint, url_args)
+                return
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                dbprofile.check_settings(flask_app, db)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in self.engines.values():
+                    await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, scope, send, endpoint, url_args):
+        started = time.perf_counter()
+        headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+        query_string = scope['query_string'].decode()
+        request = Request('GET', scope['path'], query_string,
+                          MultiDict(parse_qsl(query_string, keep_blank_values=True)), headers)
+        try:
+            reply = await self.dispatch(request, endpoint, url_args)
+        except BadArgument as error:
+            reply = json_reply({'message': str(error)}, 400)
+        except Exception:
+            logger.exception('Exception on %s %s', request.method, request.path)
+            error = InternalServerError()
+            reply = Reply(error.code, error.get_body().encode(), 'text/html', None)
+        size = await self.send_reply(send, request, reply)
+
+        elapsed = time.perf_counter() - started
+        labels = (request.method, self.rules[endpoint], str(reply.status))
+        request_latency.observe(labels, elapsed)
+        response_size.observe(labels, size)
+        if elapsed >= self.slow_request_seconds:
+            logger.warning('Slow request %s %s?%s: %.1f ms', request.method, request.path, query_string, elapsed * 1000)
+
+    async def dispatch(self, request, endpoint, url_args):
+        """The decorators of the Flask view, in the same order: token check, post-write wait,
+        response cache, user context."""
+        user_id = url_args.pop('user_id')
+        denial = session_tokens.denial(bearer_token(request.headers.get('authorization', '')), user_id)
+        if denial is not None:
+            message, status = denial
+            return json_reply({'message': message}, status)
+
+        flask_view = flask_app.view_functions[endpoint]
+        if getattr(flask_view, 'waits_for_post_write', False) and post_write_queue.has_work(user_id):
+            await asyncio.to_thread(post_write_queue.wait_for_user, user_id, POST_WRITE_WAIT_SECONDS)
+
+        view = ASYNC_VIEWS[endpoint]
+        if not hasattr(flask_view, 'cache_settings'):
+            return await self.run_view(view, request, user_id, url_args)
+
+        cache_endpoint, bucket_seconds = flask_view.cache_settings
+        key, etag = response_cache.key(cache_endpoint, user_id, request.query_string, bucket_seconds)
+        matched = response_cache.matching_etag(parse_etags(request.headers.get('if-none-match')), etag)
+        if matched is not None:
+            return Reply(304, b'', None, matched)
+        cached_value = response_cache.backend.get(key)
+        if cached_value is None:
+            reply = await self.run_view(view, request, user_id, url_args)
+            if reply.status != 200:
+                return reply
+            cached_value = (reply.body, reply.status, reply.mimetype)
+            response_cache.backend.set(key, cached_value)
+        body, status, mimetype = cached_value
+        return Reply(status, body, mimetype, etag)
+
+    async def run_view(self, view, request, user_id, url_args):
+        async with AsyncSession(self.engines[shards.shard_of(user_id)]) as session:
+            version, context = user_contexts.lookup(user_id)
+            if context is None:
+                context = user_context_from_row((await session.execute(user_context_statement(user_id))).first())
+                user_contexts.store(user_id, version, context)
+            if context is None:
+                return json_reply({'message': 'User not found'}, 404)
+            return await view(session, context, user_id, request.args, **url_args)
+
+    async def send_reply(self, send, request, reply):
+        """Send reply, compressed as Flask's responses are; returns the bytes sent."""
+        body, encoding = reply.body, None
+        vary = []
+        if compressor.varies(reply.mimetype, reply.status):
+            vary.append('Accept-Encoding')
+            body, encoding = compressor.encode(body, request.headers.get('accept-encoding', ''))
+        headers = [(b'content-length', str(len(body)).encode())]
+        if reply.mimetype:
+            headers.append((b'content-type', reply.mimetype.encode()))
+        if encoding:
+            headers.append((b'content-encoding', encoding.encode()))
+        if reply.etag:
+            headers.append((b'etag', quote_etag(encoded_etag(reply.etag, encoding)).encode()))
+        # What CORS(app) adds with its defaults
+        origin = request.headers.get('origin')
+        if origin:
+            headers.append((b'access-control-allow-origin', origin.encode('latin-1')))
+            vary.append('Origin')
+        else:
+            headers.append((b'access-control-allow-origin', b'*'))
+        if vary:
+            headers.append((b'vary', ', '.join(vary).encode()))
+        await send({'type': 'http.response.start', 'status': reply.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+        return len(body)
+
+
+app = AsyncApp(flask_app)
@@ -0,0 +1,144 @@
+# auth.py
+# Signed session tokens and the cached per-user request context.
+#
+# Tokens are stateless: the user id, signed with SECRET_KEY and timestamped, so any
+# worker can check them without a lookup. The user context (user + trait) is loaded
+# with one joined query and cached per user. An entry is only used while the user's
+# data version (bumped by every write path after commit) is the one it was loaded at.
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import request
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import select
+
+from database import db, User, Trait
+
+# trait is None for users who haven't finished the questionnaire,
+# otherwise a dict with user_type, curr_goal and long_goal
+UserContext = namedtuple('UserContext', ['user_id', 'username', 'trait'])
+
+
+class SessionTokens:
+    def __init__(self, secret_key=None, max_age_seconds=30 * 24 * 3600, required=False):
+        self.serializer = URLSafeTimedSerializer(secret_key, salt='session-token') if secret_key else None
+        self.max_age_seconds = max_age_seconds
+        # Off: requests without a token are let through (app builds that don't send one)
+        self.required = required
+
+    def init_app(self, app):
+        """Sign with app's SECRET_KEY; tokens expire after SESSION_TOKEN_MAX_AGE seconds and
+        are needed on per-user requests when REQUIRE_SESSION_TOKEN is set."""
+        self.serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='session-token')
+        self.max_age_seconds = app.config['SESSION_TOKEN_MAX_AGE']
+        self.required = app.config['REQUIRE_SESSION_TOKEN']
+
+    def issue(self, user_id):
+        return self.serializer.dumps({'uid': user_id})
+
+    def user_id(self, token):
+        """user id the token was issued for, or None if it is invalid or expired."""
+        try:
+            return self.serializer.loads(token, max_age=self.max_age_seconds)['uid']
+        except (BadSignature, KeyError, TypeError):
+            return None
+
+    def denial(self, token, user_id):
+        """(message, status) if token is missing (and required), invalid or belongs to
+        another user, else None."""
+        if token is None:
+            return ('Missing session token', 401) if self.required else None
+        token_user_id = self.user_id(token)
+        if token_user_id is None:
+            return 'Invalid or expired token', 401
+        if token_user_id != user_id:
+            return 'Token does not belong to this user', 403
+        return None
+
+
+def bearer_token(authorization):
+    """Token of an "Authorization: Bearer <token>" header value, or None."""
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() == 'bearer' and token:
+        return token.strip()
+    return None
+
+
+def token_from_request():
+    """Bearer token from the Authorization header, or None."""
+    return bearer_token(request.headers.get('Authorization', ''))
+
+
+def user_context_statement(user_id):
+    """User and trait in one query."""
+    return select(
+        User.id, User.username, Trait.id.label('trait_id'), Trait.user_type, Trait.curr_goal, Trait.long_goal
+    ).outerjoin(Trait, Trait.user_id == User.id).where(User.id == user_id)
+
+
+def user_context_from_row(row):
+    """UserContext of a user_context_statement() row. None if there was no row."""
+    if row is None:
+        return None
+    trait = None
+    if row.trait_id is not None:
+        trait = {
+            'user_type': row.user_type,
+            'curr_goal': dict(row.curr_goal) if row.curr_goal is not None else None,
+            'long_goal': dict(row.long_goal) if row.long_goal is not None else None,
+        }
+    return UserContext(row.id, row.username, trait)
+
+
+def load_user_context(user_id):
+    """None if the user doesn't exist."""
+    return user_context_from_row(db.session.execute(user_context_statement(user_id)).first())
+
+
+class UserContextCache:
+    """TTL + LRU cache of UserContext, validated against a per-user data version."""
+
+    def __init__(self, get_version, ttl_seconds=300, max_entries=10000):
+        self.get_version = get_version
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # user_id -> (version, expires_at, context)
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl_seconds = app.config['USER_CONTEXT_TTL_SECONDS']
+        self.max_entries = app.config['USER_CONTEXT_MAX_ENTRIES']
+
+    def get(self, user_id):
+        """Context of user_id, loaded from the database when missing, stale or expired."""
+        version, context = self.lookup(user_id)
+        if context is None:
+            context = load_user_context(user_id)
+            self.store(user_id, version, context)
+        return context
+
+    def lookup(self, user_id):
+        """(version, cached context or None). Load the context after this call and store()
+        it with the version returned here, so an entry is never newer than its version claims."""
+        version = self.get_version(user_id)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] == version and entry[1] > time.monotonic():
+                self.entries.move_to_end(user_id)
+                return version, entry[2]
+        return version, None
+
+    def store(self, user_id, version, context):
+        if context is None:
+            # Not cached: the id may be registered later
+            return
+        with self.lock:
+            self.entries[user_id] = (version, time.monotonic() + self.ttl_seconds, context)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
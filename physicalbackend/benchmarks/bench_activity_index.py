@@ -0,0 +1,135 @@
+# bench_activity_index.py
+# Query plans and latency of the per-user activity lookups with and without the
+# (user_id, start_time DESC) index, on a synthetic SQLite database.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/bench_activity_index.py --activities 1000000 --users 2000
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+parser = argparse.ArgumentParser(description='Benchmark per-user activity queries with and without the composite index.')
+parser.add_argument('--activities', type=int, default=1_000_000)
+parser.add_argument('--users', type=int, default=2000)
+parser.add_argument('--repeat', type=int, default=200, help='Queries per scenario')
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+# The database has to be chosen before server.py is imported
+db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, desc, text  # noqa: E402
+from server import create_app, local_day_range  # noqa: E402
+from database import db, User, Activity  # noqa: E402
+
+app = create_app()
+INDEX_NAME = 'ix_activity_user_id_start_time'
+FIRST_DAY = datetime(2022, 1, 1)
+HISTORY_DAYS = 3 * 365
+
+
+def populate():
+    rng = random.Random(args.seed)
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': f'user{i}', 'password_hash': 'x'} for i in range(1, args.users + 1)
+    ])
+    batch = []
+    for i in range(args.activities):
+        distance = round(rng.uniform(2.0, 15.0), 2)
+        pace = rng.randint(270, 540)
+        batch.append({
+            'user_id': rng.randint(1, args.users),
+            'start_time': FIRST_DAY + timedelta(seconds=rng.randint(0, HISTORY_DAYS * 86400)),
+            'duration_seconds': int(distance * pace),
+            'distance_km': distance,
+            'average_pace_seconds_per_km': pace,
+            'split_paces_json': None,
+            'goal_state': rng.choice(['completed', 'missed']),
+            'goal_dist': 5.0,
+            'goal_pace': 360,
+        })
+        if len(batch) == 50_000:
+            db.session.execute(Activity.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(Activity.__table__.insert(), batch)
+    db.session.commit()
+
+
+def by_date_function(user_id, day):
+    return Activity.query.filter(
+        Activity.user_id == user_id,
+        func.date(Activity.start_time) == day
+    ).order_by(Activity.start_time.desc())
+
+
+def by_date_range(user_id, day):
+    day_start, day_end = local_day_range(day)
+    return Activity.query.filter(
+        Activity.user_id == user_id,
+        Activity.start_time >= day_start,
+        Activity.start_time < day_end
+    ).order_by(Activity.start_time.desc())
+
+
+def recent_runs(user_id, day):
+    return Activity.query.filter_by(user_id=user_id).order_by(desc(Activity.start_time)).limit(10)
+
+
+SCENARIOS = [
+    ('activities_by_date func.date()', by_date_function),
+    ('activities_by_date range', by_date_range),
+    ('last 10 runs (trait update)', recent_runs),
+]
+
+
+def query_plan(query):
+    compiled = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    rows = db.session.execute(text(f'EXPLAIN QUERY PLAN {compiled}')).all()
+    return '; '.join(row[-1] for row in rows)
+
+
+def measure(build_query):
+    rng = random.Random(args.seed)
+    timings = []
+    for _ in range(args.repeat):
+        user_id = rng.randint(1, args.users)
+        day = (FIRST_DAY + timedelta(days=rng.randint(0, HISTORY_DAYS))).date()
+        started = time.perf_counter()
+        build_query(user_id, day).all()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def report(label):
+    print(f'\n== {label} ==')
+    for name, build_query in SCENARIOS:
+        p50, p95 = measure(build_query)
+        print(f'{name:32s} p50 {p50:8.3f} ms  p95 {p95:8.3f} ms')
+        print(f'{"":32s} plan: {query_plan(build_query(1, FIRST_DAY.date()))}')
+
+
+with app.app_context():
+    db.create_all()
+    print(f'Generating {args.activities} activities for {args.users} users in {db_path} ...')
+    started = time.perf_counter()
+    populate()
+    print(f'done in {time.perf_counter() - started:.1f}s')
+
+    db.session.execute(text(f'DROP INDEX {INDEX_NAME}'))
+    db.session.execute(text('ANALYZE'))
+    report('without index')
+
+    started = time.perf_counter()
+    db.session.execute(text(f'CREATE INDEX {INDEX_NAME} ON activity (user_id, start_time DESC)'))
+    db.session.execute(text('ANALYZE'))
+    print(f'\nindex build: {time.perf_counter() - started:.1f}s')
+    report('with index')
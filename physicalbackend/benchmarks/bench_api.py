@@ -0,0 +1,225 @@
+# bench_api.py
+# Replays the app's client flows against the Flask app in-process and reports
+# throughput, p50/p95/p99 latency and SQL statements per endpoint.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/datagen.py bench.db --users 500 --activities-per-user 200
+#   python benchmarks/bench_api.py --db bench.db --sessions 2000 --output before.json
+#   ... change server.py ...
+#   python benchmarks/bench_api.py --db bench.db --sessions 2000 --output after.json --compare before.json
+#
+# The database is copied before the run, so every run starts from the same data.
+# Without --db a database is generated with --users / --activities-per-user.
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, func  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+from database import db, User  # noqa: E402
+from datagen import generate, BENCH_PASSWORD  # noqa: E402
+
+# Share of sessions that open each page after logging in
+FLOW_WEIGHTS = {'run': 0.3, 'history': 0.3, 'analysis': 0.4}
+
+local = threading.local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    local.sql_count = getattr(local, 'sql_count', 0) + 1
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}  # label -> [(seconds, sql statements, status)]
+        self.lock = threading.Lock()
+
+    def call(self, client, label, method, url, **kwargs):
+        local.sql_count = 0
+        started = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.samples.setdefault(label, []).append((elapsed, local.sql_count, response.status_code))
+        return response
+
+
+def percentile(sorted_values, p):
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run_flow(client, recorder, rng, user_id, today):
+    response = recorder.call(client, 'POST /login', 'POST', '/login',
+                             json={'username': f'runner{user_id}', 'password': BENCH_PASSWORD})
+    if response.status_code != 200:
+        return
+
+    flow = rng.choices(list(FLOW_WEIGHTS), weights=list(FLOW_WEIGHTS.values()))[0]
+    if flow == 'run':
+        # Home page shows the goal, then the run is submitted
+        goal = recorder.call(client, 'GET /goal/<id>', 'GET', f'/goal/{user_id}').get_json()
+        distance = round(rng.uniform(2.0, 12.0), 2)
+        pace = rng.randint(280, 540)
+        recorder.call(client, 'POST /activities', 'POST', '/activities', json={
+            'user_id': user_id,
+            'start_time': datetime.now().isoformat(),
+            'duration_seconds': int(distance * pace),
+            'distance_km': distance,
+            'end_latitude': 25.03 + rng.uniform(-0.2, 0.2),
+            'end_longitude': 121.56 + rng.uniform(-0.2, 0.2),
+            'average_pace_seconds_per_km': pace,
+            'split_paces': [pace + rng.randint(-15, 15) for _ in range(int(distance))],
+            'goal_state': 'completed' if distance >= goal['goal_dist'] and pace <= goal['goal_pace'] else 'missed',
+            'goal_dist': goal['goal_dist'],
+            'goal_pace': goal['goal_pace'],
+        })
+    elif flow == 'history':
+        # Calendar of a recent month, then one or two days opened from it
+        month = (today.replace(day=1) - timedelta(days=rng.randint(0, 90))).strftime('%Y-%m')
+        recorder.call(client, 'GET /activities/calendar/<id>', 'GET',
+                      f'/activities/calendar/{user_id}?month={month}')
+        for _ in range(rng.randint(1, 2)):
+            day = (today - timedelta(days=rng.randint(0, 90))).isoformat()
+            recorder.call(client, 'GET /activities_by_date/<id>/<date>', 'GET',
+                          f'/activities_by_date/{user_id}/{day}')
+    else:
+        recorder.call(client, 'GET /user_type/<id>', 'GET', f'/user_type/{user_id}')
+        recorder.call(client, 'GET /analytics/week/<id>', 'GET', f'/analytics/week/{user_id}')
+
+
+def replay(user_count):
+    recorder = Recorder()
+    today = datetime.now().date()
+
+    def worker(index):
+        rng = random.Random(args.seed * 1000 + index)
+        client = app.test_client()
+        for _ in range(index, args.sessions, args.threads):
+            run_flow(client, recorder, rng, rng.randint(1, user_count), today)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Goal adaptation runs after the response; include it in the wall time
+    post_write_queue.flush()
+    return recorder, time.perf_counter() - started
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for label, samples in sorted(recorder.samples.items()):
+        latencies = sorted(seconds * 1000 for seconds, _, _ in samples)
+        statements = [count for _, count, _ in samples]
+        endpoints[label] = {
+            'requests': len(samples),
+            'errors': sum(1 for _, _, status in samples if status >= 400),
+            'throughput_rps': round(len(samples) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'sql_mean': round(sum(statements) / len(statements), 2),
+            'sql_max': max(statements),
+        }
+    total = sum(item['requests'] for item in endpoints.values())
+    return {
+        'config': {key: getattr(args, key) for key in ('db', 'users', 'activities_per_user', 'sessions', 'threads', 'seed')},
+        'elapsed_seconds': round(elapsed, 3),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 2),
+        'endpoints': endpoints,
+    }
+
+
+def print_results(results):
+    print(f'\n{results["requests"]} requests in {results["elapsed_seconds"]:.1f}s '
+          f'({results["throughput_rps"]:.1f} req/s, {args.threads} threads)\n')
+    print(f'{"endpoint":38s} {"count":>6s} {"err":>4s} {"rps":>8s} {"p50 ms":>9s} {"p95 ms":>9s} '
+          f'{"p99 ms":>9s} {"sql avg":>8s} {"sql max":>8s}')
+    for label, item in results['endpoints'].items():
+        print(f'{label:38s} {item["requests"]:6d} {item["errors"]:4d} {item["throughput_rps"]:8.1f} '
+              f'{item["p50_ms"]:9.2f} {item["p95_ms"]:9.2f} {item["p99_ms"]:9.2f} '
+              f'{item["sql_mean"]:8.2f} {item["sql_max"]:8d}')
+
+
+def compare(results, baseline):
+    """Print endpoints that got slower or issue more SQL than in baseline. Returns the regression count."""
+    regressions = 0
+    print(f'\nCompared with {args.compare}:')
+    if baseline['config'] != results['config']:
+        print(f'  (baseline ran with a different configuration: {baseline["config"]})')
+    for label, item in results['endpoints'].items():
+        before = baseline['endpoints'].get(label)
+        if before is None:
+            continue
+        change = (item['p95_ms'] - before['p95_ms']) / before['p95_ms'] if before['p95_ms'] else 0
+        problems = []
+        if change > args.threshold:
+            problems.append(f'p95 {before["p95_ms"]:.2f} -> {item["p95_ms"]:.2f} ms (+{change:.0%})')
+        if item['sql_mean'] > before['sql_mean']:
+            problems.append(f'SQL {before["sql_mean"]:.2f} -> {item["sql_mean"]:.2f} per request')
+        if problems:
+            regressions += 1
+            print(f'  REGRESSION {label}: ' + ', '.join(problems))
+        else:
+            print(f'  ok         {label}: p95 {change:+.0%}')
+    return regressions
+
+
+# Worker processes of the password hashing pool re-import this script
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test the backend API with the client flows.')
+    parser.add_argument('--db', help='Database made by datagen.py (copied, not modified)')
+    parser.add_argument('--users', type=int, default=200, help='Users to generate when --db is not given')
+    parser.add_argument('--activities-per-user', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=500, help='Client sessions to replay')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Results JSON of a previous run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='Relative p95 latency increase that counts as a regression')
+    args = parser.parse_args()
+
+    # The database has to be chosen before server.py is imported
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    if args.db:
+        shutil.copyfile(args.db, db_path)
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    # Slow-request warnings would drown the report
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    from server import create_app, post_write_queue
+    app = create_app()
+
+    if not args.db:
+        print(f'Generating {args.users} users x {args.activities_per_user} activities in {db_path} ...')
+        generate(app, args.users, args.activities_per_user, args.seed)
+    with app.app_context():
+        user_count = db.session.query(func.max(User.id)).scalar()
+
+    print(f'Replaying {args.sessions} sessions for {user_count} users ...')
+    results = summarize(*replay(user_count))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nResults written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f)):
+                sys.exit(1)
@@ -0,0 +1,126 @@
+# bench_archive.py
+# Latency of the recent-window reads before and after `flask archive-activities` moves
+# old activities to the archive table, and of reads that reach back into it.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/bench_archive.py --users 1000 --activities-per-user 400 --older-than-days 180
+#
+# The database is generated with datagen.py: a few runs a week per user, going back
+# over a year. Every round sends the same requests through the Flask app in-process,
+# with the response cache off.
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+parser = argparse.ArgumentParser(description='Benchmark activity reads before and after archiving old activities.')
+parser.add_argument('--users', type=int, default=1000)
+parser.add_argument('--activities-per-user', type=int, default=400)
+parser.add_argument('--older-than-days', type=int, default=180, help='Archive horizon')
+parser.add_argument('--repeat', type=int, default=2000, help='Requests per scenario')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--dir', help='Directory for the database file (default: system temp)')
+args = parser.parse_args()
+
+# The database has to be chosen before server.py is imported
+db_path = os.path.join(tempfile.mkdtemp(dir=args.dir), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+os.environ['USER_CONTEXT_TTL_SECONDS'] = '0'
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from server import create_app, db  # noqa: E402
+from archive import archive_activities  # noqa: E402
+from datagen import generate  # noqa: E402
+
+app = create_app()
+TODAY = date.today()
+
+# (name, url for a user)
+RECENT = [
+    ('past_week', lambda rng, user_id: f'/activities/past_week/{user_id}'),
+    ('history, first page', lambda rng, user_id: f'/activities/{user_id}?limit=20'),
+    ('day view, last 2 weeks', lambda rng, user_id: f'/activities_by_date/{user_id}/{TODAY - timedelta(days=rng.randint(0, 13))}'),
+    ('analytics week', lambda rng, user_id: f'/analytics/week/{user_id}'),
+]
+REACHING_BACK = [
+    ('day view, a year ago', lambda rng, user_id: f'/activities_by_date/{user_id}/{TODAY - timedelta(days=rng.randint(330, 400))}'),
+    ('history, all runs', lambda rng, user_id: f'/activities/{user_id}'),
+    ('analytics, last year', lambda rng, user_id: f'/analytics/window/{user_id}?year={TODAY.year - 1}'),
+]
+
+
+def measure(client, url_for):
+    rng = random.Random(args.seed)
+    timings = []
+    for _ in range(args.repeat):
+        url = url_for(rng, rng.randint(1, args.users))
+        started = time.perf_counter()
+        response = client.get(url)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, (url, response.status_code)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def table_sizes():
+    """KiB per table and index; needs SQLite's dbstat table."""
+    with app.app_context():
+        try:
+            rows = db.session.execute(text('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')).all()
+        except OperationalError:
+            return {}
+    return {name: size // 1024 for name, size in rows if 'activity' in name}
+
+
+def report(label, client, results):
+    print(f'\n== {label} ==')
+    for name, url_for in RECENT + REACHING_BACK:
+        p50, p95 = measure(client, url_for)
+        results.setdefault(name, []).append((p50, p95))
+        print(f'{name:24s} p50 {p50:7.3f} ms  p95 {p95:7.3f} ms')
+    for name, size in sorted(table_sizes().items()):
+        print(f'  {name:40s} {size:9d} KiB')
+
+
+print(f'Generating {args.users} users x {args.activities_per_user} activities in {db_path} ...')
+started = time.perf_counter()
+generate(app, args.users, args.activities_per_user, args.seed)
+print(f'done in {time.perf_counter() - started:.1f}s')
+client = app.test_client()
+with app.app_context():
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+results = {}
+report('all activities in the activity table', client, results)
+
+with app.app_context():
+    started = time.perf_counter()
+    moved = archive_activities(datetime.utcnow() - timedelta(days=args.older_than_days))
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+total = args.users * args.activities_per_user
+print(f'\nArchived {moved} of {total} activities older than {args.older_than_days} days '
+      f'in {time.perf_counter() - started:.1f}s')
+report('after archiving', client, results)
+
+# Deleted rows leave free space in the activity table's pages until SQLite rebuilds the file
+with app.app_context():
+    started = time.perf_counter()
+    with db.engine.connect() as connection:
+        connection.execute(text('VACUUM'))
+print(f'\nVACUUM in {time.perf_counter() - started:.1f}s')
+report('after archiving and VACUUM', client, results)
+
+print(f'\n{"p50 ms":24s} {"before":>8s} {"archived":>9s} {"+VACUUM":>8s}')
+for name, ((before, _), (archived, _), (vacuumed, _)) in results.items():
+    print(f'{name:24s} {before:8.3f} {archived:9.3f} {vacuumed:8.3f}')
@@ -0,0 +1,181 @@
+# bench_async.py
+# Read throughput of one server process in threaded mode (the werkzeug server of
+# `python server.py`) vs. async mode (`uvicorn asgi:app`) for growing numbers of
+# concurrent clients.
+#
+# The database is a local SQLite file standing in for a remote one: every SQL statement
+# first waits --latency-ms, like a network round trip (time.sleep on the threaded path,
+# asyncio.sleep on the async engine). The response and user context caches are off, so
+# every request pays its round trips.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/bench_async.py --clients 1,8,32,128 --latency-ms 5 --seconds 5
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_sharding import QUESTIONNAIRE, configure  # noqa: E402
+
+MODES = ('threaded', 'async')
+
+
+def setup(directory, users, activities):
+    configure(directory, 0)
+    from server import create_app, db
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    for index in range(users):
+        client.post('/register', json={'username': f'reader{index}', 'password': 'bench'})
+        user_id = client.post('/login', json={'username': f'reader{index}', 'password': 'bench'}).get_json()['user_id']
+        client.post('/finish_questionare', json=dict(QUESTIONNAIRE, user_id=user_id))
+        client.post('/activities/batch', json=[{
+            'user_id': user_id,
+            'start_time': f'2025-{1 + day // 28 % 12:02d}-{1 + day % 28:02d}T07:00:00',
+            'duration_seconds': 1800,
+            'distance_km': 5.0 + day % 5,
+            'average_pace_seconds_per_km': 300 + day % 60,
+            'split_paces': [300] * 5,
+            'goal_state': 'completed',
+        } for day in range(activities)])
+
+
+def inject_latency(seconds):
+    """Delay every statement on every engine by seconds, without blocking the event loop on async engines."""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.util import await_only
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def delay(conn, cursor, statement, parameters, context, executemany):
+        if conn.dialect.is_async:
+            await_only(asyncio.sleep(seconds))
+        else:
+            time.sleep(seconds)
+
+
+def serve(directory, mode, port, latency):
+    configure(directory, 0)
+    os.environ['DATABASE_PROFILE'] = 'production'
+    os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+    os.environ['USER_CONTEXT_TTL_SECONDS'] = '0'
+    inject_latency(latency)
+    if mode == 'threaded':
+        from werkzeug.serving import make_server
+        from server import create_app
+        app = create_app()
+        # No access log, as with uvicorn's log_level below
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+    else:
+        import uvicorn
+        from asgi import app
+        uvicorn.run(app, host='127.0.0.1', port=port, log_level='warning')
+
+
+async def fetch(connection, path):
+    """GET path; returns (status, whether the server keeps the connection open)."""
+    reader, writer = connection
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    lines = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').lower().split('\r\n')
+    headers = dict(line.split(':', 1) for line in lines[1:] if ':' in line)
+    await reader.readexactly(int(headers['content-length']))
+    return int(lines[0].split()[1]), headers.get('connection', '').strip() != 'close'
+
+
+async def load(port, clients, paths, seconds):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client(index):
+        nonlocal errors
+        connection = None
+        request = index
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            # The werkzeug server closes the connection after every response
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', port)
+            status, keep_alive = await fetch(connection, paths[request % len(paths)])
+            if not keep_alive:
+                connection[1].close()
+                connection = None
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+            request += clients
+        if connection is not None:
+            connection[1].close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(index) for index in range(clients)))
+    return len(latencies) / (time.perf_counter() - started), sorted(latencies), errors
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare threaded and async serving of the read endpoints.')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--clients', default='1,8,32,128', help='Comma-separated numbers of concurrent clients')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='Injected delay per SQL statement')
+    parser.add_argument('--seconds', type=float, default=5.0, help='Duration of each run')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--activities', type=int, default=30, help='Activities per user')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--dir', help='Directory for the database file (default: system temp)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=setup, args=(directory, args.users, args.activities))
+    process.start()
+    process.join()
+
+    paths = []
+    for user_id in range(1, args.users + 1):
+        paths += [f'/goal/{user_id}', f'/user_type/{user_id}', f'/activities/{user_id}?limit=20',
+                  f'/activities/past_week/{user_id}', f'/activities/calendar/{user_id}?month=2025-03']
+
+    print(f'{args.latency_ms} ms per statement, {args.seconds}s per run, one server process, {os.cpu_count()} CPUs\n')
+    print(f'{"mode":9s} {"clients":>8s} {"req/s":>9s} {"p50 ms":>8s} {"p95 ms":>8s} {"errors":>7s}')
+    for mode in args.modes.split(','):
+        server = context.Process(target=serve, args=(directory, mode, args.port, args.latency_ms / 1000), daemon=True)
+        server.start()
+        try:
+            wait_for_port(args.port)
+            # Warm up connections and imports
+            asyncio.run(load(args.port, 4, paths, 1))
+            for clients in [int(value) for value in args.clients.split(',')]:
+                rate, latencies, errors = asyncio.run(load(args.port, clients, paths, args.seconds))
+                print(f'{mode:9s} {clients:8d} {rate:9.1f} {statistics.median(latencies) * 1000:8.2f} '
+                      f'{latencies[int(len(latencies) * 0.95) - 1] * 1000:8.2f} {errors:7d}')
+        finally:
+            server.terminate()
+            server.join()
+
+
+# The setup and server processes are spawned and re-import this script
+if __name__ == '__main__':
+    main()
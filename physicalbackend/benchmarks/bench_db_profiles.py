@@ -0,0 +1,109 @@
+# bench_db_profiles.py
+# Concurrent writers and readers against SQLite with each DATABASE_PROFILE:
+# POST /activities from writer processes while reader processes load history pages.
+# Reports throughput, latency and failed requests ("database is locked") per side.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/bench_db_profiles.py --writers 4 --readers 4 --activities 300 --dir /data/bench
+#
+# The setup and writer processes are the ones of bench_sharding.py, on one database.
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_sharding import configure, setup, writer  # noqa: E402
+from dbprofile import PROFILES  # noqa: E402
+
+
+def reader(directory, user_ids, requests, barrier, results):
+    configure(directory, 0)
+    # The in-process response cache doesn't see the writers' processes; measure the database
+    os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+    from server import create_app
+    app = create_app()
+    client = app.test_client()
+    barrier.wait()
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for index in range(requests):
+        user_id = user_ids[index % len(user_ids)]
+        request_started = time.perf_counter()
+        response = client.get(f'/activities/{user_id}?limit=50')
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code != 200:
+            errors += 1
+    results.put(('read', time.perf_counter() - started, latencies, errors))
+
+
+def run(profile, args):
+    # Spawned processes inherit the environment
+    os.environ['DATABASE_PROFILE'] = profile
+    directory = tempfile.mkdtemp(dir=args.dir)
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=setup, args=(directory, 0, args.users))
+    process.start()
+    process.join()
+
+    barrier = context.Barrier(args.writers + args.readers)
+    results = context.Queue()
+    user_ids = list(range(1, args.users + 1))
+    processes = [
+        context.Process(target=writer, args=(directory, 0, user_ids[index::args.writers], args.activities, barrier, results))
+        for index in range(args.writers)
+    ] + [
+        context.Process(target=reader, args=(directory, user_ids, args.reads, barrier, results))
+        for _ in range(args.readers)
+    ]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    summary = {}
+    for side in ('write', 'read'):
+        side_outcomes = [outcome for outcome in outcomes if outcome[0] == side]
+        if not side_outcomes:
+            continue
+        latencies = sorted(latency for _, _, process_latencies, _ in side_outcomes for latency in process_latencies)
+        summary[side] = {
+            'rate': len(latencies) / max(seconds for _, seconds, _, _ in side_outcomes),
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            'errors': sum(errors for _, _, _, errors in side_outcomes),
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare database profiles under concurrent reads and writes.')
+    parser.add_argument('--profiles', default=','.join(PROFILES))
+    parser.add_argument('--writers', type=int, default=4, help='Writer processes')
+    parser.add_argument('--readers', type=int, default=4, help='Reader processes')
+    parser.add_argument('--activities', type=int, default=300, help='Activities per writer process')
+    parser.add_argument('--reads', type=int, default=300, help='History requests per reader process')
+    parser.add_argument('--users', type=int, default=64)
+    parser.add_argument('--dir', help='Directory for the database files (default: system temp)')
+    args = parser.parse_args()
+
+    print(f'{args.writers} writers x {args.activities} activities, {args.readers} readers x {args.reads} requests, '
+          f'{os.cpu_count()} CPUs\n')
+    print(f'{"profile":12s} {"side":6s} {"req/s":>9s} {"p50 ms":>8s} {"p95 ms":>8s} {"errors":>7s}')
+    for profile in args.profiles.split(','):
+        for side, result in run(profile, args).items():
+            print(f'{profile:12s} {side:6s} {result["rate"]:9.1f} {result["p50_ms"]:8.2f} '
+                  f'{result["p95_ms"]:8.2f} {result["errors"]:7d}')
+
+
+# Worker processes are spawned and re-import this script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# bench_passwords.py
+# Login throughput per core with the password hashing pool, and /goal latency
+# during a login burst with hashing in the pool vs. in the request threads.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/bench_passwords.py --method scrypt --logins 200
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+from passwords import PasswordHasher  # noqa: E402
+
+PASSWORD = 'bench-password'
+
+
+def login_rate(hasher, password_hash, logins, threads):
+    """Verify logins passwords from threads client threads; returns logins per second."""
+    def worker(count):
+        for _ in range(count):
+            assert hasher.verify(password_hash, PASSWORD)
+
+    # Start the pool processes before timing
+    hasher.verify(password_hash, PASSWORD)
+    workers = [threading.Thread(target=worker, args=(logins // threads,)) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (logins // threads * threads) / (time.perf_counter() - started)
+
+
+def goal_latency_during_burst(server, app, hasher, logins, threads):
+    """p50/p95 of GET /goal (ms) while threads clients log in continuously."""
+    server.password_hasher = hasher
+    done = threading.Event()
+
+    def login_worker():
+        client = app.test_client()
+        for _ in range(logins // threads):
+            client.post('/login', json={'username': 'runner', 'password': PASSWORD})
+        done.set()
+
+    client = app.test_client()
+    client.post('/login', json={'username': 'runner', 'password': PASSWORD})
+    workers = [threading.Thread(target=login_worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    timings = []
+    while not done.is_set():
+        started = time.perf_counter()
+        client.get('/goal/1')
+        timings.append((time.perf_counter() - started) * 1000)
+        time.sleep(0.005)
+    for thread in workers:
+        thread.join()
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark password hashing throughput and its effect on other requests.')
+    parser.add_argument('--method', default='scrypt', help='werkzeug hash method, e.g. scrypt or pbkdf2:sha256:600000')
+    parser.add_argument('--logins', type=int, default=100, help='Logins per measurement')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    password_hash = generate_password_hash(PASSWORD, method=args.method)
+    print(f'method {password_hash.split("$")[0]}, {os.cpu_count()} CPUs\n')
+
+    print(f'{"hashing":22s} {"logins/s":>10s} {"per core":>10s}')
+    inline = PasswordHasher(args.method, workers=0, max_pending=10**6)
+    rate = login_rate(inline, password_hash, args.logins, args.max_workers)
+    print(f'{"request threads":22s} {rate:10.1f} {rate / min(args.max_workers, os.cpu_count() or 1):10.1f}')
+    for workers in range(1, args.max_workers + 1):
+        hasher = PasswordHasher(args.method, workers=workers, max_pending=10**6)
+        rate = login_rate(hasher, password_hash, args.logins, 2 * workers)
+        hasher.shutdown()
+        print(f'{f"pool, {workers} workers":22s} {rate:10.1f} {rate / workers:10.1f}')
+
+    # The database has to be chosen before server.py is imported
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}'
+    # Slow-request warnings would drown the report
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    import server
+    app = server.create_app()
+    with app.app_context():
+        server.db.create_all()
+        server.db.session.add(server.User(username='runner', password_hash=password_hash))
+        server.db.session.commit()
+
+    threads = 4 * args.max_workers
+    print(f'\nGET /goal during a burst of {args.logins} logins from {threads} clients')
+    for label, hasher in [
+        ('request threads', PasswordHasher(args.method, workers=0, max_pending=10**6)),
+        ('pool', PasswordHasher(args.method, workers=args.max_workers, max_pending=10**6)),
+    ]:
+        p50, p95 = goal_latency_during_burst(server, app, hasher, args.logins, threads)
+        hasher.shutdown()
+        print(f'{label:22s} p50 {p50:8.2f} ms  p95 {p95:8.2f} ms')
+
+
+# Worker processes of the hashing pool re-import this script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# bench_rankings.py
+# Cohort rankings from the in-memory index against computing them per request.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/bench_rankings.py --users 2000 --activities-per-user 60
+#
+# Generates --users runners with traits and histories (datagen.py), then measures:
+#   - building the index from the activity tables vs. loading the saved snapshot,
+#   - GET /rank/<user_id> and GET /rank/top/<user_type> against the brute-force way
+#     (aggregate the cohort's week in SQL, sort in Python) on the same data,
+#   - POST /activities before the index is loaded and while it is kept up to date,
+# and finally runs the consistency check after the inserts.
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+parser = argparse.ArgumentParser(description='Benchmark the cohort ranking index.')
+parser.add_argument('--users', type=int, default=2000)
+parser.add_argument('--activities-per-user', type=int, default=60)
+parser.add_argument('--repeat', type=int, default=200)
+parser.add_argument('--inserts', type=int, default=300)
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--dir', help='Directory for the database file (default: system temp)')
+args = parser.parse_args()
+
+# The database has to be chosen before server.py is imported
+db_path = os.path.join(tempfile.mkdtemp(dir=args.dir), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+os.environ['RANKING_SNAPSHOT_SECONDS'] = '0'
+os.environ['POST_WRITE_WORKERS'] = '0'
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select  # noqa: E402
+from server import create_app, db, rankings, shards  # noqa: E402
+from database import Activity, Trait  # noqa: E402
+from rankings import RankingIndex, week_of  # noqa: E402
+from datagen import generate  # noqa: E402
+
+app = create_app()
+rng = random.Random(args.seed)
+
+
+def p50_ms(function, repeat=None):
+    timings = []
+    for _ in range(repeat or args.repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def cohort_distances(user_type, week):
+    """{user_id: meters} of the cohort's week, aggregated per request."""
+    monday = datetime.combine(date.fromordinal(week), datetime.min.time())
+    rows = db.session.execute(
+        select(Activity.user_id, func.sum(Activity.distance_km))
+        .join(Trait, Trait.user_id == Activity.user_id)
+        .where(Trait.user_type == user_type, Activity.start_time >= monday,
+               Activity.start_time < monday + timedelta(days=7))
+        .group_by(Activity.user_id)
+    ).all()
+    return {user_id: round(distance * 1000) for user_id, distance in rows}
+
+
+def brute_force_rank(user_id, user_type, week):
+    distances = cohort_distances(user_type, week)
+    if user_id not in distances:
+        return None
+    return 1 + sum(1 for meters in distances.values() if meters > distances[user_id])
+
+
+def brute_force_top(user_type, week, limit=10):
+    distances = cohort_distances(user_type, week)
+    return sorted(distances.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+print(f'Generating {args.users} users x {args.activities_per_user} activities in {db_path} ...')
+generate(app, args.users, args.activities_per_user, args.seed)
+client = app.test_client()
+week = week_of(datetime.now().date())
+
+
+def post_run():
+    response = client.post('/activities', json={
+        'user_id': rng.randint(1, args.users),
+        'start_time': datetime.now().replace(microsecond=0).isoformat(),
+        'duration_seconds': 1800,
+        'distance_km': round(rng.uniform(2, 15), 2),
+        'average_pace_seconds_per_km': rng.randint(240, 540),
+        'split_paces': [300] * 5,
+        'goal_state': 'completed',
+        'goal_dist': 5.0,
+        'goal_pace': 420,
+    })
+    assert response.status_code == 201, response.get_data(as_text=True)
+
+
+# The app's index loads on the first ranking read; until then inserts don't touch it
+not_loaded_ms = p50_ms(post_run, args.inserts)
+
+with app.app_context():
+    user_types = dict(db.session.execute(select(Trait.user_id, Trait.user_type)).all())
+    in_week = cohort_distances(user_types[1], week)
+    print(f'{len(user_types)} users in {len(set(user_types.values()))} cohorts, '
+          f'{len(in_week)} of cohort {user_types[1]!r} ran this week')
+
+    print('\n== loading the index ==')
+    index = RankingIndex(shards, app, weeks=app.config['RANKING_WEEKS'], snapshot_seconds=0)
+    print(f'{"from the activities":28s} {p50_ms(lambda: index.load(from_snapshot=False), 5):8.1f} ms')
+    index.save()
+    print(f'{"from the snapshot":28s} {p50_ms(lambda: index.load(), 5):8.1f} ms  '
+          f'{len(index.totals)} weekly totals')
+
+sample = [rng.randint(1, args.users) for _ in range(args.repeat)]
+
+print('\n== GET /rank/<user_id> ==')
+with app.app_context():
+    for user_id in sample[:20]:
+        expected = brute_force_rank(user_id, user_types[user_id], week)
+        body = client.get(f'/rank/{user_id}').get_json()
+        assert (body['distance'] or {}).get('rank') == expected, (user_id, body, expected)
+    iterator = iter(sample * 2)
+    print(f'{"brute force (SQL + sort)":28s} '
+          f'{p50_ms(lambda: (user_id := next(iterator), brute_force_rank(user_id, user_types[user_id], week))):8.2f} ms')
+iterator = iter(sample * 2)
+print(f'{"index":28s} {p50_ms(lambda: client.get(f"/rank/{next(iterator)}")):8.2f} ms')
+
+print('\n== GET /rank/top/<user_type> ==')
+user_type = user_types[1]
+with app.app_context():
+    entries = client.get(f'/rank/top/{user_type}?limit=10').get_json()['entries']
+    assert [(entry['user_id'], round(entry['value'] * 1000)) for entry in entries] == brute_force_top(user_type, week)
+    print(f'{"brute force (SQL + sort)":28s} {p50_ms(lambda: brute_force_top(user_type, week)):8.2f} ms')
+print(f'{"index, first page":28s} {p50_ms(lambda: client.get(f"/rank/top/{user_type}?limit=10")):8.2f} ms')
+deep = max(0, len(in_week) - 10)
+print(f'{f"index, offset {deep}":28s} {p50_ms(lambda: client.get(f"/rank/top/{user_type}?limit=10&offset={deep}")):8.2f} ms')
+
+print('\n== POST /activities ==')
+print(f'{"index not loaded":28s} {not_loaded_ms:8.2f} ms')
+catch_up_ms = []
+after_insert = rankings.after_insert
+
+
+def timed_after_insert(key):
+    started = time.perf_counter()
+    after_insert(key)
+    catch_up_ms.append((time.perf_counter() - started) * 1000)
+
+
+rankings.after_insert = timed_after_insert
+print(f'{"index kept up to date":28s} {p50_ms(post_run, args.inserts):8.2f} ms')
+print(f'{"  of which the catch-up":28s} {statistics.median(catch_up_ms):8.2f} ms')
+
+with app.app_context():
+    problems = rankings.check()
+print(f'\nConsistency check after {2 * args.inserts} inserts: {len(problems)} differences')
+for problem in problems[:20]:
+    print(' ', problem)
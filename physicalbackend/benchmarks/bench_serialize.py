@@ -0,0 +1,117 @@
+# bench_serialize.py
+# Serialization time and bytes on the wire for a full activity history.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/bench_serialize.py --activities 1000
+#
+# One user with --activities activities (datagen.py). Measures, on the rows of
+# GET /activities/<user_id>:
+#   - rows -> dicts: the per-field function the endpoints used before (kept below as a
+#     reference) against the compiled serializer,
+#   - dicts -> JSON: Flask's default provider against OrjsonProvider,
+#   - the compression settings on the resulting body,
+# and then the whole request through the Flask app per Accept-Encoding.
+import argparse
+import gzip
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description='Benchmark activity serialization and response compression.')
+parser.add_argument('--activities', type=int, default=1000)
+parser.add_argument('--repeat', type=int, default=200)
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--dir', help='Directory for the database file (default: system temp)')
+args = parser.parse_args()
+
+# The database has to be chosen before server.py is imported
+db_path = os.path.join(tempfile.mkdtemp(dir=args.dir), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+from server import create_app, db, activities_read, ACTIVITY_FIELD_COLUMNS  # noqa: E402
+from database import decode_split_paces  # noqa: E402
+from serialize import OrjsonProvider, orjson  # noqa: E402
+from compression import brotli  # noqa: E402
+from datagen import generate  # noqa: E402
+
+app = create_app()
+USER_ID = 1
+
+
+def legacy_row_to_dict(row, fields):
+    """The per-row field dispatch the activity endpoints used before row_serializer()."""
+    item = {}
+    for field in fields:
+        if field == 'start_time':
+            item[field] = row.start_time.isoformat()
+        elif field == 'split_paces':
+            item[field] = decode_split_paces(row.split_paces_blob, row.split_paces_json) or []
+        else:
+            item[field] = getattr(row, ACTIVITY_FIELD_COLUMNS[field][0].key)
+    return item
+
+
+def p50_ms(function):
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+print(f'Generating 1 user x {args.activities} activities in {db_path} ...')
+generate(app, 1, args.activities, args.seed)
+client = app.test_client()
+url = f'/activities/{USER_ID}'
+
+with app.test_request_context():
+    statement, render = activities_read(USER_ID, {})
+    rows = db.session.execute(statement).all()
+    fields = list(ACTIVITY_FIELD_COLUMNS)
+    print(f'\n== rows -> dicts ({len(rows)} rows) ==')
+    print(f'{"per-field function":28s} {p50_ms(lambda: [legacy_row_to_dict(row, fields) for row in rows]):7.2f} ms')
+
+    class Rows:
+        """Result stand-in, so render() is timed without the query."""
+        def all(self):
+            return rows
+    output = render(Rows())
+    assert output == [legacy_row_to_dict(row, fields) for row in rows]
+    print(f'{"compiled serializer":28s} {p50_ms(lambda: render(Rows())):7.2f} ms')
+    print(f'{"query + fetch":28s} {p50_ms(lambda: db.session.execute(statement).all()):7.2f} ms')
+
+    print('\n== dicts -> JSON ==')
+    providers = [('Flask default provider', DefaultJSONProvider(app))]
+    if orjson is not None:
+        providers.append(('OrjsonProvider', OrjsonProvider(app)))
+    bodies = []
+    for name, provider in providers:
+        bodies.append(provider.response(output).get_data())
+        print(f'{name:28s} {p50_ms(lambda: provider.response(output)):7.2f} ms  {len(bodies[-1]):8d} bytes')
+    assert all(body == bodies[0] for body in bodies)
+    body = bodies[0]
+
+print('\n== compressing the body ==')
+settings = [(f'gzip level {level}', lambda level=level: gzip.compress(body, compresslevel=level, mtime=0))
+            for level in (1, 6, 9)]
+if brotli is not None:
+    settings += [(f'brotli quality {quality}', lambda quality=quality: brotli.compress(body, quality=quality))
+                 for quality in (1, 4, 6)]
+for name, compress in settings:
+    print(f'{name:28s} {p50_ms(compress):7.2f} ms  {len(compress()):8d} bytes')
+
+print(f'\n== GET {url}, whole request ==')
+for encoding in ['identity', 'gzip'] + (['br'] if brotli is not None else []):
+    headers = {'Accept-Encoding': encoding}
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding', 'identity') == encoding
+    print(f'{encoding:28s} {p50_ms(lambda: client.get(url, headers=headers)):7.2f} ms  {len(response.data):8d} bytes')
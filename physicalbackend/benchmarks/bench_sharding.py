@@ -0,0 +1,136 @@
+# bench_sharding.py
+# POST /activities throughput with several writer processes (like several server
+# workers) against one SQLite database vs. users sharded over N databases.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/bench_sharding.py --shards 0,1,2,4 --processes 4 --activities 500
+#
+# Shard count 0 is the unsharded setup (everything in DATABASE_URL). Writer processes
+# start together after importing the app; each posts --activities runs for its users.
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+QUESTIONNAIRE = {'g1': 'Faster speed', 'g2': 'No', 'h1': 'Within a week', 'h2': '3~10km', 'h3': '5~7',
+                 'h4': 'kg (Additional: weight=75)', 'm1': 'No', 'm2': 'Yes'}
+
+
+def configure(directory, shards):
+    """Environment for server.py with shards shard databases (0: not sharded) in directory."""
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(directory, "main.db")}'
+    os.environ['SHARD_DATABASE_URLS'] = ','.join(
+        f'sqlite:///{os.path.join(directory, f"shard{index}.db")}' for index in range(shards))
+    # Cheap hashes and inline goal adaptation: the benchmark is about the database writes
+    os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    os.environ['PASSWORD_HASH_WORKERS'] = '0'
+    os.environ['POST_WRITE_WORKERS'] = '0'
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+
+def setup(directory, shards, users):
+    configure(directory, shards)
+    from server import create_app, db, shards as app_shards
+    app = create_app()
+    from database import current_engine
+    with app.app_context():
+        app_shards.create_directory()
+        for _ in app_shards.each():
+            db.metadata.create_all(current_engine())
+    client = app.test_client()
+    for index in range(users):
+        client.post('/register', json={'username': f'writer{index}', 'password': 'bench'})
+        user_id = client.post('/login', json={'username': f'writer{index}', 'password': 'bench'}).get_json()['user_id']
+        client.post('/finish_questionare', json=dict(QUESTIONNAIRE, user_id=user_id))
+
+
+def writer(directory, shards, user_ids, activities, barrier, results):
+    configure(directory, shards)
+    from server import create_app
+    app = create_app()
+    client = app.test_client()
+    barrier.wait()
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for index in range(activities):
+        user_id = user_ids[index % len(user_ids)]
+        day = 1 + index // len(user_ids)
+        request_started = time.perf_counter()
+        response = client.post('/activities', json={
+            'user_id': user_id,
+            'start_time': f'2025-{1 + day // 28 % 12:02d}-{1 + day % 28:02d}T07:{index % 60:02d}:00',
+            'duration_seconds': 1800,
+            'distance_km': 5.0 + index % 5,
+            'average_pace_seconds_per_km': 300 + index % 60,
+            'split_paces': [300] * 5,
+            'goal_state': 'completed',
+            'goal_dist': 5.0,
+            'goal_pace': 420,
+        })
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code != 201:
+            errors += 1
+    results.put(('write', time.perf_counter() - started, latencies, errors))
+
+
+def run(shards, args):
+    directory = tempfile.mkdtemp(dir=args.dir)
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=setup, args=(directory, shards, args.users))
+    process.start()
+    process.join()
+
+    barrier = context.Barrier(args.processes)
+    results = context.Queue()
+    user_ids = list(range(1, args.users + 1))
+    writers = [
+        context.Process(target=writer, args=(directory, shards, user_ids[index::args.processes],
+                                             args.activities, barrier, results))
+        for index in range(args.processes)
+    ]
+    for process in writers:
+        process.start()
+    outcomes = [results.get() for _ in writers]
+    for process in writers:
+        process.join()
+
+    elapsed = max(seconds for _, seconds, _, _ in outcomes)
+    latencies = sorted(latency for _, _, process_latencies, _ in outcomes for latency in process_latencies)
+    return {
+        'activities': len(latencies),
+        'rate': len(latencies) / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        'errors': sum(errors for _, _, _, errors in outcomes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark activity writes with and without sharding.')
+    parser.add_argument('--shards', default='0,1,2,4', help='Comma-separated shard counts; 0 = not sharded')
+    parser.add_argument('--processes', type=int, default=4, help='Writer processes')
+    parser.add_argument('--activities', type=int, default=500, help='Activities per writer process')
+    parser.add_argument('--users', type=int, default=64)
+    parser.add_argument('--dir', help='Directory for the database files (default: system temp)')
+    args = parser.parse_args()
+
+    print(f'{args.processes} writer processes x {args.activities} activities, {args.users} users, {os.cpu_count()} CPUs\n')
+    print(f'{"shards":>8s} {"activities/s":>13s} {"speedup":>8s} {"p50 ms":>8s} {"p95 ms":>8s} {"errors":>7s}')
+    baseline = None
+    for shards in [int(value) for value in args.shards.split(',')]:
+        result = run(shards, args)
+        baseline = baseline or result['rate']
+        print(f'{shards or "-":>8} {result["rate"]:13.1f} {result["rate"] / baseline:7.2f}x '
+              f'{result["p50_ms"]:8.2f} {result["p95_ms"]:8.2f} {result["errors"]:7d}')
+
+
+# Writer processes are spawned and re-import this script
+if __name__ == '__main__':
+    main()
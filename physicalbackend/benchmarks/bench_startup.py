@@ -0,0 +1,154 @@
+# bench_startup.py
+# Cold start of a worker: how long a fresh process takes to import the app, build it and
+# serve its first requests, and a one-shot CLI command end to end.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/bench_startup.py --runs 10
+#
+# Generates a database (datagen.py), then starts --runs fresh interpreters per mode:
+#   cold      import server, create_app(), serve: what `flask run`, waitress or a
+#             gunicorn worker without preload_app pay,
+#   prewarm   the same with DATABASE_PREWARM_CONNECTIONS=2 (warm_up() in create_app),
+#   preload   the app built in a parent and the worker forked from it, with the
+#             post_fork hook of gunicorn.conf.py (POSIX only),
+# and reports the medians of: import, create_app, the first request, and the next
+# --requests requests (each endpoint once more, at their warm latency).
+# Trees from before the app factory (a module-level server.app) are measured too, so the
+# script can be run on an older checkout for comparison.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# The per-user reads a client makes when it opens the app, first one timed on its own
+PATHS = ['/activities/{user}', '/goal/{user}', '/user_type/{user}', '/activities/past_week/{user}',
+         '/activities/calendar/{user}', '/activities/{user}?limit=20']
+
+
+def build_app():
+    import server
+    if hasattr(server, 'create_app'):
+        return server.create_app()
+    return server.app
+
+
+def probe(mode, user_id, requests):
+    """Runs in the fresh interpreter; prints the timings as JSON."""
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    import server  # noqa: F401
+    imported = time.perf_counter()
+    app = build_app()
+    built = time.perf_counter()
+    timings = {'import_ms': (imported - started) * 1000, 'create_app_ms': (built - imported) * 1000}
+
+    if mode == 'preload':
+        import runpy
+        import types
+        # The hook takes the app from wsgi.py; hand it this one rather than building another
+        sys.modules['wsgi'] = types.SimpleNamespace(app=app)
+        post_fork = runpy.run_path(os.path.join(ROOT, 'gunicorn.conf.py'))['post_fork']
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(write)
+            with os.fdopen(read) as pipe:
+                print(pipe.read())
+            os.waitpid(pid, 0)
+            return
+        os.close(read)
+        forked = time.perf_counter()
+        post_fork(None, None)
+        timings = {'import_ms': 0.0, 'create_app_ms': (time.perf_counter() - forked) * 1000}
+        started = forked
+        out = os.fdopen(write, 'w')
+    else:
+        out = sys.stdout
+
+    client = app.test_client()
+    paths = [path.format(user=user_id) for path in PATHS]
+    request_started = time.perf_counter()
+    assert client.get(paths[0]).status_code == 200
+    timings['first_request_ms'] = (time.perf_counter() - request_started) * 1000
+    timings['to_first_response_ms'] = (time.perf_counter() - started) * 1000
+    request_started = time.perf_counter()
+    for index in range(requests):
+        assert client.get(paths[(index + 1) % len(paths)]).status_code == 200
+    timings['next_requests_ms'] = (time.perf_counter() - request_started) * 1000
+    request_started = time.perf_counter()
+    for index in range(requests):
+        client.get(paths[(index + 1) % len(paths)])
+    timings['warm_requests_ms'] = (time.perf_counter() - request_started) * 1000
+    out.write(json.dumps(timings))
+    out.flush()
+    if mode == 'preload':
+        os._exit(0)
+
+
+def run(command, env):
+    started = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f'{" ".join(command)} failed:\n{result.stderr}')
+    return result.stdout, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark process start and first requests.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--activities-per-user', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--dir', help='Directory for the database file (default: system temp)')
+    parser.add_argument('--probe', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        probe(args.probe, 1, args.requests)
+        return
+
+    db_path = os.path.join(tempfile.mkdtemp(dir=args.dir), 'bench.db')
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{db_path}', PASSWORD_HASH_WORKERS='0',
+               LOG_LEVEL='ERROR', FLASK_APP='server.py')
+    env.pop('DATABASE_PREWARM_CONNECTIONS', None)
+    print(f'Generating {args.users} users x {args.activities_per_user} activities in {db_path} ...')
+    run([sys.executable, os.path.join(HERE, 'datagen.py'), db_path,
+         '--users', str(args.users), '--activities-per-user', str(args.activities_per_user)], env)
+
+    modes = [('cold', {}), ('prewarm', {'DATABASE_PREWARM_CONNECTIONS': '2'})]
+    if hasattr(os, 'fork') and os.path.exists(os.path.join(ROOT, 'gunicorn.conf.py')):
+        modes.append(('preload', {'DATABASE_PREWARM_CONNECTIONS': '2'}))
+    columns = ['import_ms', 'create_app_ms', 'first_request_ms', 'to_first_response_ms',
+               'next_requests_ms', 'warm_requests_ms']
+    print(f'\nmedians of {args.runs} fresh processes, ms; "next" and "warm" are {args.requests} requests each')
+    print(f'{"mode":10s} {"import":>8s} {"app":>8s} {"first":>8s} {"to first":>9s} {"next":>8s} '
+          f'{"warm":>8s} {"process":>8s}')
+    for mode, extra in modes:
+        results = []
+        for _ in range(args.runs):
+            output, wall_ms = run([sys.executable, os.path.abspath(__file__), '--probe', mode,
+                                   '--requests', str(args.requests)], dict(env, **extra))
+            results.append(dict(json.loads(output), process_ms=wall_ms))
+        medians = [statistics.median(result[column] for result in results) for column in columns + ['process_ms']]
+        print(f'{mode:10s} ' + ' '.join(f'{value:8.1f}' for value in medians[:3])
+              + f' {medians[3]:9.1f} ' + ' '.join(f'{value:8.1f}' for value in medians[4:]))
+    if modes[-1][0] == 'preload':
+        print('  preload: "app" is the post_fork hook; import and create_app ran once in the parent')
+
+    print('\n== one-shot CLI command, whole process ==')
+    for command in (['flask', 'db-settings'], ['flask', '--help']):
+        timings = [run([sys.executable, '-m'] + command, env)[1] for _ in range(args.runs)]
+        print(f'{" ".join(command):28s} {statistics.median(timings):8.1f} ms')
+    timings = [run([sys.executable, '-c', 'pass'], env)[1] for _ in range(args.runs)]
+    print(f'{"python -c pass":28s} {statistics.median(timings):8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+# check_questionnaire.py
+# Differential check of questionnaire.QuestionnaireRules against the if/elif version of
+# /finish_questionare it replaced (legacy_traits below, kept verbatim), over every
+# combination of the app's answer options plus missing, unknown and malformed answers.
+# Reports any combination where the two disagree, and the time per submission of each.
+#
+# Usage (from physicalbackend/):
+#   python benchmarks/check_questionnaire.py
+import itertools
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from questionnaire import QuestionnaireRules  # noqa: E402
+
+MAX_PACE_SECONDS_PER_KM = 599
+
+
+def legacy_traits(data):
+    long_goal = {"dist": 21.0, "pace": 300, "weight": 60.0}
+    
+    curr_goal = {"dist": 5.0, "pace": 420, "weight": 70.0, "freq": 3.0} # Added 'freq' with a default
+
+    usually_quit = False
+    now_quit = False # This field is typically updated by the performance logic in update_trait_after_run, not directly from questionnaire
+    believe_ai = False
+
+    # Helper function to parse additional input from answers string
+    def parse_additional_input(answer_string):
+        """Parses additional key=value pairs from an answer string like '(Additional: key1=val1, key2=val2)'."""
+        match = re.search(r'\(Additional: (.*)\)', answer_string)
+        if match:
+            params_str = match.group(1)
+            params = {}
+            for pair in params_str.split(', '):
+                key_val = pair.split('=')
+                if len(key_val) == 2:
+                    key, val = key_val[0], key_val[1]
+                    try:
+                        # Attempt to convert to float or int for numeric values
+                        if key in ['distance', 'goal', 'weight']:
+                            params[key] = float(val)
+                        elif key == 'speed':
+                            params[key] = int(val) # Speed is min/km, will be converted to seconds later
+                        else:
+                            params[key] = val # Keep as string if not numeric
+                    except ValueError:
+                        params[key] = val # Fallback to string if conversion fails
+            return params
+        return {}
+
+    # --- Process answers from the questionnaire ---
+
+    # g1: Why do you run?
+    g1_answer = data.get('g1')
+    
+    user_type = g1_answer.split()[0].lower()
+        
+
+    # g2: Do you have a long term goal?
+    g2_answer = data.get('g2')
+    if g2_answer and g2_answer.startswith('Yes'):
+        # User has a specific long-term goal
+        g2_additional_input = parse_additional_input(g2_answer)
+        if g1_answer == 'Faster speed':
+            if 'distance' in g2_additional_input:
+                long_goal['dist'] = g2_additional_input['distance']
+            if 'speed' in g2_additional_input:
+                # Convert min/km to seconds/km (e.g., 5 min/km -> 300 sec/km)
+                long_goal['pace'] = int(g2_additional_input['speed'] * 60)
+            long_goal['weight'] = curr_goal['weight'] # Keep current weight for speed goal unless specified
+        elif g1_answer == 'Longer distance':
+            if 'goal' in g2_additional_input:
+                long_goal['dist'] = g2_additional_input['goal']
+            # Set a reasonable default pace for longer distance goals if not explicitly given
+            long_goal['pace'] = 360 # 6 min/km pace
+            long_goal['weight'] = curr_goal['weight'] # Keep current weight for distance goal unless specified
+        elif g1_answer == 'Healthier shape':
+            if 'weight' in g2_additional_input:
+                long_goal['weight'] = g2_additional_input['weight']
+            # Set generic distance/pace goals for healthier shape if not specified
+            long_goal['dist'] = 10.0 # A common distance for general health
+            long_goal['pace'] = 420 # 7 min/km pace
+
+    elif g2_answer == 'No':
+        # User does not have a specific long-term goal, infer from g1
+        if g1_answer == 'Faster speed':
+            long_goal['pace'] = min(270, long_goal['pace']) # Aim for slightly faster than default (4.5 min/km)
+            long_goal['dist'] = 10.0 # A good distance to work on speed
+            long_goal['weight'] = curr_goal['weight'] # Keep current weight for speed goal
+        elif g1_answer == 'Longer distance':
+            long_goal['dist'] = max(10, long_goal['dist']) # Aim for longer than default (25 km)
+            long_goal['pace'] = 390 # A bit slower pace for longer runs (6.5 min/km)
+            long_goal['weight'] = curr_goal['weight'] # Keep current weight for distance goal
+        elif g1_answer == 'Healthier shape':
+            long_goal['dist'] = 10.0 # Keep general 10km goal
+            long_goal['pace'] = 450 # Moderate pace (7.5 min/km)
+            long_goal['weight'] = 65.0 # A general healthy weight goal
+
+    # Determine a base current distance based on last run performance
+    base_curr_dist_from_h2 = curr_goal['dist'] # Default to initialized curr_goal['dist']
+    h2_answer = data.get('h2')
+    if h2_answer == 'Less than 3km':
+        base_curr_dist_from_h2 = 3.0
+    elif h2_answer == '3~10km':
+        base_curr_dist_from_h2 = 5.0
+    elif h2_answer == 'More than 10km':
+        base_curr_dist_from_h2 = 8.0
+
+    # h1: How long has it been since you last ran? (Influences current goal's difficulty)
+    h1_answer = data.get('h1')
+    if h1_answer == 'More than a month':
+        curr_goal['dist'] = 2.0
+        curr_goal['pace'] = 570 
+        curr_goal['freq'] = 1.0 
+    elif h1_answer == 'Within a month':
+        curr_goal['dist'] = max(3.0, base_curr_dist_from_h2 * 0.75) # At least 3km, or 75% of last run if long
+        curr_goal['pace'] = max(480, curr_goal['pace']) # At least 8 min/km, or existing pace
+        curr_goal['freq'] = 2.0
+    else: # Within a week
+        curr_goal['dist'] = base_curr_dist_from_h2 # Use last run's distance as a strong indicator
+        curr_goal['freq'] = 3.0 
+
+    if long_goal['dist'] > 10.0 and curr_goal['dist'] < long_goal['dist'] * 0.2: # If long goal is high and current is too low
+        curr_goal['dist'] = max(curr_goal['dist'], long_goal['dist'] * 0.2) # Ensure at least 20% of long goal
+    if long_goal['dist'] > 5.0 and curr_goal['dist'] < long_goal['dist'] * 0.5 and h1_answer != 'More than a month':
+         curr_goal['dist'] = max(curr_goal['dist'], long_goal['dist'] * 0.3) # If active, aim for at least 30% of long goal
+
+    # h3: how fast
+    h3_answer = data.get('h3')
+    if h3_answer == 'Less than 5':
+        curr_goal['pace'] = min(curr_goal['pace'], 300) 
+    elif h3_answer == '5~7':
+        curr_goal['pace'] = max(curr_goal['pace'], 300) 
+        curr_goal['pace'] = min(curr_goal['pace'], 420) 
+    elif h3_answer == 'More than 7':
+        curr_goal['pace'] = max(curr_goal['pace'], 480) 
+    
+    long_goal['pace'] = min(long_goal['pace'], MAX_PACE_SECONDS_PER_KM)
+    curr_goal['pace'] = min(curr_goal['pace'], MAX_PACE_SECONDS_PER_KM)
+
+
+    # h4: curr weight
+    h4_answer = data.get('h4')
+    if h4_answer and h4_answer.startswith('kg'):
+        h4_additional_input = parse_additional_input(h4_answer)
+        if 'weight' in h4_additional_input:
+            curr_goal['weight'] = h4_additional_input['weight']
+            if curr_goal['weight'] > 90: # adjust for obese users
+                curr_goal['dist'] = min(curr_goal['dist'], 3.0) 
+                curr_goal['pace'] = max(curr_goal['pace'], 540) 
+                curr_goal['pace'] = min(curr_goal['pace'], MAX_PACE_SECONDS_PER_KM) # Ensure within max allowed
+
+    m1_answer = data.get('m1')
+    if m1_answer == 'Yes':
+        usually_quit = True
+    elif m1_answer == 'No':
+        usually_quit = False
+
+    # m2: Do you believe in the idea: "Don't think. Just run as AI tells you"?
+    m2_answer = data.get('m2')
+    if m2_answer == 'Yes':
+        believe_ai = True
+    elif m2_answer == 'No':
+        believe_ai = False
+
+    # Final consistency checks to ensure curr_goal is not harder than long_goal
+    # Current distance should be less than or equal to long-term distance
+    curr_goal['dist'] = min(curr_goal['dist'], long_goal['dist'])
+    # Current pace should be slower than or equal to long-term pace (higher seconds/km means slower)
+    curr_goal['pace'] = max(curr_goal['pace'], long_goal['pace'])
+    # Current weight should be higher than or equal to long-term target weight
+    curr_goal['weight'] = max(curr_goal['weight'], long_goal['weight'])
+    
+    # Ensure current pace does not exceed the overall MAX_PACE_SECONDS_PER_KM
+    curr_goal['pace'] = min(curr_goal['pace'], MAX_PACE_SECONDS_PER_KM)
+
+    return {
+        'user_type': user_type,
+        'long_goal': long_goal,
+        'curr_goal': curr_goal,
+        'usually_quit': usually_quit,
+        'now_quit': now_quit,
+        'believe_ai': believe_ai,
+    }
+
+
+# Answer options of physicalapp/lib/instruction.dart, plus missing (None), unknown and
+# malformed answers. Typed values follow the app's '<option> (Additional: k=v, ...)'.
+TYPED_GOALS = [
+    'distance=10, speed=5', 'distance=42.195, speed=4', 'distance=3, speed=9', 'distance=-5, speed=0',
+    'distance=8', 'speed=4', 'speed=5.5', 'distance=abc, speed=5', 'distance=10,speed=5',
+    'goal=50', 'goal=8', 'goal=4', 'goal=1e3', 'goal=nan', 'goal=abc',
+    'weight=55', 'weight=80', 'weight=abc', 'height=180',
+]
+TYPED_WEIGHTS = ['weight=75', 'weight=90', 'weight=90.5', 'weight=130', 'weight=50', 'weight=abc', 'height=180']
+ANSWERS = {
+    'g1': ['Faster speed', 'Longer distance', 'Healthier shape', 'Just for fun', None],
+    'g2': ['Yes', 'No', 'Maybe', '', None] + [f'Yes (Additional: {typed})' for typed in TYPED_GOALS],
+    'h1': ['Within a week', 'Within a month', 'More than a month', 'Yesterday', None],
+    'h2': ['Less than 3km', '3~10km', 'More than 10km', None],
+    'h3': ['Less than 5', '5~7', 'More than 7', 'No idea', None],
+    'h4': ['kg', None] + [f'kg (Additional: {typed})' for typed in TYPED_WEIGHTS],
+    'm1': ['Yes', 'No', None],
+    'm2': ['Yes', 'No', None],
+}
+
+
+def outcome(function, answers):
+    """(repr of the result, or the exception type name, seconds taken)."""
+    started = time.perf_counter()
+    try:
+        result = function(answers)
+    except Exception as error:
+        return type(error).__name__, time.perf_counter() - started
+    seconds = time.perf_counter() - started
+    return repr(result), seconds
+
+
+def main():
+    rules = QuestionnaireRules(MAX_PACE_SECONDS_PER_KM)
+    keys = list(ANSWERS)
+    combinations = mismatches = errors = 0
+    legacy_seconds = compiled_seconds = 0.0
+    for values in itertools.product(*ANSWERS.values()):
+        answers = {key: value for key, value in zip(keys, values) if value is not None}
+        expected, seconds = outcome(legacy_traits, answers)
+        legacy_seconds += seconds
+        actual, seconds = outcome(rules.traits, answers)
+        compiled_seconds += seconds
+        combinations += 1
+        errors += not expected.startswith('{')
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print(f'MISMATCH {answers}\n  legacy:   {expected}\n  compiled: {actual}')
+
+    print(f'{combinations} answer combinations ({errors} raise an error in the legacy version), {mismatches} mismatches')
+    print(f'legacy   {legacy_seconds / combinations * 1e6:6.2f} us per submission')
+    print(f'compiled {compiled_seconds / combinations * 1e6:6.2f} us per submission')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# datagen.py
+# Synthetic users, questionnaire-derived traits and activity histories for benchmarks.
+#
+# Usage (from physicalbackend/), writes a new SQLite file:
+#   python benchmarks/datagen.py bench.db --users 500 --activities-per-user 200
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+from database import db, User, Activity, split_paces_columns  # noqa: E402
+
+BENCH_PASSWORD = 'bench-password'
+
+QUESTIONNAIRE_OPTIONS = {
+    'g1': ['Faster speed', 'Longer distance', 'Healthier shape'],
+    'h1': ['More than a month', 'Within a month', 'Within a week'],
+    'h2': ['Less than 3km', '3~10km', 'More than 10km'],
+    'h3': ['Less than 5', '5~7', 'More than 7'],
+    'm1': ['Yes', 'No'],
+    'm2': ['Yes', 'No'],
+}
+
+# Runs end around Taipei
+HOME_LATITUDE = 25.03
+HOME_LONGITUDE = 121.56
+
+
+def questionnaire_answers(rng, user_id):
+    answers = {key: rng.choice(options) for key, options in QUESTIONNAIRE_OPTIONS.items()}
+    answers['user_id'] = user_id
+    if rng.random() < 0.5:
+        answers['g2'] = f'Yes (Additional: distance={rng.choice([5, 10, 21])}, speed={rng.randint(4, 7)}, ' \
+                        f'goal={rng.choice([10, 21, 42])}, weight={rng.randint(50, 80)})'
+    else:
+        answers['g2'] = 'No'
+    answers['h4'] = f'kg (Additional: weight={rng.randint(45, 110)})'
+    return answers
+
+
+def activity_history(rng, user_id, count, now):
+    """count activities for one runner, oldest first, with per-km splits and end coordinates."""
+    base_pace = rng.randint(280, 540)
+    usual_distance = rng.uniform(2.0, 15.0)
+    runs_per_week = rng.uniform(1.0, 5.0)
+    home = (HOME_LATITUDE + rng.uniform(-0.2, 0.2), HOME_LONGITUDE + rng.uniform(-0.2, 0.2))
+    goal_dist, goal_pace = round(usual_distance, 1), base_pace
+
+    start = now - timedelta(days=count * 7 / runs_per_week)
+    rows = []
+    for change_seq in range(1, count + 1):
+        start += timedelta(days=rng.expovariate(runs_per_week / 7))
+        start = start.replace(hour=rng.choice([6, 7, 12, 18, 19, 20]), minute=rng.randint(0, 59), second=rng.randint(0, 59))
+        distance = round(max(0.5, rng.gauss(usual_distance, usual_distance * 0.2)), 2)
+        pace = max(200, int(rng.gauss(base_pace, base_pace * 0.05)))
+        # Slightly positive splits: the last kilometres are a bit slower
+        splits = [max(150, int(pace * (0.97 + 0.06 * km / max(1, distance)) + rng.gauss(0, 8)))
+                  for km in range(int(distance))]
+        completed = distance >= goal_dist and pace <= goal_pace
+        rows.append({
+            'user_id': user_id,
+            'start_time': start,
+            'duration_seconds': int(distance * pace),
+            'distance_km': distance,
+            'end_latitude': home[0] + rng.uniform(-0.03, 0.03),
+            'end_longitude': home[1] + rng.uniform(-0.03, 0.03),
+            'average_pace_seconds_per_km': pace,
+            **split_paces_columns(splits),
+            'goal_state': 'completed' if completed else 'missed',
+            'goal_dist': goal_dist,
+            'goal_pace': goal_pace,
+            'change_seq': change_seq,
+        })
+        # Goals drift the way the adaptation would move them
+        if completed:
+            goal_dist, goal_pace = round(goal_dist + 0.5, 1), max(240, goal_pace - 5)
+    return rows
+
+
+def generate(app, users, activities_per_user, seed=42, now=None):
+    """Fill app's (empty) database. Traits go through the real /finish_questionare logic."""
+    from server import rebuild_daily_summaries, backfill_recent_runs
+
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    client = app.test_client()
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [
+            {'id': user_id, 'username': f'runner{user_id}', 'password_hash': password_hash,
+             'change_seq': activities_per_user}
+            for user_id in range(1, users + 1)
+        ])
+        db.session.commit()
+
+    for user_id in range(1, users + 1):
+        response = client.post('/finish_questionare', json=questionnaire_answers(rng, user_id))
+        assert response.status_code == 201, response.get_data(as_text=True)
+
+    with app.app_context():
+        batch = []
+        for user_id in range(1, users + 1):
+            batch += activity_history(rng, user_id, activities_per_user, now)
+            if len(batch) >= 20_000:
+                db.session.execute(Activity.__table__.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(Activity.__table__.insert(), batch)
+        rebuild_daily_summaries()
+        backfill_recent_runs()
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic benchmark database.')
+    parser.add_argument('path', help='SQLite file to create')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--activities-per-user', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        sys.exit(f'{args.path} already exists')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.path)}'
+    from server import create_app
+    app = create_app()
+    generate(app, args.users, args.activities_per_user, args.seed)
+    print(f'Wrote {args.users} users x {args.activities_per_user} activities to {args.path}')
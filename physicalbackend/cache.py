@@ -0,0 +1,191 @@
+# cache.py
+# Per-user versioned response cache with ETag / If-None-Match support.
+#
+# Each user has a version counter that write paths bump after committing. Cached
+# responses are keyed by (endpoint, user, version, args), so a bump makes every
+# cached response of that user unreachable and nothing has to be deleted. A client
+# that sends the ETag of the current version gets a 304 without touching the database.
+#
+# A user's version starts at a random number rather than 0, so a restarted process (or
+# a Redis that lost the key) doesn't hand out the versions, and ETags, of an earlier one.
+import functools
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, make_response
+
+from compression import encoded_etags
+
+
+class CacheBackend:
+    """Storage used by ResponseCache. Share one backend between workers to share the cache."""
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """Store value (a (body, status, mimetype) tuple) under key."""
+        raise NotImplementedError
+
+    def get_version(self, user_id):
+        """Current version of user_id's data; a random starting value if never seen."""
+        raise NotImplementedError
+
+    def bump_version(self, user_id):
+        """Invalidate every cached response of user_id."""
+        raise NotImplementedError
+
+
+class InProcessCacheBackend(CacheBackend):
+    """LRU cache in this process, bounded by the total size of the cached bodies."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(value[0])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = value
+            self.size += size
+            # Evict least recently used until under the cap
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[0])
+
+    def get_version(self, user_id):
+        version = self.versions.get(user_id)
+        if version is None:
+            with self.lock:
+                version = self.versions.setdefault(user_id, secrets.randbits(48))
+        return version
+
+    def bump_version(self, user_id):
+        with self.lock:
+            self.versions[user_id] = self.versions.get(user_id, secrets.randbits(48)) + 1
+
+
+class RedisCacheBackend(CacheBackend):
+    """Cache shared by all workers through Redis. Eviction is left to Redis (maxmemory-policy allkeys-lru)."""
+
+    def __init__(self, url, ttl_seconds=24 * 3600):
+        import redis  # optional dependency, only needed for this backend
+        self.client = redis.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key):
+        fields = self.client.hmget(f'resp:{key}', 'body', 'status', 'mimetype')
+        if fields[0] is None:
+            return None
+        return fields[0], int(fields[1]), fields[2].decode()
+
+    def set(self, key, value):
+        body, status, mimetype = value
+        with self.client.pipeline() as pipe:
+            pipe.hset(f'resp:{key}', mapping={'body': body, 'status': status, 'mimetype': mimetype})
+            pipe.expire(f'resp:{key}', self.ttl_seconds)
+            pipe.execute()
+
+    def get_version(self, user_id):
+        version = self.client.get(f'ver:{user_id}')
+        if version is None:
+            # Never bumped, or evicted: start somewhere no earlier version was
+            self.client.set(f'ver:{user_id}', secrets.randbits(48), nx=True)
+            version = self.client.get(f'ver:{user_id}')
+        return int(version)
+
+    def bump_version(self, user_id):
+        self.client.set(f'ver:{user_id}', secrets.randbits(48), nx=True)
+        self.client.incr(f'ver:{user_id}')
+
+
+class ResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend or InProcessCacheBackend()
+
+    def init_app(self, app):
+        """Use Redis at RESPONSE_CACHE_URL when set, else an in-process cache of
+        RESPONSE_CACHE_MAX_BYTES."""
+        if app.config.get('RESPONSE_CACHE_URL'):
+            self.backend = RedisCacheBackend(app.config['RESPONSE_CACHE_URL'])
+        else:
+            self.backend = InProcessCacheBackend(app.config['RESPONSE_CACHE_MAX_BYTES'])
+
+    def get_version(self, user_id):
+        return self.backend.get_version(user_id)
+
+    def bump(self, user_id):
+        """Call after committing a write that changes any of user_id's cached responses."""
+        self.backend.bump_version(user_id)
+
+    def key(self, endpoint, user_id, query_string, bucket_seconds=None):
+        """(cache key, ETag) of a request for user_id's current version."""
+        key_parts = [endpoint, str(user_id), str(self.backend.get_version(user_id)), query_string]
+        if bucket_seconds:
+            key_parts.append(str(int(time.time() // bucket_seconds)))
+        key = '|'.join(key_parts)
+        return key, hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+
+    @staticmethod
+    def matching_etag(if_none_match, etag):
+        """The ETag of if_none_match (parsed) naming a representation of etag, or None."""
+        for candidate in encoded_etags(etag):
+            if if_none_match.contains_weak(candidate):
+                return candidate
+        return None
+
+    def cached(self, endpoint, bucket_seconds=None):
+        """Cache a GET view that takes user_id.
+
+        bucket_seconds is for views whose output also depends on the clock (e.g. a
+        trailing time window): the cache key then changes every bucket_seconds.
+        Only 200 responses are cached.
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(user_id, **kwargs):
+                key, etag = self.key(endpoint, user_id, request.query_string.decode(), bucket_seconds)
+
+                # Strong, per encoding: compression.py appends the encoding to the ETag
+                matched = self.matching_etag(request.if_none_match, etag)
+                if matched is not None:
+                    response = make_response('', 304)
+                    response.set_etag(matched)
+                    return response
+
+                cached_value = self.backend.get(key)
+                if cached_value is None:
+                    response = make_response(view(user_id, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    cached_value = (response.get_data(), response.status_code, response.mimetype)
+                    self.backend.set(key, cached_value)
+
+                body, status, mimetype = cached_value
+                response = make_response(body, status)
+                response.mimetype = mimetype
+                response.set_etag(etag)
+                return response
+            # For serving the same endpoint elsewhere (asgi.py); kept by functools.wraps of outer decorators
+            wrapper.cache_settings = (endpoint, bucket_seconds)
+            return wrapper
+        return decorator
@@ -0,0 +1,91 @@
+# compression.py
+# Negotiated gzip / brotli compression of response bodies.
+#
+# JSON, NDJSON and CSV bodies of at least COMPRESS_MIN_BYTES are compressed with the
+# best encoding the client accepts (Accept-Encoding, q-values respected): brotli when
+# the brotli module is installed and the client takes it, else gzip. Smaller bodies go
+# out as they are, since the encoding overhead outweighs the few bytes saved. Streamed
+# responses (the exports) are left alone.
+import gzip
+
+from flask import request
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli  # optional dependency; without it only gzip is offered
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html'}
+ENCODINGS = ('br', 'gzip')
+
+
+def encoded_etag(etag, encoding):
+    """Strong ETag of the body with ETag etag sent in encoding (None for the identity)."""
+    return f'{etag}-{encoding}' if encoding else etag
+
+
+def encoded_etags(etag):
+    """The ETags of every representation of the body with ETag etag."""
+    return [etag] + [encoded_etag(etag, encoding) for encoding in ENCODINGS]
+
+
+class Compressor:
+    def __init__(self, min_bytes=1024, gzip_level=6, brotli_quality=4, encodings=ENCODINGS):
+        self.configure(min_bytes, gzip_level, brotli_quality, encodings)
+
+    def configure(self, min_bytes, gzip_level, brotli_quality, encodings):
+        self.min_bytes = min_bytes
+        # Encoding -> compress function, in order of preference
+        encoders = {
+            'br': (lambda body: brotli.compress(body, quality=brotli_quality)) if brotli is not None else None,
+            # mtime=0: the same body always compresses to the same bytes
+            'gzip': lambda body: gzip.compress(body, compresslevel=gzip_level, mtime=0),
+        }
+        self.encoders = {encoding: encoders[encoding] for encoding in encodings if encoders.get(encoding)}
+
+    def init_app(self, app):
+        self.configure(app.config['COMPRESS_MIN_BYTES'], app.config['COMPRESS_GZIP_LEVEL'],
+                       app.config['COMPRESS_BROTLI_QUALITY'], app.config['COMPRESS_ENCODINGS'])
+        # Register after init_metrics(): after_request hooks run in reverse order, so
+        # the size metric then sees the compressed bodies
+        app.after_request(self.compress_response)
+
+    def varies(self, mimetype, status):
+        """Whether a response of mimetype and status may be compressed, i.e. depends on
+        Accept-Encoding."""
+        return bool(self.encoders) and mimetype in COMPRESSIBLE_MIMETYPES and status not in (204, 304)
+
+    def negotiate(self, accept_encoding):
+        """Best encoding for an Accept-Encoding header, None for the identity."""
+        accept = parse_accept_header(accept_encoding)
+        best, best_quality = None, 0
+        for encoding in self.encoders:
+            quality = accept.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def encode(self, body, accept_encoding):
+        """(body, encoding): body compressed for the client, or as it is with None."""
+        if len(body) < self.min_bytes:
+            return body, None
+        encoding = self.negotiate(accept_encoding)
+        if encoding is None:
+            return body, None
+        return self.encoders[encoding](body), encoding
+
+    def compress_response(self, response):
+        if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+                or not self.varies(response.mimetype, response.status_code)):
+            return response
+        response.vary.add('Accept-Encoding')
+        body, encoding = self.encode(response.get_data(), request.headers.get('Accept-Encoding', ''))
+        if encoding is not None:
+            response.set_data(body)
+            response.headers['Content-Encoding'] = encoding
+            # A strong ETag names exact bytes, which the encodings don't share
+            etag, weak = response.get_etag()
+            if etag and not weak:
+                response.set_etag(encoded_etag(etag, encoding))
+        return response
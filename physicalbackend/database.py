@@ -1,13 +1,79 @@
 # database.py
+from contextvars import ContextVar
+import importlib
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy import JSON
 from sqlalchemy.ext.mutable import MutableDict
+from array import array
 import json
+import sys
+
+# Bind key of the shard statements go to, None for the default database (see sharding.py)
+current_shard = ContextVar('current_shard', default=None)
+
+class RoutingSession(Session):
+    """Session that sends every statement to the shard selected in current_shard."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        shard = current_shard.get()
+        if bind is None and shard is not None:
+            return self._db.engines[shard]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
 # Initialize SQLAlchemy outside of app context for flexibility
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+def dialect_insert(dialect_name):
+    """insert() construct of dialect 'sqlite' or 'postgresql', for upserts (ON CONFLICT DO
+    UPDATE). Imported on first use: processes on SQLite never load the PostgreSQL dialect."""
+    return importlib.import_module(f'sqlalchemy.dialects.{dialect_name}').insert
+
+def current_engine():
+    """Engine of the selected shard, or the default engine."""
+    shard = current_shard.get()
+    return db.engines[shard] if shard is not None else db.engine
+
+# --- Split pace encoding ---
+# Splits are whole seconds per km, stored as packed little-endian uint16 (2 bytes per km).
+# Payloads that don't fit (non-integers, out of range, other shapes) stay in split_paces_json.
+MAX_SPLIT_SECONDS = 65535
+
+def encode_split_paces(split_paces):
+    """Pack a list of split seconds into bytes, or return None if it can't be packed losslessly."""
+    if not isinstance(split_paces, list):
+        return None
+    values = array('H')
+    for value in split_paces:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        if value != int(value) or not 0 <= value <= MAX_SPLIT_SECONDS:
+            return None
+        values.append(int(value))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+def decode_split_paces(split_paces_blob, split_paces_json):
+    """Inverse of encode_split_paces, falling back to the JSON column. None if neither is set."""
+    if split_paces_blob is not None:
+        values = array('H')
+        values.frombytes(split_paces_blob)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values.tolist()
+    if split_paces_json:
+        return json.loads(split_paces_json)
+    return None
+
+def split_paces_columns(split_paces):
+    """Column values for storing split paces on an Activity."""
+    split_paces_blob = encode_split_paces(split_paces)
+    if split_paces_blob is not None:
+        return {'split_paces_blob': split_paces_blob, 'split_paces_json': None}
+    return {'split_paces_blob': None, 'split_paces_json': json.dumps(split_paces)}
 
 # --- Database Models ---
 class User(db.Model):
@@ -16,6 +82,8 @@ class User(db.Model):
     password_hash = db.Column(db.String(128), nullable=False)
     third_party_id = db.Column(db.String(128), unique=True, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Last change sequence number handed out to this user's activities (see reserve_change_seqs)
+    change_seq = db.Column(db.Integer, nullable=True, default=0)
 
     # Establish a relationship with Activity.
     # 'backref' adds a .user property to Activity objects
@@ -41,10 +109,24 @@ class Activity(db.Model):
     end_longitude = db.Column(db.Float, nullable=True)
     average_pace_seconds_per_km = db.Column(db.Integer, nullable=False)
     # Using db.Text to store JSON string. For PostgreSQL, consider JSONB.
+    # Only used for rows not yet migrated and splits that can't be packed into split_paces_blob.
     split_paces_json = db.Column(db.Text, nullable=True)
+    split_paces_blob = db.Column(db.LargeBinary, nullable=True)
     goal_state = db.Column(db.String, nullable=True)
     goal_dist = db.Column(db.Float, nullable=True)
     goal_pace = db.Column(db.Integer, nullable=True)
+    # Per-user sequence number of the last insert/modification, for delta sync
+    change_seq = db.Column(db.Integer, nullable=True)
+    # Map grid cell of the end point, None without coordinates (see geo.py)
+    end_cell = db.Column(db.BigInteger, nullable=True)
+
+    # Every per-user read filters on user_id and orders/ranges on start_time
+    __table_args__ = (
+        db.Index('ix_activity_user_id_start_time', 'user_id', db.desc('start_time')),
+        db.Index('ix_activity_user_id_change_seq', 'user_id', 'change_seq'),
+        # Nearby lookups scan ranges of cells
+        db.Index('ix_activity_end_cell', 'end_cell'),
+    )
     
     def to_dict(self):
         return {
@@ -56,20 +138,215 @@ class Activity(db.Model):
             'end_latitude': self.end_latitude,
             'end_longitude': self.end_longitude,
             'average_pace_seconds_per_km': self.average_pace_seconds_per_km,
-            'split_paces_json': json.loads(self.split_paces_json) if self.split_paces_json else None,
+            'split_paces_json': self.split_paces,
             'goal_state': self.goal_state,
             'goal_dist': self.goal_dist,
             'goal_pace': self.goal_pace,
         }
 
+    @property
+    def split_paces(self):
+        # Decoded on access only
+        return decode_split_paces(self.split_paces_blob, self.split_paces_json)
+
     def __repr__(self):
         return f'<Activity {self.id} for User {self.user_id}>'
 
+class ArchivedActivity(db.Model):
+    # Activities moved out of Activity by `flask archive-activities` (see archive.py).
+    # Same columns and ids as Activity, so reads can merge both tables.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    duration_seconds = db.Column(db.Integer, nullable=False)
+    distance_km = db.Column(db.Float, nullable=False)
+    end_latitude = db.Column(db.Float, nullable=True)
+    end_longitude = db.Column(db.Float, nullable=True)
+    average_pace_seconds_per_km = db.Column(db.Integer, nullable=False)
+    split_paces_json = db.Column(db.Text, nullable=True)
+    split_paces_blob = db.Column(db.LargeBinary, nullable=True)
+    goal_state = db.Column(db.String, nullable=True)
+    goal_dist = db.Column(db.Float, nullable=True)
+    goal_pace = db.Column(db.Integer, nullable=True)
+    change_seq = db.Column(db.Integer, nullable=True)
+    end_cell = db.Column(db.BigInteger, nullable=True)
+
+    # The lookups of Activity's indexes also run here when a read reaches back this far
+    __table_args__ = (
+        db.Index('ix_archived_activity_user_id_start_time', 'user_id', db.desc('start_time')),
+        db.Index('ix_archived_activity_user_id_change_seq', 'user_id', 'change_seq'),
+        db.Index('ix_archived_activity_end_cell', 'end_cell'),
+    )
+
+    def __repr__(self):
+        return f'<ArchivedActivity {self.id} for User {self.user_id}>'
+
+class DailyActivitySummary(db.Model):
+    # Per-user, per-day rollup of activity goal states, kept up to date by add_activity.
+    # The history calendar reads one row per day instead of the whole Activity history.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    completed_count = db.Column(db.Integer, nullable=False, default=0)
+    missed_count = db.Column(db.Integer, nullable=False, default=0)
+    other_count = db.Column(db.Integer, nullable=False, default=0) # any other goal_state, including None
+    # Totals for the analytics windows; NULL on rows from before they existed (rebuild-calendar fills them)
+    distance_km = db.Column(db.Float, nullable=True, default=0.0)
+    duration_seconds = db.Column(db.Integer, nullable=True, default=0)
+    last_start_time = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.UniqueConstraint('user_id', 'day', name='uq_daily_summary_user_day'),)
+
+    def to_dict(self):
+        return {
+            'date': self.day.isoformat(),
+            'completed': self.completed_count,
+            'missed': self.missed_count,
+            'other': self.other_count,
+        }
+
+    def __repr__(self):
+        return f'<DailyActivitySummary {self.day} for User {self.user_id}>'
+
+class MonthlyActivitySummary(db.Model):
+    # Per-user, per-month totals, kept up to date along with DailyActivitySummary.
+    # Analytics windows read one row per whole month instead of one per day.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    month = db.Column(db.Date, nullable=False) # first day of the month
+    completed_count = db.Column(db.Integer, nullable=False, default=0)
+    missed_count = db.Column(db.Integer, nullable=False, default=0)
+    other_count = db.Column(db.Integer, nullable=False, default=0)
+    distance_km = db.Column(db.Float, nullable=True, default=0.0)
+    duration_seconds = db.Column(db.Integer, nullable=True, default=0)
+    last_start_time = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.UniqueConstraint('user_id', 'month', name='uq_monthly_summary_user_month'),)
+
+    def __repr__(self):
+        return f'<MonthlyActivitySummary {self.month:%Y-%m} for User {self.user_id}>'
+
+class GeoCellCount(db.Model):
+    # Number of activities ending in each map grid cell, per zoom level, for the
+    # heatmap tiles (see geo.py). Incremented on insert, never decremented.
+    zoom = db.Column(db.Integer, primary_key=True)
+    cell = db.Column(db.BigInteger, primary_key=True)
+    activity_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<GeoCellCount {self.zoom}/{self.cell}: {self.activity_count}>'
+
+class RankingSnapshot(db.Model):
+    # Saved state of the in-memory cohort rankings (see rankings.py), one row per
+    # database: the weekly totals of this database's users as packed little-endian
+    # int64 (user_id, week, meters, best pace or -1) and the last activity they include.
+    id = db.Column(db.Integer, primary_key=True)
+    last_activity_id = db.Column(db.Integer, nullable=False)
+    # Ids up to last_activity_id that were not committed yet and are still awaited
+    pending_activity_ids = db.Column(JSON, nullable=True)
+    saved_at = db.Column(db.DateTime, nullable=False)
+    totals = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f'<RankingSnapshot up to Activity {self.last_activity_id} at {self.saved_at}>'
+
+def reserve_change_seqs(user_id, count=1):
+    """Reserve count change sequence numbers for user_id; returns the last one.
+
+    The UPDATE locks the user's row until the transaction ends, so a user's sequence
+    numbers become visible in order: a reader that sees N also sees everything below N.
+    """
+    return db.session.execute(
+        db.update(User).where(User.id == user_id)
+        .values(change_seq=db.func.coalesce(User.change_seq, 0) + count)
+        .returning(User.change_seq)
+    ).scalar_one()
+
 def init_db_command():
     """Clear existing data and create new tables."""
     # db.drop_all() # Optional: Use with caution, it deletes all data!
-    db.create_all()
+    db.metadata.create_all(current_engine())
     print("Initialized the database.")
+
+def add_column_sql(table, column, dialect):
+    """ALTER TABLE adding column to table, names quoted as dialect needs ("user" is
+    reserved on PostgreSQL)."""
+    preparer = dialect.identifier_preparer
+    return (f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN '
+            f'{preparer.format_column(column)} {column.type.compile(dialect)}')
+
+def migrate_db_command():
+    """Bring an existing database up to date with the models without touching data."""
+    # create_all only creates missing tables; indexes on tables that already exist are added below.
+    engine = current_engine()
+    db.metadata.create_all(engine)
+
+    inspector = db.inspect(engine)
+    for table in db.metadata.sorted_tables:
+        # New columns are nullable, so they can be added in place
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                with engine.begin() as conn:
+                    conn.execute(db.text(add_column_sql(table, column, engine.dialect)))
+                print(f"Added column {column.name} to {table.name}.")
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                print(f"Created index {index.name} on {table.name}.")
+    print("Migrated the database.")
+
+def backfill_change_seq_command():
+    """Give activities created before delta sync a change sequence number."""
+    backfilled = 0
+    user_ids = db.session.scalars(
+        db.select(Activity.user_id).where(Activity.change_seq.is_(None)).distinct()
+    ).all()
+    # One transaction per user, numbering their activities in id order
+    for user_id in user_ids:
+        activity_ids = db.session.scalars(
+            db.select(Activity.id).where(Activity.user_id == user_id, Activity.change_seq.is_(None)).order_by(Activity.id)
+        ).all()
+        last_seq = reserve_change_seqs(user_id, len(activity_ids))
+        first_seq = last_seq - len(activity_ids) + 1
+        db.session.execute(db.update(Activity), [
+            {'id': activity_id, 'change_seq': first_seq + offset} for offset, activity_id in enumerate(activity_ids)
+        ])
+        db.session.commit()
+        backfilled += len(activity_ids)
+    print(f"Backfilled change sequence numbers for {backfilled} activities.")
+
+def migrate_split_paces_command():
+    """Pack split_paces_json into split_paces_blob for existing activities."""
+    converted = 0
+    last_id = 0
+    # Walk the table in id order, one chunk per transaction, so memory stays flat
+    while True:
+        rows = db.session.query(Activity.id, Activity.split_paces_json).filter(
+            Activity.id > last_id,
+            Activity.split_paces_json.isnot(None),
+            Activity.split_paces_blob.is_(None)
+        ).order_by(Activity.id).limit(1000).all()
+        if not rows:
+            break
+
+        updates = []
+        for activity_id, split_paces_json in rows:
+            try:
+                split_paces_blob = encode_split_paces(json.loads(split_paces_json))
+            except ValueError:
+                split_paces_blob = None
+            if split_paces_blob is not None:
+                updates.append({'id': activity_id, 'split_paces_blob': split_paces_blob, 'split_paces_json': None})
+        if updates:
+            db.session.execute(db.update(Activity), updates)
+        db.session.commit()
+
+        converted += len(updates)
+        last_id = rows[-1].id
+    print(f"Converted split paces for {converted} activities.")
         
 class Trait(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -93,4 +370,15 @@ class Trait(db.Model):
     usually_quit = db.Column(db.Boolean, default=False)
     now_quit = db.Column(db.Boolean, default=False)
     believe_ai = db.Column(db.Boolean, default=True)
+    # Rolling window of the user's latest runs used by goal adaptation, newest first
+    # ex [["2025-06-27T10:00:00", 360, 5.0], ...]  (start_time, pace s/km, dist km)
+    recent_runs = db.Column(JSON, nullable=True)
+    # Highest Activity.change_seq of the user folded into recent_runs and curr_goal by
+    # the post-write job; the activities above it are still to be (see update_trait_after_run)
+    adapted_change_seq = db.Column(db.Integer, nullable=True)
+    # When user_type was last written (see upsert_traits), so that other processes'
+    # rankings re-read only the cohorts that changed
+    cohort_changed_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index('ix_trait_cohort_changed_at', 'cohort_changed_at'),)
   
@@ -0,0 +1,158 @@
+# dbprofile.py
+# Database performance profiles, selected with DATABASE_PROFILE.
+#
+# 'default' leaves the driver defaults alone. 'production' tunes each engine:
+# - SQLite: WAL journal, so readers and the writer don't block each other;
+#   synchronous=NORMAL, which syncs at checkpoints instead of on every commit (a power
+#   loss can lose the latest commits, but doesn't corrupt the database); memory-mapped
+#   reads, a larger page cache, and a busy timeout, so writers wait for the lock
+#   instead of failing with "database is locked".
+# - PostgreSQL: a sized connection pool with pre-ping and recycling, and a statement
+#   timeout so a runaway query doesn't hold a connection forever.
+import os
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.pool import QueuePool
+
+from metrics import logger
+
+PROFILES = ('default', 'production')
+
+SYNCHRONOUS_NAMES = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+
+
+def load_config(app):
+    """Read the profile and its tunables from the environment into app.config."""
+    app.config['DATABASE_PROFILE'] = os.environ.get('DATABASE_PROFILE', 'default')
+    if app.config['DATABASE_PROFILE'] not in PROFILES:
+        raise ValueError(f"DATABASE_PROFILE must be one of {', '.join(PROFILES)}")
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    app.config['SQLITE_CACHE_SIZE_KB'] = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64 * 1024))
+    app.config['SQLITE_MMAP_SIZE_MB'] = int(os.environ.get('SQLITE_MMAP_SIZE_MB', 256))
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+    app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    app.config['DB_POOL_RECYCLE_SECONDS'] = int(os.environ.get('DB_POOL_RECYCLE_SECONDS', 1800))
+    app.config['DB_STATEMENT_TIMEOUT_MS'] = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+
+
+def sqlite_pragmas(config):
+    if config['DATABASE_PROFILE'] != 'production':
+        return {}
+    return {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': config['SQLITE_BUSY_TIMEOUT_MS'],
+        # Negative cache_size is in KiB rather than pages
+        'cache_size': -config['SQLITE_CACHE_SIZE_KB'],
+        'mmap_size': config['SQLITE_MMAP_SIZE_MB'] * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    }
+
+
+def engine_options(url, config):
+    """create_engine() options of the profile for url. SQLite is tuned with pragmas instead."""
+    if config['DATABASE_PROFILE'] != 'production' or not make_url(url).get_backend_name().startswith('postgresql'):
+        return {}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_pre_ping': True,
+        'pool_recycle': config['DB_POOL_RECYCLE_SECONDS'],
+        'connect_args': {'options': f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"},
+    }
+
+
+def async_engine_options(url, config):
+    """engine_options() for the async driver of url (asyncpg takes server settings instead of options)."""
+    options = engine_options(url, config)
+    if 'connect_args' in options:
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(config['DB_STATEMENT_TIMEOUT_MS'])}}
+    return options
+
+
+def configure(app):
+    """Set engine options for the default database and every bind. Call before db.init_app()."""
+    config = app.config
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}, **engine_options(config['SQLALCHEMY_DATABASE_URI'], config))
+    binds = {}
+    for key, value in (config.get('SQLALCHEMY_BINDS') or {}).items():
+        # Binds don't get SQLALCHEMY_ENGINE_OPTIONS; a dict value carries its own options
+        options = dict(value) if isinstance(value, dict) else {'url': value}
+        binds[key] = dict(engine_options(options['url'], config), **options)
+    config['SQLALCHEMY_BINDS'] = binds
+
+
+def listen_pragmas(engine, config):
+    """Apply the SQLite pragmas on every new connection of engine (for an async engine, pass its sync_engine)."""
+    pragmas = sqlite_pragmas(config)
+    if not pragmas or engine.dialect.name != 'sqlite':
+        return
+
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    event.listen(engine, 'connect', apply_pragmas)
+
+
+def init_app(app, db):
+    """Apply the SQLite pragmas on every new connection. Call after db.init_app()."""
+    with app.app_context():
+        for engine in db.engines.values():
+            listen_pragmas(engine, app.config)
+
+
+def warm_pools(db, connections):
+    """Configure the ORM mappers and open up to `connections` connections per engine (at
+    most its pool size), left in the pools for the first requests. Call inside an app context."""
+    configure_mappers()
+    for engine in db.engines.values():
+        size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+        opened = [engine.connect() for _ in range(min(connections, size))]
+        for conn in opened:
+            conn.close()
+
+
+def effective_settings(engine):
+    """Settings a new connection of engine actually runs with."""
+    settings = {'url': engine.url.render_as_string(hide_password=True), 'pool': type(engine.pool).__name__}
+    with engine.connect() as conn:
+        if engine.dialect.name == 'sqlite':
+            for name in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size', 'temp_store'):
+                settings[name] = conn.execute(text(f'PRAGMA {name}')).scalar()
+            settings['synchronous'] = SYNCHRONOUS_NAMES.get(settings['synchronous'], settings['synchronous'])
+        elif engine.dialect.name == 'postgresql':
+            settings['statement_timeout'] = conn.execute(text('SHOW statement_timeout')).scalar()
+    if hasattr(engine.pool, 'size'):
+        settings['pool_size'] = engine.pool.size()
+    return settings
+
+
+def collect_settings(app, db):
+    """({bind key: effective settings}, [problems]) for every engine."""
+    expected = sqlite_pragmas(app.config)
+    report, problems = {}, []
+    with app.app_context():
+        for key, engine in db.engines.items():
+            name = key or 'default'
+            settings = report[name] = effective_settings(engine)
+            if engine.dialect.name == 'sqlite' and expected and str(settings['journal_mode']).lower() != 'wal':
+                # e.g. in-memory databases, or a filesystem without shared memory
+                problems.append(f"{name} is not in WAL mode (journal_mode={settings['journal_mode']})")
+    return report, problems
+
+
+def check_settings(app, db):
+    """Startup check: log the effective settings and warn where the profile didn't take."""
+    report, problems = collect_settings(app, db)
+    for name, settings in report.items():
+        logger.info('Database %s (profile %s): %s', name, app.config['DATABASE_PROFILE'],
+                    ', '.join(f'{setting}={value}' for setting, value in settings.items()))
+    for problem in problems:
+        logger.warning('Database %s', problem)
+    return report
@@ -0,0 +1,131 @@
+# export.py
+# Streaming export of activity history as NDJSON or CSV.
+#
+# Rows are read as plain column tuples with yield_per (a server-side cursor where the
+# driver supports it), in id order, and formatted one line at a time, so memory does
+# not grow with the size of the table. Every row carries its id: passing the id of the
+# last row received as after_id continues an interrupted export.
+import csv
+import io
+import json
+import os
+
+from sqlalchemy import select, func
+
+from archive import activities_select, all_activities, same_columns
+from database import db, Activity, decode_split_paces
+
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_COLUMNS = [
+    Activity.id,
+    Activity.user_id,
+    Activity.start_time,
+    Activity.duration_seconds,
+    Activity.distance_km,
+    Activity.end_latitude,
+    Activity.end_longitude,
+    Activity.average_pace_seconds_per_km,
+    Activity.goal_state,
+    Activity.goal_dist,
+    Activity.goal_pace,
+]
+EXPORT_FIELDS = [column.key for column in EXPORT_COLUMNS]
+
+
+def _scope(model, columns, user_id, after_id):
+    statement = select(*same_columns(model, columns)).where(model.id > after_id)
+    if user_id is not None:
+        statement = statement.where(model.user_id == user_id)
+    return statement
+
+
+def iter_activity_rows(user_id=None, after_id=0):
+    """Yield activity rows (without ORM objects), archived ones included, in id order, after after_id."""
+    columns = EXPORT_COLUMNS + [Activity.split_paces_blob, Activity.split_paces_json]
+    statement = activities_select(lambda model: _scope(model, columns, user_id, after_id), order_by=('id',))
+    yield from db.session.execute(statement.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+
+
+def max_split_count(user_id=None, after_id=0):
+    """Largest number of packed splits in the export scope, i.e. the split_N columns a CSV needs."""
+    blobs = all_activities(lambda model: _scope(model, [Activity.split_paces_blob], user_id, after_id))
+    max_bytes = db.session.execute(select(func.max(func.length(blobs.c.split_paces_blob)))).scalar()
+    return (max_bytes or 0) // 2
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        item = {field: getattr(row, field) for field in EXPORT_FIELDS}
+        item['start_time'] = row.start_time.isoformat()
+        item['split_paces'] = decode_split_paces(row.split_paces_blob, row.split_paces_json) or []
+        yield json.dumps(item) + '\n'
+
+
+def csv_lines(rows, split_columns, header=True):
+    """One CSV line per activity with split_1..split_<split_columns> expanded.
+
+    Splits that are not stored packed (unmigrated or non-integer) are written as-is
+    to the trailing split_paces_json column instead.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    if header:
+        writer.writerow(EXPORT_FIELDS + [f'split_{km}' for km in range(1, split_columns + 1)] + ['split_paces_json'])
+        yield flush()
+
+    for row in rows:
+        values = [getattr(row, field) for field in EXPORT_FIELDS]
+        values[EXPORT_FIELDS.index('start_time')] = row.start_time.isoformat()
+        if row.split_paces_blob is not None:
+            splits = decode_split_paces(row.split_paces_blob, None)
+            values += splits + [''] * (split_columns - len(splits)) + ['']
+        else:
+            values += [''] * split_columns + [row.split_paces_json or '']
+        writer.writerow(values)
+        yield flush()
+
+
+def read_resume_state(path, export_format):
+    """Return (after_id, split_columns) from a partially written export file.
+
+    Only the first line and the tail of the file are read. A trailing incomplete line
+    (the write that was interrupted) is cut off the file.
+    """
+    with open(path, 'rb+') as f:
+        first_line = f.readline()
+        end = f.seek(0, os.SEEK_END)
+        # Read backwards until the tail holds the last complete line
+        position, tail = end, b''
+        while position > 0 and tail.count(b'\n') < 2:
+            step = min(64 * 1024, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+        complete = tail.rfind(b'\n') + 1
+        if position + complete != end:
+            f.truncate(position + complete)
+
+    lines = tail[:complete].decode().splitlines()
+    last = lines[-1] if lines else None
+
+    split_columns = None
+    if export_format == 'csv':
+        if not first_line.endswith(b'\n'):
+            return 0, None
+        header = next(csv.reader([first_line.decode()]))
+        split_columns = sum(1 for name in header if name.startswith('split_') and name != 'split_paces_json')
+        if position + complete == len(first_line):
+            return 0, split_columns
+        return int(next(csv.reader([last]))[0]), split_columns
+
+    if last is None:
+        return 0, None
+    return json.loads(last)['id'], None
@@ -0,0 +1,257 @@
+# geo.py
+# Grid cells of activity end points, for nearby lookups and heatmap tiles.
+#
+# The grid is the web map tile grid (Web Mercator; zoom z has 2^z x 2^z tiles), so
+# heatmap tiles line up with the tiles the map draws. A cell id is the Morton code of a
+# tile's (x, y), i.e. their bits interleaved. The cells inside tile (z, x, y) at any
+# finer zoom then form one contiguous id range, and the cell containing a cell at a
+# coarser zoom is a right shift.
+#
+# Activity.end_cell is the cell of the end point at CELL_ZOOM (about 38 m at the
+# equator), indexed. GeoCellCount holds the number of activities ending in each cell at
+# every heatmap bin zoom, updated along with the insert, so a heatmap tile reads only
+# its own counter rows.
+import math
+
+from sqlalchemy import and_, or_, select
+
+from archive import activities_select, same_columns, ACTIVITY_TABLES
+from database import db, Activity, GeoCellCount, dialect_insert
+
+CELL_ZOOM = 20
+
+# Heatmap tiles exist for zooms HEATMAP_MIN_ZOOM..HEATMAP_MAX_ZOOM; each is split
+# into 2^HEATMAP_BIN_SHIFT x 2^HEATMAP_BIN_SHIFT bins, the cells HEATMAP_BIN_SHIFT zooms finer.
+HEATMAP_MIN_ZOOM = 0
+HEATMAP_MAX_ZOOM = 14
+HEATMAP_BIN_SHIFT = 4
+COUNTER_ZOOMS = range(HEATMAP_MIN_ZOOM + HEATMAP_BIN_SHIFT, HEATMAP_MAX_ZOOM + HEATMAP_BIN_SHIFT + 1)
+
+# Web Mercator stops short of the poles
+MAX_LATITUDE = 85.05112878
+EARTH_RADIUS_KM = 6371.0088
+
+# A nearby lookup scans at most this many tiles, at the finest zoom where that covers the radius
+MAX_NEARBY_TILES = 9
+
+# End points are shown to other users only as the center of their tile at this zoom
+# (about 300 m wide at the equator), not where the run actually ended
+NEARBY_SNAP_ZOOM = 17
+
+
+def _spread(value):
+    """Put the bits of a 32-bit value on the even bit positions."""
+    value &= 0xFFFFFFFF
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    return (value | (value << 1)) & 0x5555555555555555
+
+
+def _compact(value):
+    """Inverse of _spread: the even bits of value."""
+    value &= 0x5555555555555555
+    value = (value | (value >> 1)) & 0x3333333333333333
+    value = (value | (value >> 2)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value >> 4)) & 0x00FF00FF00FF00FF
+    value = (value | (value >> 8)) & 0x0000FFFF0000FFFF
+    return (value | (value >> 16)) & 0xFFFFFFFF
+
+
+def cell_id(x, y):
+    return _spread(x) | (_spread(y) << 1)
+
+
+def cell_xy(cell):
+    return _compact(cell), _compact(cell >> 1)
+
+
+def tile_xy(latitude, longitude, zoom):
+    """Tile (x, y) containing the point at zoom."""
+    n = 1 << zoom
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    x = int((longitude + 180.0) / 360.0 * n)
+    sin_latitude = math.sin(math.radians(latitude))
+    y = int((0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)) * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_center(zoom, x, y):
+    """(latitude, longitude) of the center of tile (x, y) at zoom."""
+    n = 1 << zoom
+    longitude = (x + 0.5) / n * 360.0 - 180.0
+    latitude = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 0.5) / n))))
+    return latitude, longitude
+
+
+def snap_to_tile(latitude, longitude, zoom=NEARBY_SNAP_ZOOM):
+    """The point moved to the center of its tile at zoom, rounded to 6 decimals."""
+    latitude, longitude = tile_center(zoom, *tile_xy(latitude, longitude, zoom))
+    return round(latitude, 6), round(longitude, 6)
+
+
+def is_coordinate(latitude, longitude):
+    return all(isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+               for value in (latitude, longitude)) and -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+def end_cell(latitude, longitude):
+    """Cell of an end point at CELL_ZOOM, None without (valid) coordinates."""
+    if not is_coordinate(latitude, longitude):
+        return None
+    # What the app sends when it has no location fix
+    if latitude == 0 and longitude == 0:
+        return None
+    return cell_id(*tile_xy(latitude, longitude, CELL_ZOOM))
+
+
+def cell_range(zoom, x, y, cell_zoom=CELL_ZOOM):
+    """[first, end) ids of the cells at cell_zoom inside tile (zoom, x, y)."""
+    shift = 2 * (cell_zoom - zoom)
+    first = cell_id(x, y)
+    return first << shift, (first + 1) << shift
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(longitude2 - longitude1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def nearby_cell_ranges(latitude, longitude, radius_km):
+    """end_cell ranges [first, end) covering every point within radius_km of the center."""
+    d_latitude = math.degrees(radius_km / EARTH_RADIUS_KM)
+    north, south = min(latitude + d_latitude, 90.0), max(latitude - d_latitude, -90.0)
+    # Longitude degrees shrink towards the poles; near a pole the circle spans every longitude
+    cos_latitude = min(math.cos(math.radians(north)), math.cos(math.radians(south)))
+    d_longitude = d_latitude / cos_latitude if cos_latitude > 1e-9 else 360.0
+
+    for zoom in range(CELL_ZOOM, -1, -1):
+        n = 1 << zoom
+        if d_longitude >= 180.0:
+            xs = range(n)
+        else:
+            # Wrap around the antimeridian
+            x_first, _ = tile_xy(latitude, (longitude - d_longitude + 540.0) % 360.0 - 180.0, zoom)
+            x_last, _ = tile_xy(latitude, (longitude + d_longitude + 540.0) % 360.0 - 180.0, zoom)
+            xs = [(x_first + offset) % n for offset in range((x_last - x_first) % n + 1)]
+        _, y_first = tile_xy(north, longitude, zoom)
+        _, y_last = tile_xy(south, longitude, zoom)
+        if len(xs) * (y_last - y_first + 1) <= MAX_NEARBY_TILES:
+            break
+
+    ranges = sorted(cell_range(zoom, x, y) for x in xs for y in range(y_first, y_last + 1))
+    # Neighbouring tiles are often adjacent in Morton order
+    merged = [list(ranges[0])]
+    for first, end in ranges[1:]:
+        if first == merged[-1][1]:
+            merged[-1][1] = end
+        else:
+            merged.append([first, end])
+    return [tuple(bounds) for bounds in merged]
+
+
+def nearby_activities(latitude, longitude, radius_km, columns):
+    """[(distance_km, row)] of the activities ending within radius_km of the center,
+    archived ones included, on the selected database. Rows hold columns plus the end
+    coordinates."""
+    ranges = nearby_cell_ranges(latitude, longitude, radius_km)
+    keys = {column.key for column in columns}
+    columns = list(columns) + [column for column in (Activity.end_latitude, Activity.end_longitude) if column.key not in keys]
+    statement = activities_select(lambda model: select(*same_columns(model, columns)).where(
+        or_(*(and_(model.end_cell >= first, model.end_cell < end) for first, end in ranges))))
+    found = []
+    # Cells only prune; the exact distance decides
+    for row in db.session.execute(statement):
+        distance_km = haversine_km(latitude, longitude, row.end_latitude, row.end_longitude)
+        if distance_km <= radius_km:
+            found.append((distance_km, row))
+    return found
+
+
+def add_cell_deltas(deltas, cell):
+    """Count one activity ending in cell (at CELL_ZOOM) into {(zoom, cell): count}."""
+    if cell is None:
+        return
+    for zoom in COUNTER_ZOOMS:
+        key = (zoom, cell >> 2 * (CELL_ZOOM - zoom))
+        deltas[key] = deltas.get(key, 0) + 1
+
+
+def add_cell_count_deltas(deltas):
+    """Add {(zoom, cell): count} to the heatmap counters. Caller commits."""
+    if not deltas:
+        return
+    # Counters are shared by all users, so two writers can create the same row:
+    # insert and increment in one upsert
+    statement = dialect_insert(db.session.get_bind().dialect.name)(GeoCellCount)
+    statement = statement.on_conflict_do_update(
+        index_elements=[GeoCellCount.zoom, GeoCellCount.cell],
+        set_={'activity_count': GeoCellCount.activity_count + statement.excluded.activity_count}
+    )
+    # executemany; sorted so concurrent writers take the row locks in the same order
+    db.session.execute(statement, [
+        {'zoom': zoom, 'cell': cell, 'activity_count': count} for (zoom, cell), count in sorted(deltas.items())
+    ])
+
+
+def record_end_cell(cell):
+    """Count one activity in the heatmap counters. Caller commits."""
+    deltas = {}
+    add_cell_deltas(deltas, cell)
+    add_cell_count_deltas(deltas)
+
+
+def heatmap_bins(zoom, x, y):
+    """{(bin x, bin y): count} of tile (zoom, x, y) on the selected database; bin
+    coordinates are relative to the tile, 0 .. 2^HEATMAP_BIN_SHIFT - 1."""
+    bin_zoom = zoom + HEATMAP_BIN_SHIFT
+    first, end = cell_range(zoom, x, y, bin_zoom)
+    rows = db.session.execute(select(GeoCellCount.cell, GeoCellCount.activity_count).where(
+        GeoCellCount.zoom == bin_zoom, GeoCellCount.cell >= first, GeoCellCount.cell < end))
+    bins = {}
+    for cell, count in rows:
+        bin_x, bin_y = cell_xy(cell)
+        bins[(bin_x - (x << HEATMAP_BIN_SHIFT), bin_y - (y << HEATMAP_BIN_SHIFT))] = count
+    return bins
+
+
+def rebuild_geo_cells(chunk_size=1000):
+    """Set end_cell on every activity, archived ones included, and recount the heatmap
+    counters from scratch on the selected database. Commits per chunk; returns
+    (activities with a cell, counter rows). Activities added or archived while it runs
+    may be counted twice."""
+    deltas = {}
+    activities = 0
+    # Walk each table in id order, one chunk per transaction
+    for model in ACTIVITY_TABLES:
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                select(model.id, model.end_latitude, model.end_longitude, model.end_cell)
+                .where(model.id > last_id).order_by(model.id).limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                cell = end_cell(row.end_latitude, row.end_longitude)
+                if cell != row.end_cell:
+                    updates.append({'id': row.id, 'end_cell': cell})
+                add_cell_deltas(deltas, cell)
+                activities += cell is not None
+            if updates:
+                db.session.execute(db.update(model), updates)
+            db.session.commit()
+            last_id = rows[-1].id
+
+    # Replace the counters in one transaction
+    db.session.execute(db.delete(GeoCellCount))
+    items = sorted(deltas.items())
+    for start in range(0, len(items), chunk_size):
+        add_cell_count_deltas(dict(items[start:start + chunk_size]))
+    db.session.commit()
+    return activities, len(items)
@@ -0,0 +1,43 @@
+# gunicorn.conf.py
+# gunicorn -c gunicorn.conf.py wsgi:app
+#
+# The app is imported and built once in the master (preload_app) and the workers are
+# forked from it, so a worker starts with the modules imported and the ORM mappers and
+# compiled statements already there instead of spending its first requests on them.
+# Connections must not be shared across the fork: post_fork drops the master's pooled
+# connections in each worker and, with DATABASE_PREWARM_CONNECTIONS set, opens the
+# worker's own before it accepts requests.
+#
+# One worker by default: the response cache, the user context cache and the post-write
+# queue's read-your-writes wait live in the process, so a second worker would serve
+# responses from before a write another worker handled. More workers need
+# RESPONSE_CACHE_URL (shared cache and versions) and POST_WRITE_WORKERS=0 (the goal is
+# updated before the write's response goes out); on_starting refuses to start otherwise.
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+
+
+def on_starting(server):
+    from wsgi import app
+    if server.cfg.workers > 1:
+        if not app.config['RESPONSE_CACHE_URL']:
+            raise RuntimeError(f'{server.cfg.workers} workers need RESPONSE_CACHE_URL: the in-process '
+                               'response cache would serve other workers\' stale responses')
+        if app.config['POST_WRITE_WORKERS']:
+            raise RuntimeError(f'{server.cfg.workers} workers need POST_WRITE_WORKERS=0: other workers '
+                               'can\'t wait for this one\'s background goal updates')
+
+
+def post_fork(server, worker):
+    from server import db, warm_up
+    from wsgi import app
+    with app.app_context():
+        for engine in db.engines.values():
+            # close=False: leave the master's connections alone, just forget them here
+            engine.dispose(close=False)
+    if app.config['DATABASE_PREWARM_CONNECTIONS']:
+        warm_up(app)
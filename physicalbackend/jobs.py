@@ -0,0 +1,109 @@
+# jobs.py
+# Background queue for work that follows a write (goal adaptation, rollups) so the
+# request can respond as soon as its own transaction has committed.
+#
+# Work is queued per user: items submitted for a user that is already waiting are
+# appended to the same job, so a burst of runs for one user is handled in one pass.
+# A user's jobs never run concurrently and run in submission order. When the queue is
+# full the job runs in the submitting thread instead.
+#
+# The queue lives in memory: work still waiting when the process dies is lost, so
+# handlers should be able to redo it from the database on a later job.
+import atexit
+import logging
+import threading
+import queue
+
+logger = logging.getLogger('physicalbackend')
+
+
+class PostWriteQueue:
+    def __init__(self, handler, workers=2, maxsize=1000):
+        """handler(user_id, items) runs inside an app context on a worker thread.
+
+        With workers=0 the handler runs synchronously in submit().
+        """
+        self.app = None
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.pending = {}       # user_id -> items not picked up yet
+        self.in_flight = set()  # user_ids being handled right now
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def init_app(self, app):
+        """Run the handler in app's context, with POST_WRITE_WORKERS threads and at most
+        POST_WRITE_QUEUE_SIZE users waiting. Threads start with the first submit()."""
+        self.app = app
+        self.workers = app.config['POST_WRITE_WORKERS']
+        self.queue = queue.Queue(maxsize=app.config['POST_WRITE_QUEUE_SIZE'])
+
+    def submit(self, user_id, items):
+        """Queue items for user_id. When the queue is full they are handled right away,
+        in this thread."""
+        if not self.workers:
+            self._run(user_id, list(items))
+            return
+
+        with self.condition:
+            if not self.threads:
+                self._start()
+            if user_id in self.pending:
+                # Coalesce into the job that is already waiting
+                self.pending[user_id].extend(items)
+                return
+            self.pending[user_id] = list(items)
+            try:
+                self.queue.put_nowait(user_id)
+                return
+            except queue.Full:
+                del self.pending[user_id]
+        logger.warning('Post-write queue full, running the job for user %s inline', user_id)
+        self._run(user_id, list(items))
+
+    def wait_for_user(self, user_id, timeout=None):
+        """Block until no work for user_id is pending or running. Returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: user_id not in self.pending and user_id not in self.in_flight, timeout)
+
+    def has_work(self, user_id):
+        """Whether work for user_id is pending or running, without waiting."""
+        with self.condition:
+            return user_id in self.pending or user_id in self.in_flight
+
+    def flush(self, timeout=None):
+        """Block until the queue is empty and idle. Returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.in_flight, timeout)
+
+    def _start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'post-write-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        # Don't drop queued work when the process exits normally
+        atexit.register(self.flush, 30)
+
+    def _work(self):
+        while True:
+            user_id = self.queue.get()
+            with self.condition:
+                # Another worker may still be running this user's previous job
+                self.condition.wait_for(lambda: user_id not in self.in_flight)
+                items = self.pending.pop(user_id)
+                self.in_flight.add(user_id)
+            try:
+                self._run(user_id, items)
+            finally:
+                with self.condition:
+                    self.in_flight.discard(user_id)
+                    self.condition.notify_all()
+
+    def _run(self, user_id, items):
+        with self.app.app_context():
+            try:
+                self.handler(user_id, items)
+            except Exception:
+                logger.exception('Post-write job for user %s failed', user_id)
@@ -0,0 +1,128 @@
+# metrics.py
+# Per-request performance instrumentation exposed in Prometheus text format at /metrics.
+#
+# For every request we record latency per endpoint, the number of SQL statements and
+# the time spent in them (from SQLAlchemy engine events), and the response size.
+# Requests slower than SLOW_REQUEST_MS are logged together with their SQL statements.
+import logging
+import random
+import threading
+import time
+
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('physicalbackend')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# Statements kept per request for the slow-request log
+MAX_LOGGED_STATEMENTS = 50
+
+
+def log_sampled(log, level, rate, message, *args):
+    """Log roughly a `rate` fraction of calls. Free when the level is disabled."""
+    if log.isEnabledFor(level) and (rate >= 1 or random.random() < rate):
+        log.log(level, message, *args)
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts..., count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self, label_names):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            items = sorted(self.series.items())
+        for labels, series in items:
+            label_text = ','.join(f'{name}="{value}"' for name, value in zip(label_names, labels))
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {series[-2]}')
+            lines.append(f'{self.name}_count{{{label_text}}} {series[-2]}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {series[-1]}')
+        return lines
+
+
+LABELS = ('method', 'endpoint', 'status')
+request_latency = Histogram('http_request_duration_seconds', 'Request latency.', LATENCY_BUCKETS)
+request_sql_count = Histogram('http_request_sql_statements', 'SQL statements per request.', SQL_COUNT_BUCKETS)
+request_sql_time = Histogram('http_request_sql_duration_seconds', 'Time spent in SQL per request.', LATENCY_BUCKETS)
+response_size = Histogram('http_response_size_bytes', 'Response body size.', SIZE_BUCKETS)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_count' in g:
+        context._query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    g.sql_count += 1
+    g.sql_time += elapsed
+    if len(g.sql_statements) < MAX_LOGGED_STATEMENTS:
+        g.sql_statements.append((elapsed, statement))
+
+
+def init_metrics(app):
+    """Register the request hooks and the /metrics endpoint on app."""
+    slow_request_seconds = app.config.get('SLOW_REQUEST_MS', 500) / 1000
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        g.sql_count = 0
+        g.sql_time = 0.0
+        g.sql_statements = []
+
+    @app.after_request
+    def record_request(response):
+        if 'request_started' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        # Route pattern rather than the URL, so user ids don't create new series
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = (request.method, endpoint, str(response.status_code))
+
+        request_latency.observe(labels, elapsed)
+        request_sql_count.observe(labels, g.sql_count)
+        request_sql_time.observe(labels, g.sql_time)
+        # Streamed responses have no length up front
+        if response.content_length is not None:
+            response_size.observe(labels, response.content_length)
+
+        if elapsed >= slow_request_seconds and logger.isEnabledFor(logging.WARNING):
+            statements = '\n'.join(f'  {duration * 1000:8.2f} ms  {statement}' for duration, statement in g.sql_statements)
+            logger.warning('Slow request %s %s: %.1f ms, %d SQL statements (%.1f ms)\n%s',
+                           request.method, request.full_path, elapsed * 1000, g.sql_count, g.sql_time * 1000, statements)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        lines = []
+        for histogram in (request_latency, request_sql_count, request_sql_time, response_size):
+            lines += histogram.render(LABELS)
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,88 @@
+# passwords.py
+# Password hashing on a bounded process pool, so login bursts don't hold the
+# request threads (and the GIL) while scrypt/PBKDF2 runs.
+#
+# At most max_pending hash operations are queued or running at once. Beyond that,
+# hash() and verify() raise HasherBusy right away and the endpoint answers 503 with
+# Retry-After, instead of requests piling up behind the pool.
+import threading
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    """Too many hash operations are queued; retry later."""
+
+
+# Run in the pool processes, so they must be module-level
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(password_hash, password):
+    return check_password_hash(password_hash, password)
+
+
+class PasswordHasher:
+    def __init__(self, method='scrypt', workers=1, max_pending=4):
+        """method is a werkzeug hash method with optional cost parameters,
+        e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'.
+
+        With workers=0 hashing runs in the calling thread (still subject to max_pending).
+        """
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.pool = None
+        self._prefix = None
+
+    def init_app(self, app):
+        """Take method, workers and max_pending from app's PASSWORD_HASH_* settings."""
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.max_pending = app.config['PASSWORD_HASH_MAX_PENDING']
+        self._prefix = None
+
+    def hash(self, password):
+        return self._call(_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._call(_verify, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if password_hash was made with other cost parameters than self.method."""
+        if self._prefix is None:
+            # werkzeug fills in defaults for omitted parameters; take them from a real hash
+            self._prefix = generate_password_hash('', method=self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefix
+
+    def _call(self, function, *args):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise HasherBusy()
+            self.pending += 1
+            if self.workers and self.pool is None:
+                self.pool = self._start()
+        try:
+            if not self.workers:
+                return function(*args)
+            return self.pool.submit(function, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def _start(self):
+        # Imported with the first hash: processes that never hash (CLI jobs) don't pay for them
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Not fork: the server process has threads (post-write workers, the request threads)
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
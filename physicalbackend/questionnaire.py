@@ -0,0 +1,238 @@
+# questionnaire.py
+# Questionnaire answers -> the user's first Trait (user type, long-term and current goals).
+#
+# The answer-to-goal mapping is declared in the rule tables below. QuestionnaireRules
+# compiles them once at startup: everything that only depends on the multiple-choice
+# answers is worked out for every combination of them, so a submission is a few dict
+# lookups plus the steps that depend on numbers typed into the answers.
+import csv
+import itertools
+import json
+import re
+from datetime import datetime
+
+from database import db, Trait, dialect_insert
+
+# Answers that ask for numbers carry them as 'Yes (Additional: distance=10, speed=5)'
+ADDITIONAL_INPUT = re.compile(r'\(Additional: (.*)\)')
+FLOAT_INPUTS = ('distance', 'goal', 'weight')
+INT_INPUTS = ('speed',)
+
+DEFAULT_LONG_GOAL = {'dist': 21.0, 'pace': 300, 'weight': 60.0}
+DEFAULT_CURR_GOAL = {'dist': 5.0, 'pace': 420, 'weight': 70.0, 'freq': 3.0}
+
+
+class Typed:
+    """Goal value typed into the answer: the Additional value of key, passed through
+    convert. The goal keeps its default when the key is missing."""
+
+    def __init__(self, key, convert=None):
+        self.key = key
+        self.convert = convert
+
+
+class LastRun:
+    """Current distance as share x the last run's distance (h2), at least at_least km."""
+
+    def __init__(self, share, at_least=None):
+        self.share = share
+        self.at_least = at_least
+
+    def distance(self, last_run_dist):
+        dist = last_run_dist * self.share
+        return dist if self.at_least is None else max(self.at_least, dist)
+
+
+def minutes_to_seconds(minutes):
+    return int(minutes * 60)
+
+
+# g1 (why do you run) x g2 (do you have a long-term goal) -> long-term goal. 'Yes' stands
+# for any answer starting with 'Yes', which carries the numbers the user typed.
+LONG_GOAL_RULES = {
+    ('Faster speed', 'Yes'): {'dist': Typed('distance'), 'pace': Typed('speed', minutes_to_seconds),
+                              'weight': DEFAULT_CURR_GOAL['weight']},
+    ('Longer distance', 'Yes'): {'dist': Typed('goal'), 'pace': 360, 'weight': DEFAULT_CURR_GOAL['weight']},
+    ('Healthier shape', 'Yes'): {'weight': Typed('weight'), 'dist': 10.0, 'pace': 420},
+    ('Faster speed', 'No'): {'pace': 270, 'dist': 10.0, 'weight': DEFAULT_CURR_GOAL['weight']},
+    ('Longer distance', 'No'): {'dist': 21.0, 'pace': 390, 'weight': DEFAULT_CURR_GOAL['weight']},
+    ('Healthier shape', 'No'): {'dist': 10.0, 'pace': 450, 'weight': 65.0},
+}
+
+# h2: how far did you run last time -> km the current distance is based on
+LAST_RUN_DIST = {'Less than 3km': 3.0, '3~10km': 5.0, 'More than 10km': 8.0}
+
+# h1: how long since the last run -> current goal; any other answer ('Within a week')
+# gets RECENT_RUN
+LONG_BREAK = 'More than a month'
+RECENCY_RULES = {
+    LONG_BREAK: {'dist': 2.0, 'pace': 570, 'freq': 1.0},
+    'Within a month': {'dist': LastRun(0.75, at_least=3.0), 'pace': 480, 'freq': 2.0},
+}
+RECENT_RUN = {'dist': LastRun(1.0), 'freq': 3.0}
+
+# A long-term distance above `above` km lifts a current distance below `below` of it to
+# at least `at_least` of it. (above, below, at_least, also after a LONG_BREAK)
+LONG_DIST_SHARES = (
+    (10.0, 0.2, 0.2, True),
+    (5.0, 0.5, 0.3, False),
+)
+
+# h3: how fast did you run last time (min/km) -> (slowest, fastest) bounds on the current
+# pace in s/km, None: unbounded
+PACE_BOUNDS = {'Less than 5': (None, 300), '5~7': (300, 420), 'More than 7': (480, None)}
+
+# h4: current weight, typed as 'kg (Additional: weight=...)'. Above HEAVY_WEIGHT kg the
+# current goal is at most HEAVY_MAX_DIST km at HEAVY_MIN_PACE s/km or slower.
+WEIGHT_ANSWER = 'kg'
+HEAVY_WEIGHT = 90
+HEAVY_MAX_DIST = 3.0
+HEAVY_MIN_PACE = 540
+
+# m1 (have you started and quit running) and m2 (believe in "just run as AI tells you")
+YES = 'Yes'
+
+
+def parse_additional_input(answer):
+    """{key: value} of an answer's '(Additional: key1=val1, key2=val2)' part."""
+    match = ADDITIONAL_INPUT.search(answer)
+    if not match:
+        return {}
+    params = {}
+    for pair in match.group(1).split(', '):
+        key_val = pair.split('=')
+        if len(key_val) != 2:
+            continue
+        key, val = key_val
+        try:
+            if key in FLOAT_INPUTS:
+                params[key] = float(val)
+            elif key in INT_INPUTS:
+                params[key] = int(val)
+            else:
+                params[key] = val
+        except ValueError:
+            # Kept as typed
+            params[key] = val
+    return params
+
+
+def _choice(table, answer):
+    """answer if it is one of table's keys, otherwise None (the table's fallback)."""
+    return answer if isinstance(answer, str) and answer in table else None
+
+
+class QuestionnaireRules:
+    def __init__(self, max_pace):
+        self.max_pace = max_pace
+
+        # (g1, g2 choice) -> (long goal without typed values, [(field, Typed)])
+        self.long_goals = {}
+        for key, rule in LONG_GOAL_RULES.items():
+            goal = dict(DEFAULT_LONG_GOAL)
+            typed = []
+            for field, value in rule.items():
+                if isinstance(value, Typed):
+                    typed.append((field, value))
+                else:
+                    goal[field] = value
+            self.long_goals[key] = (goal, typed)
+        self.default_long_goal = (dict(DEFAULT_LONG_GOAL), [])
+
+        # (h1, h2, h3 choices) -> (current dist, pace, freq, after a long break)
+        self.current_goals = {}
+        for h1, h2, h3 in itertools.product([*RECENCY_RULES, None], [*LAST_RUN_DIST, None], [*PACE_BOUNDS, None]):
+            goal = dict(DEFAULT_CURR_GOAL)
+            last_run_dist = LAST_RUN_DIST.get(h2, DEFAULT_CURR_GOAL['dist'])
+            for field, value in RECENCY_RULES.get(h1, RECENT_RUN).items():
+                goal[field] = value.distance(last_run_dist) if isinstance(value, LastRun) else value
+            slowest, fastest = PACE_BOUNDS.get(h3, (None, None))
+            pace = goal['pace']
+            if slowest is not None:
+                pace = max(pace, slowest)
+            if fastest is not None:
+                pace = min(pace, fastest)
+            self.current_goals[(h1, h2, h3)] = (goal['dist'], min(pace, max_pace), goal['freq'], h1 == LONG_BREAK)
+
+    def traits(self, answers):
+        """Trait columns (user_type, long_goal, curr_goal, usually_quit, now_quit,
+        believe_ai) for the answers of a questionnaire submission."""
+        g1 = answers.get('g1')
+        user_type = g1.split()[0].lower()
+
+        g2 = answers.get('g2')
+        has_goal = g2 and g2.startswith(YES)
+        fixed, typed = self.long_goals.get(
+            (g1, YES if has_goal else g2 if isinstance(g2, str) else None), self.default_long_goal)
+        long_goal = dict(fixed)
+        if typed:
+            params = parse_additional_input(g2)
+            for field, value in typed:
+                if value.key in params:
+                    long_goal[field] = value.convert(params[value.key]) if value.convert else params[value.key]
+
+        dist, pace, freq, after_break = self.current_goals[(
+            _choice(RECENCY_RULES, answers.get('h1')),
+            _choice(LAST_RUN_DIST, answers.get('h2')),
+            _choice(PACE_BOUNDS, answers.get('h3')),
+        )]
+        long_dist = long_goal['dist']
+        for above, below, at_least, after_break_too in LONG_DIST_SHARES:
+            if long_dist > above and dist < long_dist * below and (after_break_too or not after_break):
+                dist = max(dist, long_dist * at_least)
+        long_goal['pace'] = min(long_goal['pace'], self.max_pace)
+
+        weight = DEFAULT_CURR_GOAL['weight']
+        h4 = answers.get('h4')
+        if h4 and h4.startswith(WEIGHT_ANSWER):
+            params = parse_additional_input(h4)
+            if 'weight' in params:
+                weight = params['weight']
+                if weight > HEAVY_WEIGHT:
+                    dist = min(dist, HEAVY_MAX_DIST)
+                    pace = min(max(pace, HEAVY_MIN_PACE), self.max_pace)
+
+        # The current goal is never harder than the long-term one
+        dist = min(dist, long_goal['dist'])
+        pace = min(max(pace, long_goal['pace']), self.max_pace)
+        weight = max(weight, long_goal['weight'])
+
+        return {
+            'user_type': user_type,
+            'long_goal': long_goal,
+            'curr_goal': {'dist': dist, 'pace': pace, 'weight': weight, 'freq': freq},
+            'usually_quit': answers.get('m1') == YES,
+            'now_quit': False,
+            'believe_ai': answers.get('m2') == YES,
+        }
+
+
+def upsert_traits(rows):
+    """Insert or replace the traits of the rows' users (Trait column values, user_id
+    included) in one statement on the selected database. Caller commits."""
+    if 'user_type' in rows[0]:
+        changed_at = datetime.utcnow()
+        rows = [dict(row, cohort_changed_at=changed_at) for row in rows]
+    statement = dialect_insert(db.session.get_bind().dialect.name)(Trait)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Trait.user_id],
+        set_={key: statement.excluded[key] for key in rows[0] if key != 'user_id'}
+    )
+    db.session.execute(statement, rows)
+
+
+def read_questionnaires(lines, input_format):
+    """(line number, answers) of each questionnaire in an NDJSON or CSV file. Answers are
+    the body /finish_questionare takes: user_id and g1 .. m2. An empty CSV cell is an
+    unanswered question."""
+    if input_format == 'csv':
+        for line, row in enumerate(csv.DictReader(lines), start=2):
+            yield line, {key: value for key, value in row.items() if value}
+        return
+    for line, text in enumerate(lines, start=1):
+        if not text.strip():
+            continue
+        try:
+            yield line, json.loads(text)
+        except ValueError as error:
+            raise ValueError(f'line {line}: {error}') from None
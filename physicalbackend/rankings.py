@@ -0,0 +1,638 @@
+# rankings.py
+# Weekly cohort rankings: where a user's weekly distance and best pace stand among the
+# users of the same Trait.user_type.
+#
+# RankingIndex keeps every user's totals for the last RANKING_WEEKS weeks (Monday to
+# Sunday, by start_time's date like the daily rollups) and, per (cohort, week, metric),
+# an order-statistic tree of them. A rank, a percentile or the start of a top-N page is
+# then O(log n) instead of a sort of the whole cohort.
+#
+# The index follows the activity table: catch_up() applies the activities whose id is
+# above the highest one it has applied on that database. Inserts call it after they
+# commit and ranking reads call it first, so runs stored by other worker processes are
+# picked up too, each exactly once. On PostgreSQL a transaction can commit after one
+# that took a higher id: the ids skipped below the highest one are remembered and
+# looked up again on each catch_up() until they show up, or for LATE_COMMIT_SECONDS
+# (rolled back inserts never do). Cohorts changed by other processes are re-read from
+# the traits whose cohort_changed_at is recent, at most every RANKING_COHORT_SECONDS.
+#
+# The state is saved to RankingSnapshot every RANKING_SNAPSHOT_SECONDS when it changed,
+# so after a restart the index loads the snapshot and only reads the activities added
+# since instead of recomputing every total.
+import atexit
+import logging
+import random
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, or_, select
+
+from archive import activities_select
+from database import db, Activity, Trait, RankingSnapshot
+
+logger = logging.getLogger('physicalbackend')
+
+METRICS = ('distance', 'pace')
+
+# Tree keys are value * KEY_SCALE + user_id: ordered by value, ties by user id.
+# Distance is stored negated, so that smaller keys are better for both metrics.
+KEY_SCALE = 1 << 32
+
+# RankingSnapshot.totals stores a missing best pace as this
+NO_PACE = -1
+
+# How long after taking its activity ids or stamping Trait.cohort_changed_at a
+# transaction may still commit: skipped ids are awaited, and recent cohort changes
+# re-read, for that long
+LATE_COMMIT_SECONDS = 600
+
+# A jump of more ids than this is a moved sequence, not inserts in flight; it is also
+# how far back a recomputation looks for ids not committed yet
+MAX_AWAITED_IDS = 1000
+
+
+class _Node:
+    __slots__ = ('key', 'priority', 'size', 'left', 'right')
+
+    def __init__(self, key, priority=None):
+        self.key = key
+        self.priority = random.random() if priority is None else priority
+        self.size = 1
+        self.left = None
+        self.right = None
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _split(node, key):
+    """(tree of the keys < key, tree of the keys >= key)."""
+    if node is None:
+        return None, None
+    if node.key < key:
+        node.right, right = _split(node.right, key)
+        node.size = 1 + _size(node.left) + _size(node.right)
+        return node, right
+    left, node.left = _split(node.left, key)
+    node.size = 1 + _size(node.left) + _size(node.right)
+    return left, node
+
+
+def _merge(left, right):
+    """Join two trees, all keys of left below those of right."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.size = 1 + _size(left.left) + _size(left.right)
+        return left
+    right.left = _merge(left, right.left)
+    right.size = 1 + _size(right.left) + _size(right.right)
+    return right
+
+
+class OrderStatisticTree:
+    """Set of distinct ints with O(log n) expected insert, remove and rank: a treap
+    whose nodes count the keys below them."""
+
+    def __init__(self):
+        self.root = None
+
+    @classmethod
+    def from_sorted(cls, keys):
+        """Tree of ascending distinct keys, built in O(n)."""
+        tree = cls()
+        spine = []  # right spine of the tree built so far
+        for key in keys:
+            node = _Node(key)
+            last = None
+            while spine and spine[-1].priority < node.priority:
+                last = spine.pop()
+            node.left = last
+            if spine:
+                spine[-1].right = node
+            spine.append(node)
+        tree.root = spine[0] if spine else None
+
+        # Subtree sizes, children before parents
+        order = []
+        stack = [tree.root] if tree.root else []
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack += [child for child in (node.left, node.right) if child is not None]
+        for node in reversed(order):
+            node.size = 1 + _size(node.left) + _size(node.right)
+        return tree
+
+    def __len__(self):
+        return _size(self.root)
+
+    def insert(self, key):
+        left, right = _split(self.root, key)
+        self.root = _merge(_merge(left, _Node(key)), right)
+
+    def remove(self, key):
+        left, right = _split(self.root, key)
+        _, right = _split(right, key + 1)
+        self.root = _merge(left, right)
+
+    def count_less(self, key):
+        """Number of keys below key."""
+        count = 0
+        node = self.root
+        while node is not None:
+            if node.key < key:
+                count += _size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return count
+
+    def iter_from(self, index):
+        """Keys in ascending order, from the index-th smallest (0-based) on."""
+        stack = []
+        node = self.root
+        while node is not None:
+            left = _size(node.left)
+            if index < left:
+                stack.append(node)
+                node = node.left
+            elif index > left:
+                index -= left + 1
+                node = node.right
+            else:
+                stack.append(node)
+                break
+        while stack:
+            node = stack.pop()
+            yield node.key
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+
+def week_of(day):
+    """Ordinal of the Monday of day's week."""
+    return day.toordinal() - day.weekday()
+
+
+def run_values(distance_km, pace):
+    """(meters, pace s/km or None) a run adds to its week: the distance is summed, the
+    pace counts towards the best pace if the run has both a distance and a pace."""
+    meters = round((distance_km or 0) * 1000)
+    if not distance_km or distance_km <= 0 or not pace or pace <= 0:
+        return meters, None
+    return meters, round(pace)
+
+
+def add_to_total(total, meters, pace):
+    """Fold a run's run_values() into a [meters, best pace] total."""
+    total[0] += meters
+    if pace is not None and (total[1] is None or pace < total[1]):
+        total[1] = pace
+
+
+def metric_keys(user_id, total):
+    """(metric, tree key) of a [meters, best pace] total."""
+    yield 'distance', -total[0] * KEY_SCALE + user_id
+    if total[1] is not None:
+        yield 'pace', total[1] * KEY_SCALE + user_id
+
+
+def metric_value(metric, key):
+    """Response value of a tree key: km for distance, s/km for pace."""
+    value = key // KEY_SCALE
+    return -value / 1000 if metric == 'distance' else value
+
+
+def rank_body(value, rank, size):
+    return {'value': value, 'rank': rank, 'of': size, 'percentile': round(100 * (size - rank + 1) / size, 1)}
+
+
+def weekly_totals(first_week, up_to_id=None, skipped_ids=()):
+    """{(user_id, week): [meters, best pace]} computed from every activity on the selected
+    database that started in first_week or later, archived ones included, and whose id
+    is at most up_to_id (None: all) and not in skipped_ids."""
+    since = datetime.combine(date.fromordinal(first_week), datetime.min.time())
+
+    def build(model):
+        statement = select(model.user_id, model.start_time, model.distance_km, model.average_pace_seconds_per_km)\
+            .where(model.start_time >= since)
+        if skipped_ids:
+            statement = statement.where(model.id.not_in(list(skipped_ids)))
+        return statement if up_to_id is None else statement.where(model.id <= up_to_id)
+
+    totals = {}
+    for row in db.session.execute(activities_select(build, since=since)):
+        key = (row.user_id, week_of(row.start_time.date()))
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = [0, None]
+        add_to_total(total, *run_values(row.distance_km, row.average_pace_seconds_per_km))
+    return totals
+
+
+def pack_totals(totals):
+    values = array('q')
+    for (user_id, week), (meters, pace) in totals:
+        values.extend((user_id, week, meters, NO_PACE if pace is None else pace))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack_totals(blob):
+    values = array('q')
+    values.frombytes(blob)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    for index in range(0, len(values), 4):
+        user_id, week, meters, pace = values[index:index + 4]
+        yield (user_id, week), [meters, None if pace == NO_PACE else pace]
+
+
+class RankingIndex:
+    def __init__(self, shards, app=None, weeks=4, snapshot_seconds=300, cohort_seconds=0):
+        """Rankings of the activities on the databases of shards, kept for the last
+        `weeks` weeks. With snapshot_seconds=0 the state is only saved by save().
+        Reads re-read the cohorts when they are older than cohort_seconds."""
+        self.app = app
+        self.shards = shards
+        self.weeks = weeks
+        self.snapshot_seconds = snapshot_seconds
+        self.cohort_seconds = cohort_seconds
+        self.cohorts_read_at = None  # datetime.utcnow() when the cohorts were last read
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.thread = None
+        self.totals = {}       # (user_id, week) -> [meters, best pace s/km or None]
+        self.week_users = {}   # week -> user_ids with a total that week
+        self.cohorts = {}      # user_id -> Trait.user_type, for users that have one
+        self.trees = {}        # (cohort, week, metric) -> OrderStatisticTree of metric_keys()
+        self.high_water = {}   # database (shard key) -> highest Activity.id applied
+        self.skipped = {}      # database -> {Activity.id below high_water not seen yet: time.monotonic() skipped}
+        self.changed = False
+
+    def init_app(self, app):
+        """Keep RANKING_WEEKS weeks, save every RANKING_SNAPSHOT_SECONDS and re-read the
+        cohorts every RANKING_COHORT_SECONDS for app."""
+        self.app = app
+        self.weeks = app.config['RANKING_WEEKS']
+        self.snapshot_seconds = app.config['RANKING_SNAPSHOT_SECONDS']
+        self.cohort_seconds = app.config['RANKING_COHORT_SECONDS']
+
+    def database_keys(self):
+        return self.shards.keys or [None]
+
+    def first_week(self):
+        """Oldest week kept: the current one and the weeks - 1 before it."""
+        return week_of(datetime.now().date()) - 7 * (self.weeks - 1)
+
+    # --- Loading ---
+
+    def ensure_loaded(self):
+        """Load on first use and start saving snapshots."""
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            self.load()
+            if self.snapshot_seconds:
+                self.thread = threading.Thread(target=self._save_periodically, name='ranking-snapshots', daemon=True)
+                self.thread.start()
+                atexit.register(self._save_if_changed)
+
+    def load(self, from_snapshot=True):
+        """Load each database's snapshot, or recompute its totals from the activities when
+        there is none (or from_snapshot is False), then catch up."""
+        with self.lock:
+            first_week = self.first_week()
+            self.totals = {}
+            self.cohorts = {}
+            self.cohorts_read_at = datetime.utcnow()
+            recomputed = False
+            now = time.monotonic()
+            for key in self.database_keys():
+                with self.shards.use(key):
+                    max_id = db.session.scalar(select(func.max(Activity.id))) or 0
+                    snapshot = db.session.get(RankingSnapshot, 1) if from_snapshot else None
+                    # A snapshot ahead of the activity table belongs to a database that was reset
+                    if snapshot is not None and snapshot.last_activity_id <= max_id:
+                        self.totals.update(item for item in unpack_totals(snapshot.totals) if item[0][1] >= first_week)
+                        self.high_water[key] = snapshot.last_activity_id
+                        self.skipped[key] = dict.fromkeys(snapshot.pending_activity_ids or (), now)
+                    else:
+                        self.totals.update(weekly_totals(first_week, up_to_id=max_id))
+                        self.high_water[key] = max_id
+                        # Inserts still in flight may hold ids below max_id
+                        self.skipped[key] = {}
+                        recent_ids = db.session.scalars(
+                            select(Activity.id).where(Activity.id > max_id - MAX_AWAITED_IDS * self._id_step(key))
+                            .order_by(Activity.id)).all()
+                        for previous, activity_id in zip(recent_ids, recent_ids[1:]):
+                            self._skip(key, previous, activity_id, now)
+                        recomputed = True
+                    self.cohorts.update(db.session.execute(
+                        select(Trait.user_id, Trait.user_type).where(Trait.user_type.isnot(None))).all())
+                    db.session.commit()
+
+            self.week_users = {}
+            grouped = {}
+            for (user_id, week), total in self.totals.items():
+                self.week_users.setdefault(week, set()).add(user_id)
+                cohort = self.cohorts.get(user_id)
+                if cohort is not None:
+                    for metric, tree_key in metric_keys(user_id, total):
+                        grouped.setdefault((cohort, week, metric), []).append(tree_key)
+            self.trees = {key: OrderStatisticTree.from_sorted(sorted(keys)) for key, keys in grouped.items()}
+            self.loaded = True
+            self.changed = recomputed
+            self.catch_up()
+
+    # --- Updates ---
+
+    def catch_up(self, keys=None):
+        """Apply the activities added since the last call on the databases keys (default:
+        all), and with the default re-read the cohorts when they are older than
+        cohort_seconds. Does nothing before the index is loaded."""
+        if not self.loaded:
+            return
+        with self.lock:
+            self._prune()
+            if keys is None and (datetime.utcnow() - self.cohorts_read_at).total_seconds() >= self.cohort_seconds:
+                self.refresh_cohorts()
+            now = time.monotonic()
+            for key in self.database_keys() if keys is None else keys:
+                high_water = self.high_water.get(key, 0)
+                skipped = self.skipped.setdefault(key, {})
+                expired = [activity_id for activity_id, since in skipped.items() if now - since > LATE_COMMIT_SECONDS]
+                for activity_id in expired:
+                    del skipped[activity_id]
+                    self.changed = True
+                condition = Activity.id > high_water
+                if skipped:
+                    condition = or_(condition, Activity.id.in_(list(skipped)))
+                with self.shards.use(key):
+                    rows = db.session.execute(
+                        select(Activity.id, Activity.user_id, Activity.start_time, Activity.distance_km,
+                               Activity.average_pace_seconds_per_km)
+                        .where(condition).order_by(Activity.id)
+                    ).all()
+                    if not rows:
+                        continue
+                    self._load_cohorts({row.user_id for row in rows} - set(self.cohorts))
+                first_week = self.first_week()
+                for row in rows:
+                    if row.id > high_water:
+                        self._skip(key, high_water, row.id, now)
+                        high_water = row.id
+                    else:
+                        del skipped[row.id]
+                    week = week_of(row.start_time.date())
+                    if week >= first_week:
+                        self._add_run(row.user_id, week, *run_values(row.distance_km, row.average_pace_seconds_per_km))
+                self.high_water[key] = high_water
+                self.changed = True
+
+    def after_insert(self, key):
+        """catch_up() for the database key after an insert committed. Failures are logged:
+        the request already succeeded, and the next catch_up() retries."""
+        try:
+            self.catch_up([key])
+        except Exception:
+            logger.exception('Catching up the rankings failed')
+
+    def set_cohort(self, user_id, cohort):
+        """Move user_id's totals to cohort (their new Trait.user_type)."""
+        if not self.loaded:
+            return
+        with self.lock:
+            if self.cohorts.get(user_id) == cohort:
+                return
+            weeks = [week for week, user_ids in self.week_users.items() if user_id in user_ids]
+            for week in weeks:
+                self._unlink(user_id, week)
+            if cohort is None:
+                self.cohorts.pop(user_id, None)
+            else:
+                self.cohorts[user_id] = cohort
+            for week in weeks:
+                self._link(user_id, week)
+
+    def refresh_cohorts(self):
+        """Move the users whose Trait.user_type changed since the cohorts were last read,
+        e.g. by a questionnaire retaken on another worker process."""
+        with self.lock:
+            read_at = datetime.utcnow()
+            # Changes stamped before the last read may have committed after it
+            since = self.cohorts_read_at - timedelta(seconds=LATE_COMMIT_SECONDS)
+            changes = []
+            for key in self.database_keys():
+                with self.shards.use(key):
+                    changes += db.session.execute(
+                        select(Trait.user_id, Trait.user_type).where(Trait.cohort_changed_at >= since)).all()
+                    db.session.commit()
+            for user_id, cohort in changes:
+                self.set_cohort(user_id, cohort)
+            self.cohorts_read_at = read_at
+
+    def _id_step(self, key):
+        """Difference between consecutive activity ids of database key."""
+        return len(self.shards.keys) if key is not None else 1
+
+    def _skip(self, key, above, activity_id, now):
+        """Await the ids database key may have handed out between above and activity_id."""
+        if key is None:
+            ids = range(above + 1, activity_id)
+        else:
+            ids = range(self.shards.next_activity_id(key, above), activity_id, self._id_step(key))
+        if 0 < len(ids) <= MAX_AWAITED_IDS:
+            self.skipped[key].update(dict.fromkeys(ids, now))
+            self.changed = True
+
+    def _load_cohorts(self, user_ids):
+        if user_ids:
+            # Users may already have totals from before they had a trait
+            for user_id, cohort in db.session.execute(
+                    select(Trait.user_id, Trait.user_type).where(Trait.user_id.in_(list(user_ids)), Trait.user_type.isnot(None))):
+                self.set_cohort(user_id, cohort)
+
+    def _add_run(self, user_id, week, meters, pace):
+        total = self.totals.get((user_id, week))
+        if total is None:
+            total = self.totals[(user_id, week)] = [0, None]
+            self.week_users.setdefault(week, set()).add(user_id)
+        else:
+            self._unlink(user_id, week)
+        add_to_total(total, meters, pace)
+        self._link(user_id, week)
+
+    def _link(self, user_id, week):
+        cohort = self.cohorts.get(user_id)
+        if cohort is not None:
+            for metric, tree_key in metric_keys(user_id, self.totals[(user_id, week)]):
+                tree = self.trees.get((cohort, week, metric))
+                if tree is None:
+                    tree = self.trees[(cohort, week, metric)] = OrderStatisticTree()
+                tree.insert(tree_key)
+
+    def _unlink(self, user_id, week):
+        cohort = self.cohorts.get(user_id)
+        if cohort is not None:
+            for metric, tree_key in metric_keys(user_id, self.totals[(user_id, week)]):
+                self.trees[(cohort, week, metric)].remove(tree_key)
+
+    def _prune(self):
+        """Forget the weeks that fell out of the window."""
+        first_week = self.first_week()
+        for week in [week for week in self.week_users if week < first_week]:
+            for user_id in self.week_users.pop(week):
+                del self.totals[(user_id, week)]
+            self.changed = True
+        for key in [key for key in self.trees if key[1] < first_week]:
+            del self.trees[key]
+
+    # --- Reads ---
+
+    def standing(self, user_id, cohort, week):
+        """{metric: {'value', 'rank', 'of', 'percentile'} or None} of user_id in week among
+        cohort, their current Trait.user_type. Rank 1 is the longest distance or the
+        fastest pace, ties share a rank; percentile is the share of the cohort ranked the
+        same or lower."""
+        self.ensure_loaded()
+        self.catch_up()
+        with self.lock:
+            # The trait may have changed in another process
+            self.set_cohort(user_id, cohort)
+            return self._standing(user_id, cohort, week)
+
+    def top(self, cohort, week, metric, offset=0, limit=10):
+        """(users ranked, [(rank, user_id, value)] from rank offset + 1 on)."""
+        self.ensure_loaded()
+        self.catch_up()
+        with self.lock:
+            return self._top(cohort, week, metric, offset, limit)
+
+    def _standing(self, user_id, cohort, week):
+        total = self.totals.get((user_id, week))
+        body = dict.fromkeys(METRICS)
+        for metric, tree_key in metric_keys(user_id, total) if total and cohort is not None else ():
+            tree = self.trees[(cohort, week, metric)]
+            rank = tree.count_less(tree_key - user_id) + 1
+            body[metric] = rank_body(metric_value(metric, tree_key), rank, len(tree))
+        return body
+
+    def _top(self, cohort, week, metric, offset, limit):
+        tree = self.trees.get((cohort, week, metric))
+        if tree is None:
+            return 0, []
+        entries = []
+        rank = None
+        previous = None
+        for position, tree_key in enumerate(tree.iter_from(offset), start=offset):
+            if len(entries) == limit:
+                break
+            value_key = tree_key - tree_key % KEY_SCALE
+            if value_key != previous:
+                # The first entry may tie with the ones before the page
+                rank = tree.count_less(value_key) + 1 if previous is None else position + 1
+                previous = value_key
+            entries.append((rank, tree_key % KEY_SCALE, metric_value(metric, tree_key)))
+        return len(tree), entries
+
+    def check(self, top_n=10):
+        """Differences between the index and a brute-force recomputation: totals from the
+        activities it has applied, ranks and the first top_n of every top list from
+        sorting each cohort's totals. Returns a list of messages."""
+        self.ensure_loaded()
+        self.catch_up()
+        with self.lock:
+            first_week = self.first_week()
+            totals = {}
+            cohorts = {}
+            for key in self.database_keys():
+                with self.shards.use(key):
+                    totals.update(weekly_totals(first_week, up_to_id=self.high_water.get(key, 0),
+                                                skipped_ids=self.skipped.get(key, ())))
+                    cohorts.update(db.session.execute(
+                        select(Trait.user_id, Trait.user_type).where(Trait.user_type.isnot(None))).all())
+                    db.session.commit()
+
+            problems = []
+            for user_id, week in sorted(set(totals) | set(self.totals)):
+                expected, actual = totals.get((user_id, week)), self.totals.get((user_id, week))
+                if expected != actual:
+                    problems.append(f'user {user_id}, week of {date.fromordinal(week)}: total {actual}, recomputed {expected}')
+            for user_id in sorted({user_id for user_id, _ in totals}):
+                if self.cohorts.get(user_id) != cohorts.get(user_id):
+                    problems.append(f'user {user_id}: cohort {self.cohorts.get(user_id)!r}, trait says {cohorts.get(user_id)!r}')
+
+            ranked = {}
+            for (user_id, week), total in totals.items():
+                if cohorts.get(user_id) is not None:
+                    for metric, tree_key in metric_keys(user_id, total):
+                        ranked.setdefault((cohorts[user_id], week, metric), []).append(tree_key)
+            for key in set(self.trees) - set(ranked):
+                if len(self.trees[key]):
+                    problems.append(f'{key}: {len(self.trees[key])} users ranked, none recomputed')
+            for (cohort, week, metric), tree_keys in ranked.items():
+                tree_keys.sort()
+                values = [tree_key // KEY_SCALE for tree_key in tree_keys]
+                expected_top = []
+                for tree_key in tree_keys:
+                    user_id = tree_key % KEY_SCALE
+                    value = metric_value(metric, tree_key)
+                    rank = bisect_left(values, tree_key // KEY_SCALE) + 1
+                    if len(expected_top) < top_n:
+                        expected_top.append((rank, user_id, value))
+                    expected = rank_body(value, rank, len(tree_keys))
+                    actual = self._standing(user_id, cohort, week)[metric]
+                    if expected != actual:
+                        problems.append(f'user {user_id}, {cohort} {metric} week of {date.fromordinal(week)}: {actual}, by sorting {expected}')
+                actual_top = self._top(cohort, week, metric, 0, top_n)
+                if actual_top != (len(tree_keys), expected_top):
+                    problems.append(f'{cohort} {metric} week of {date.fromordinal(week)}: top {actual_top}, by sorting {expected_top}')
+            return problems
+
+    # --- Snapshots ---
+
+    def save(self):
+        """Write each database's snapshot."""
+        with self.lock:
+            totals = list(self.totals.items())
+            high_water = dict(self.high_water)
+            skipped = {key: sorted(ids) for key, ids in self.skipped.items()}
+            self.changed = False
+        by_key = {key: [] for key in self.database_keys()}
+        for item in totals:
+            by_key[self.shards.shard_of(item[0][0])].append(item)
+        saved_at = datetime.utcnow()
+        for key, key_totals in by_key.items():
+            with self.shards.use(key):
+                db.session.merge(RankingSnapshot(id=1, last_activity_id=high_water.get(key, 0), saved_at=saved_at,
+                                                 pending_activity_ids=skipped.get(key) or None,
+                                                 totals=pack_totals(key_totals)))
+                db.session.commit()
+
+    def _save_if_changed(self):
+        if self.changed:
+            with self.app.app_context():
+                try:
+                    self.save()
+                except Exception:
+                    logger.exception('Saving the rankings snapshot failed')
+
+    def _save_periodically(self):
+        while True:
+            time.sleep(self.snapshot_seconds)
+            self._save_if_changed()
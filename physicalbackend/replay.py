@@ -0,0 +1,289 @@
+# replay.py
+# Offline replay of the goal adaptation in server.py (adapt_goal) over the stored
+# activity history, for many parameter sets at once.
+#
+# Activities are streamed in (user_id, start_time) order and simulated in chunks of
+# complete user histories. Within a chunk every user and every parameter set advances
+# one run per step: the recent-runs window is a (users, window) array, and success
+# ratios and consecutive failures of all parameter sets are computed with NumPy.
+#
+# The replay follows runs in start_time order. That is the order adapt_goal sees them
+# in when runs are uploaded as they happen (batch uploads are sorted by start_time too);
+# late uploads of older runs are evaluated online against a different window.
+import itertools
+import math
+
+import numpy as np
+from sqlalchemy import select
+
+from archive import activities_select
+from database import db, Trait
+
+REPLAY_CHUNK_SIZE = 200000
+REPLAY_FETCH_SIZE = 10000
+
+# Tunable parameters of adapt_goal; defaults come from the constants in server.py
+PARAMETER_NAMES = [
+    'window', 'ratio_upgrade_speed', 'ratio_upgrade_length',
+    'pace_upgrade_step', 'dist_upgrade_step', 'pace_downgrade_step', 'dist_downgrade_step',
+    'max_pace', 'min_dist',
+]
+
+# Columns of the chunk arrays
+USER_ID, ACTIVITY_ID, PACE, DIST, GOAL_PACE, GOAL_DIST = range(6)
+
+
+def parameter_grid(defaults, grid):
+    """Parameter sets for every combination of the grid values, e.g. grid entries
+    'window=5,10' and 'ratio_upgrade_speed=0.5,0.6' give four sets. Raises ValueError."""
+    axes = []
+    for item in grid:
+        name, _, values = item.partition('=')
+        name = name.strip().replace('-', '_')
+        if name not in defaults:
+            raise ValueError(f"Unknown parameter '{name}', expected one of: {', '.join(PARAMETER_NAMES)}")
+        cast = type(defaults[name])
+        try:
+            axes.append([(name, cast(value)) for value in values.split(',') if value.strip()])
+        except ValueError:
+            raise ValueError(f"Invalid values for '{name}': {values}")
+    return [dict(defaults, **dict(combination)) for combination in itertools.product(*axes)]
+
+
+def iter_user_chunks(chunk_size=REPLAY_CHUNK_SIZE, user_id=None):
+    """Yield float arrays (rows, 6) of complete user histories, about chunk_size rows
+    each, runs of every user in chronological order. Missing goals are NaN."""
+    def build(model):
+        statement = select(
+            model.user_id, model.id, model.average_pace_seconds_per_km,
+            model.distance_km, model.goal_pace, model.goal_dist, model.start_time,
+        )
+        return statement if user_id is None else statement.where(model.user_id == user_id)
+
+    # Newest first matches ix_activity_user_id_start_time; each chunk is reversed below.
+    # Archived activities are merged in.
+    statement = activities_select(build, order_by=('user_id', '-start_time', '-id'))
+
+    rows = []
+    last_user_id = None
+    for row in db.session.execute(statement.execution_options(yield_per=REPLAY_FETCH_SIZE)):
+        if row[0] != last_user_id and len(rows) >= chunk_size:
+            yield np.array(rows, dtype=np.float64)[::-1]
+            rows = []
+        last_user_id = row[0]
+        # start_time is only selected for the ordering
+        rows.append(tuple(row[:GOAL_DIST + 1]))
+    if rows:
+        yield np.array(rows, dtype=np.float64)[::-1]
+
+
+def load_goals():
+    """user_id -> (long pace, long dist, current pace, current dist) of every trait with goals."""
+    goals = {}
+    for user_id, long_goal, curr_goal in db.session.execute(select(Trait.user_id, Trait.long_goal, Trait.curr_goal)):
+        if long_goal and curr_goal:
+            goals[user_id] = (long_goal['pace'], long_goal['dist'], curr_goal.get('pace'), curr_goal.get('dist'))
+    return goals
+
+
+def round_1(values):
+    """Python's round(x, 1) elementwise; np.round differs on some halfway cases."""
+    rounded = np.round(values, 1)
+    scaled = values * 10
+    halfway = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if halfway.any():
+        rounded[halfway] = [round(value, 1) for value in values[halfway]]
+    return rounded
+
+
+def leading_failures(success, valid):
+    """Consecutive failures at the start of the window (valid runs only), per row."""
+    return (valid & (np.cumsum(success, axis=-1) == 0)).sum(axis=-1)
+
+
+class GoalReplay:
+    """Replays adapt_goal for parameter sets params (dicts with PARAMETER_NAMES keys).
+
+    With recorded_goals the goal of every evaluation is the one stored on the activity,
+    which reproduces the online goals exactly. Otherwise the simulated goal is fed back,
+    which is what the online goals would have been under other parameters.
+    """
+
+    def __init__(self, params, goals, recorded_goals=False, trajectory_writer=None):
+        self.params = params
+        self.goals = goals
+        self.recorded_goals = recorded_goals
+        self.trajectory_writer = trajectory_writer
+
+        def column(name):
+            return np.array([p[name] for p in params], dtype=np.float64)[:, None]
+
+        self.window = max(p['window'] for p in params)
+        self.slot_mask = np.arange(self.window)[None, :] < column('window')
+        self.ratio_speed, self.ratio_length = column('ratio_upgrade_speed'), column('ratio_upgrade_length')
+        self.pace_up, self.dist_up = column('pace_upgrade_step'), column('dist_upgrade_step')
+        self.pace_down, self.dist_down = column('pace_downgrade_step'), column('dist_downgrade_step')
+        self.max_pace, self.min_dist = column('max_pace'), column('min_dist')
+
+        size = len(params)
+        self.users = 0
+        self.activities = 0
+        self.evaluations = np.zeros(size, dtype=np.int64)
+        self.goals_met = np.zeros(size, dtype=np.int64)
+        self.changes = {key: np.zeros(size, dtype=np.int64)
+                        for key in ('pace_upgrades', 'dist_upgrades', 'pace_downgrades', 'dist_downgrades')}
+        self.final_pace = []
+        self.final_dist = []
+        self.at_long_goal = np.zeros(size, dtype=np.int64)
+        self.mismatches = 0
+
+    def run(self, chunks):
+        for chunk in chunks:
+            self.replay_chunk(chunk)
+        return self
+
+    def replay_chunk(self, chunk):
+        self.activities += len(chunk)
+        boundaries = np.flatnonzero(np.diff(chunk[:, USER_ID])) + 1
+        offsets = np.concatenate(([0], boundaries))
+        counts = np.diff(np.concatenate((offsets, [len(chunk)])))
+        user_ids = chunk[offsets, USER_ID].astype(np.int64)
+
+        # Evaluation starts with the first run made with a goal, i.e. after the questionnaire
+        has_goal = (chunk[:, GOAL_PACE] > 0) & (chunk[:, GOAL_DIST] > 0)
+        first_goal = np.minimum.reduceat(np.where(has_goal, np.arange(len(chunk)), len(chunk)), offsets)
+        keep = np.array([uid in self.goals for uid in user_ids.tolist()], dtype=bool) & (first_goal < offsets + counts)
+        if not keep.any():
+            return
+        # Longest histories first, so the users still active at step k are a prefix
+        order = np.flatnonzero(keep)[np.argsort(-counts[keep], kind='stable')]
+        user_ids, offsets, counts, first_goal = user_ids[order], offsets[order], counts[order], first_goal[order] - offsets[order]
+        user_goals = np.array([self.goals[uid] for uid in user_ids.tolist()], dtype=np.float64)
+        long_pace, long_dist = user_goals[:, 0], user_goals[:, 1]
+        self.users += len(user_ids)
+
+        size, users = len(self.params), len(user_ids)
+        goal_pace = np.repeat(chunk[offsets + first_goal, GOAL_PACE][None, :], size, axis=0)
+        goal_dist = np.repeat(chunk[offsets + first_goal, GOAL_DIST][None, :], size, axis=0)
+        # Newest run in slot 0, like Trait.recent_runs
+        window_pace = np.zeros((users, self.window))
+        window_dist = np.zeros((users, self.window))
+        window_valid = np.zeros((users, self.window), dtype=bool)
+
+        for step in range(int(counts[0])):
+            active = int(np.count_nonzero(counts > step))
+            rows = chunk[offsets[:active] + step]
+            pace, dist = rows[:, PACE], rows[:, DIST]
+            window_pace[:active, 1:] = window_pace[:active, :-1]
+            window_dist[:active, 1:] = window_dist[:active, :-1]
+            window_valid[:active, 1:] = window_valid[:active, :-1]
+            window_pace[:active, 0] = pace
+            window_dist[:active, 0] = dist
+            window_valid[:active, 0] = (pace != 0) & (dist != 0) & ~np.isnan(pace) & ~np.isnan(dist)
+
+            evaluate = (step >= first_goal[:active]) & (pace != 0) & (dist != 0)
+            if self.recorded_goals:
+                evaluate &= ~np.isnan(rows[:, GOAL_PACE]) & ~np.isnan(rows[:, GOAL_DIST])
+            index = np.flatnonzero(evaluate)
+            if len(index):
+                self.evaluate(index, rows[index], user_ids, long_pace, long_dist, goal_pace, goal_dist,
+                              window_pace[index], window_dist[index], window_valid[index])
+
+        self.final_pace.append(goal_pace)
+        self.final_dist.append(goal_dist)
+        self.at_long_goal += ((goal_pace <= long_pace) & (goal_dist >= long_dist)).sum(axis=1)
+        stored = user_goals[:, 2:].copy()
+        stored[np.isnan(stored)] = -1
+        self.mismatches += int(np.count_nonzero(
+            ~np.isclose(goal_pace[0], stored[:, 0]) | ~np.isclose(goal_dist[0], stored[:, 1])))
+
+    def evaluate(self, index, rows, user_ids, long_pace, long_dist, goal_pace, goal_dist, window_pace, window_dist, window_valid):
+        """One adapt_goal call for each user in index, for all parameter sets at once."""
+        if self.recorded_goals:
+            current_pace = np.broadcast_to(rows[:, GOAL_PACE], (len(self.params), len(index)))
+            current_dist = np.broadcast_to(rows[:, GOAL_DIST], (len(self.params), len(index)))
+        else:
+            current_pace, current_dist = goal_pace[:, index], goal_dist[:, index]
+
+        # (params, users, window)
+        valid = window_valid[None, :, :] & self.slot_mask[:, None, :]
+        faster = (window_pace[None, :, :] < current_pace[:, :, None]) & valid
+        longer = (window_dist[None, :, :] >= current_dist[:, :, None]) & valid
+        runs = valid.sum(axis=-1)
+
+        # runs is only 0 for window=0, where adapt_goal changes nothing either
+        with np.errstate(invalid='ignore'):
+            pace_upgrade = (faster.sum(axis=-1) / runs >= self.ratio_speed) & faster[:, :, 0]
+            dist_upgrade = (longer.sum(axis=-1) / runs >= self.ratio_length) & longer[:, :, 0]
+        pace_failures = leading_failures(faster, valid)
+        dist_failures = leading_failures(longer, valid)
+        pace_downgrade = pace_failures > 1
+        dist_downgrade = dist_failures > 1
+
+        # An upgrade needs the newest run to succeed and a downgrade needs it to fail, so
+        # at most one of them applies per goal, as in adapt_goal
+        new_pace = np.where(pace_upgrade, np.maximum(current_pace - self.pace_up, long_pace[index]), goal_pace[:, index])
+        new_pace = np.where(pace_downgrade, np.minimum(current_pace + (pace_failures - 1) * self.pace_down, self.max_pace), new_pace)
+        new_dist = np.where(dist_upgrade, np.minimum(round_1(current_dist + self.dist_up), long_dist[index]), goal_dist[:, index])
+        new_dist = np.where(dist_downgrade, np.maximum(current_dist - (dist_failures - 1) * self.dist_down, self.min_dist), new_dist)
+        goal_pace[:, index] = new_pace
+        goal_dist[:, index] = new_dist
+
+        self.evaluations += len(index)
+        self.goals_met += ((rows[:, PACE] <= current_pace) & (rows[:, DIST] >= current_dist)).sum(axis=1)
+        self.changes['pace_upgrades'] += pace_upgrade.sum(axis=1)
+        self.changes['dist_upgrades'] += dist_upgrade.sum(axis=1)
+        self.changes['pace_downgrades'] += pace_downgrade.sum(axis=1)
+        self.changes['dist_downgrades'] += dist_downgrade.sum(axis=1)
+
+        if self.trajectory_writer is not None:
+            activity_ids = rows[:, ACTIVITY_ID].astype(np.int64).tolist()
+            index_user_ids = user_ids[index].tolist()
+            for param_set in range(len(self.params)):
+                self.trajectory_writer.writerows(zip(
+                    itertools.repeat(param_set), index_user_ids, activity_ids,
+                    new_dist[param_set].tolist(), new_pace[param_set].tolist()))
+
+    def summary(self):
+        """Per parameter set: change counts, share of runs meeting their goal and final goals."""
+        final_pace = np.concatenate(self.final_pace, axis=1) if self.final_pace else np.zeros((len(self.params), 0))
+        final_dist = np.concatenate(self.final_dist, axis=1) if self.final_dist else np.zeros((len(self.params), 0))
+        results = []
+        for param_set, params in enumerate(self.params):
+            evaluations = int(self.evaluations[param_set])
+            result = {
+                'param_set': param_set,
+                'params': params,
+                'evaluations': evaluations,
+                'goal_met_rate': round(int(self.goals_met[param_set]) / evaluations, 4) if evaluations else None,
+            }
+            result.update({key: int(value[param_set]) for key, value in self.changes.items()})
+            if self.users:
+                result.update({
+                    'final_pace_mean': round(float(final_pace[param_set].mean()), 2),
+                    'final_pace_median': float(np.median(final_pace[param_set])),
+                    'final_dist_mean': round(float(final_dist[param_set].mean()), 3),
+                    'final_dist_median': float(np.median(final_dist[param_set])),
+                    'users_at_long_goal': int(self.at_long_goal[param_set]),
+                })
+            results.append(result)
+        return {'users': self.users, 'activities': self.activities, 'param_sets': results}
+
+
+def format_summary(summary):
+    """Plain-text table of a GoalReplay summary."""
+    lines = [f"{summary['users']} users, {summary['activities']} activities", '']
+    # Only the parameters that differ between the sets
+    varied = [name for name in PARAMETER_NAMES
+              if len({result['params'][name] for result in summary['param_sets']}) > 1]
+    lines.append(f"{'set':>3s} {'evals':>9s} {'met':>6s} {'pace +/-':>15s} {'dist +/-':>15s} "
+                 f"{'pace':>7s} {'dist':>6s} {'at long goal':>12s}  params")
+    for result in summary['param_sets']:
+        met = result['goal_met_rate']
+        lines.append(
+            f"{result['param_set']:3d} {result['evaluations']:9d} {'-' if met is None else f'{met:.1%}':>6s} "
+            f"{result['pace_upgrades']:>7d}/{result['pace_downgrades']:<7d} {result['dist_upgrades']:>7d}/{result['dist_downgrades']:<7d} "
+            f"{result.get('final_pace_mean', math.nan):7.1f} {result.get('final_dist_mean', math.nan):6.2f} "
+            f"{result.get('users_at_long_goal', 0):12d}  "
+            + ' '.join(f"{name}={result['params'][name]}" for name in varied))
+    return '\n'.join(lines)
@@ -0,0 +1,79 @@
+# serialize.py
+# Fast path from result rows to JSON bytes for the activity payloads.
+#
+# row_serializer() compiles a response layout into one Python function that builds the
+# dict straight from a result row's positions: no per-row lookups of what each field
+# needs, no ORM objects. OrjsonProvider then encodes the dicts with orjson when it is
+# installed; without it the app keeps Flask's own JSON provider.
+import functools
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson  # optional dependency, several times faster than the json module
+except ImportError:
+    orjson = None
+
+
+@functools.lru_cache(maxsize=256)
+def row_serializer(keys, fields):
+    """Function turning a row of the columns named keys into a response dict.
+
+    fields is a tuple of (response name, column keys, convert): the field is
+    convert(*values of its columns), or the value of its one column when convert is
+    None. Both arguments must be hashable; compiled functions are kept per layout.
+    """
+    positions = {key: index for index, key in enumerate(keys)}
+    namespace = {}
+    items = []
+    for number, (name, columns, convert) in enumerate(fields):
+        values = ', '.join(f'row[{positions[column]}]' for column in columns)
+        if convert is None:
+            items.append(f'{name!r}: {values}')
+        else:
+            namespace[f'convert{number}'] = convert
+            items.append(f'{name!r}: convert{number}({values})')
+    source = 'def serialize(row):\n    return {' + ', '.join(items) + '}\n'
+    exec(compile(source, f'<row_serializer {",".join(keys)}>', 'exec'), namespace)
+    return namespace['serialize']
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider encoding with orjson. Output matches the default provider's
+    compact, key-sorted JSON, except that NaN and infinities become null and non-ASCII
+    text is written as UTF-8 instead of \\u escapes. Values orjson doesn't handle itself
+    go through the default provider's conversions (dates as HTTP dates etc.). Request
+    bodies are still parsed by the json module."""
+
+    def _options(self, kwargs):
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if kwargs.get('sort_keys', self.sort_keys):
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps(self, obj, **kwargs):
+        if set(kwargs) - {'sort_keys'}:
+            # indent, separators, cls, ... are json module options
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._options(kwargs)).decode()
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits
+            return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            # Indented output for debugging
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            body = orjson.dumps(obj, default=self.default, option=self._options({}) | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def init_json(app):
+    """Encode app's JSON responses with orjson when it is installed."""
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
@@ -1,44 +1,385 @@
 import os
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+import functools
+import logging
+import secrets
+import base64
+import binascii
 import json
-from datetime import datetime
+import math
+from datetime import datetime, timedelta, date
 import click # Import click for custom commands
-from sqlalchemy import desc, func
-from flask_sqlalchemy import SQLAlchemy
-import copy
-import re # Import re for regular expressions to parse questionnaire answers
-from datetime import datetime, timedelta
+from flask import Flask, Blueprint, current_app, request, jsonify, Response, stream_with_context, g
+from flask_cors import CORS
+from sqlalchemy import desc, func, or_, and_, case, insert, select
+from sqlalchemy.exc import IntegrityError
 
 # Import db and models from database.py
-from database import db, User, Activity, init_db_command, Trait
-from flask_cors import CORS
+from database import db, User, Activity, init_db_command, migrate_db_command, migrate_split_paces_command, Trait, DailyActivitySummary
+from database import MonthlyActivitySummary
+from database import backfill_change_seq_command, reserve_change_seqs
+from database import decode_split_paces, split_paces_columns, dialect_insert
+from cache import ResponseCache
+from jobs import PostWriteQueue
+from passwords import PasswordHasher, HasherBusy
+from auth import SessionTokens, UserContextCache, token_from_request, load_user_context
+from sharding import Shards
+import dbprofile
+from metrics import init_metrics, log_sampled, logger
+from export import iter_activity_rows, max_split_count, ndjson_lines, csv_lines, read_resume_state
+from geo import end_cell, add_cell_deltas, add_cell_count_deltas, record_end_cell, nearby_activities, heatmap_bins, rebuild_geo_cells
+from geo import HEATMAP_MIN_ZOOM, HEATMAP_MAX_ZOOM, HEATMAP_BIN_SHIFT, snap_to_tile, haversine_km
+from archive import activities_select, all_activities, same_columns, archive_activities, ARCHIVE_MIN_AGE_DAYS
+from questionnaire import QuestionnaireRules, upsert_traits, read_questionnaires
+from serialize import row_serializer, init_json
+from compression import Compressor
+from rankings import RankingIndex, METRICS, week_of
 
 # Constants for updating performance
 PAST_ACCESS_ACT_NUM = 10
 RATIO_UPGRADE_SPEED = 0.5
 RATIO_UPGRADE_LENGTH = 0.7
+# Goal steps: upgrades per successful run, downgrades per consecutive failure after the first
+PACE_UPGRADE_STEP = 15
+DIST_UPGRADE_STEP = 1.0
+PACE_DOWNGRADE_STEP = 10
+DIST_DOWNGRADE_STEP = 0.5
+MIN_GOAL_DIST = 1.0
 
 # Define maximum allowed pace in seconds/km (9 min 59 sec/km)
 MAX_PACE_SECONDS_PER_KM = 599
 
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app) # Enable CORS for all routes
-
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Initialize db with the Flask app
-db.init_app(app)
+# Questionnaire answers -> initial trait, rule tables compiled once (see questionnaire.py)
+questionnaire_rules = QuestionnaireRules(MAX_PACE_SECONDS_PER_KM)
+
+# HTTP routes and CLI commands; create_app() registers both on the app it builds
+api = Blueprint('api', __name__)
+commands = Blueprint('commands', __name__, cli_group=None)
+
+# Per-process services, bound to the app and its settings by create_app()
+shards = Shards()
+compressor = Compressor()
+response_cache = ResponseCache()
+password_hasher = PasswordHasher()
+session_tokens = SessionTokens()
+user_contexts = UserContextCache(response_cache.get_version)
+rankings = RankingIndex(shards)
+
+
+def load_config(app):
+    """Read the settings from the environment into app.config."""
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO')
+
+    # Opt-in sharding: SHARD_DATABASE_URLS is a comma-separated list of database URLs.
+    # Users are spread over them by user_id; DATABASE_URL then only keeps the user directory.
+    app.config['SHARD_DATABASE_URLS'] = [url.strip() for url in os.environ.get('SHARD_DATABASE_URLS', '').split(',') if url.strip()]
+
+    # Connection tuning: DATABASE_PROFILE=production enables WAL etc. for SQLite and
+    # pool settings for PostgreSQL (see dbprofile.py)
+    dbprofile.load_config(app)
+
+    # Latency / SQL / size metrics at /metrics, slow requests logged with their queries
+    app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500))
+
+    # Negotiated br/gzip compression of JSON/CSV bodies of at least COMPRESS_MIN_BYTES.
+    # COMPRESS_ENCODINGS lists the encodings offered, in order of preference ('' disables).
+    app.config['COMPRESS_MIN_BYTES'] = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+    app.config['COMPRESS_GZIP_LEVEL'] = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+    app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+    app.config['COMPRESS_ENCODINGS'] = [e.strip() for e in os.environ.get('COMPRESS_ENCODINGS', 'br,gzip').split(',') if e.strip()]
+
+    # Response cache for the polled per-user endpoints. In-process by default;
+    # set RESPONSE_CACHE_URL (redis://...) to share it between worker processes.
+    app.config['RESPONSE_CACHE_URL'] = os.environ.get('RESPONSE_CACHE_URL')
+    app.config['RESPONSE_CACHE_MAX_BYTES'] = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+
+    # Password hashing runs on a process pool. PASSWORD_HASH_METHOD is a werkzeug method
+    # with cost parameters; stored hashes made with other parameters are upgraded at login.
+    # Beyond PASSWORD_HASH_MAX_PENDING queued hashes, /login and /register answer 503.
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+    app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 4 * app.config['PASSWORD_HASH_WORKERS'] or 4))
+    app.config['PASSWORD_HASH_RETRY_AFTER'] = int(os.environ.get('PASSWORD_HASH_RETRY_AFTER', 1))
+
+    # --- Sessions ---
+    # /login issues a signed token. Requests may send it as "Authorization: Bearer <token>";
+    # it must then belong to the user the request is for. Requests without one are still
+    # accepted, as the app identifies users by user_id.
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    app.config['SESSION_TOKEN_MAX_AGE'] = int(os.environ.get('SESSION_TOKEN_MAX_AGE', 30 * 24 * 3600))
+    # Off by default: the app doesn't send tokens yet, so without one any user_id is accepted
+    app.config['REQUIRE_SESSION_TOKEN'] = os.environ.get('REQUIRE_SESSION_TOKEN', '').lower() in ('1', 'true', 'yes')
+
+    # User + trait per user, cached until the user's data version changes (every write bumps it)
+    app.config['USER_CONTEXT_TTL_SECONDS'] = int(os.environ.get('USER_CONTEXT_TTL_SECONDS', 300))
+    app.config['USER_CONTEXT_MAX_ENTRIES'] = int(os.environ.get('USER_CONTEXT_MAX_ENTRIES', 10000))
+
+    # Cold storage: `flask archive-activities` moves activities older than ARCHIVE_AFTER_DAYS
+    # (at least ARCHIVE_MIN_AGE_DAYS) out of the activity table (see archive.py)
+    app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+
+    # Goal adaptation runs on a small worker pool after the activity is committed.
+    # POST_WRITE_WORKERS=0 runs it inline in the request instead.
+    app.config['POST_WRITE_WORKERS'] = int(os.environ.get('POST_WRITE_WORKERS', 2))
+    app.config['POST_WRITE_QUEUE_SIZE'] = int(os.environ.get('POST_WRITE_QUEUE_SIZE', 1000))
+
+    # Where users stand in their cohort (Trait.user_type) over the last RANKING_WEEKS weeks,
+    # kept up to date in memory and saved every RANKING_SNAPSHOT_SECONDS (see rankings.py)
+    app.config['RANKING_WEEKS'] = int(os.environ.get('RANKING_WEEKS', 4))
+    app.config['RANKING_SNAPSHOT_SECONDS'] = int(os.environ.get('RANKING_SNAPSHOT_SECONDS', 300))
+    # Cohorts changed by other worker processes are re-read this often (0: on every read)
+    app.config['RANKING_COHORT_SECONDS'] = int(os.environ.get('RANKING_COHORT_SECONDS', 5))
+
+    # Opt-in warm-up at startup (see warm_up()): connections opened per database, 0 for none
+    app.config['DATABASE_PREWARM_CONNECTIONS'] = int(os.environ.get('DATABASE_PREWARM_CONNECTIONS', 0))
+
+
+def create_app(config=None):
+    """Build the app: settings from the environment, overridden by the config dict, the
+    services above bound to it and the routes and commands registered.
+
+    The services are per process, so a process serves one app at a time."""
+    app = Flask(__name__)
+    load_config(app)
+    app.config.update(config or {})
+
+    CORS(app) # Enable CORS for all routes
+    # JSON bodies are encoded with orjson when it is installed (see serialize.py)
+    init_json(app)
+
+    # Levelled logging instead of prints; LOG_LEVEL=DEBUG shows per-request details
+    logging.basicConfig(level=app.config['LOG_LEVEL'], format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    shards.init_app(app)
+    dbprofile.configure(app)
+    db.init_app(app)
+    dbprofile.init_app(app, db)
+
+    init_metrics(app)
+    # After init_metrics, so the size metric sees the compressed bodies
+    compressor.init_app(app)
+
+    if not app.config['SECRET_KEY']:
+        logger.warning('SECRET_KEY is not set; session tokens will not survive a restart or work across workers')
+        app.config['SECRET_KEY'] = secrets.token_hex(32)
+    response_cache.init_app(app)
+    password_hasher.init_app(app)
+    session_tokens.init_app(app)
+    user_contexts.init_app(app)
+    post_write_queue.init_app(app)
+    rankings.init_app(app)
+
+    app.register_blueprint(api)
+    app.register_blueprint(commands)
+
+    if app.config['DATABASE_PREWARM_CONNECTIONS']:
+        warm_up(app)
+    return app
+
+
+def warm_up(app):
+    """Do the work of a process's first requests ahead of them: configure the ORM mappers,
+    compile the statements of the per-user reads and the user context, and open
+    DATABASE_PREWARM_CONNECTIONS connections to each database (at most its pool size).
+    Run it in the process that will serve, i.e. after a fork."""
+    with app.app_context():
+        dbprofile.warm_pools(db, app.config['DATABASE_PREWARM_CONNECTIONS'])
+        # User 0 doesn't exist: each read compiles and runs its statement, returning nothing
+        for _ in shards.each():
+            load_user_context(0)
+            for statement, _ in (activities_read(0, {}), activities_read(0, {'limit': '1'}),
+                                 activity_changes_read(0, {}), past_week_read(0, {}), calendar_read(0, {})):
+                db.session.execute(statement).all()
+
+
+@api.app_errorhandler(HasherBusy)
+def password_hasher_busy(error):
+    return jsonify({'message': 'Server busy, please retry'}), 503, {'Retry-After': str(current_app.config['PASSWORD_HASH_RETRY_AFTER'])}
+
+def authorize(user_id):
+    """Error response if the request's session token is missing (with REQUIRE_SESSION_TOKEN),
+    invalid or belongs to another user, else None."""
+    denial = session_tokens.denial(token_from_request(), user_id)
+    if denial is not None:
+        message, status = denial
+        return jsonify({'message': message}), status
+    return None
+
+@api.before_app_request
+def check_session_token():
+    # Routes with user_id in the URL; views taking it from the body call authorize() themselves.
+    # Runs before the response cache, so cached responses are covered too.
+    user_id = (request.view_args or {}).get('user_id')
+    if user_id is not None:
+        shards.activate(user_id)
+        return authorize(user_id)
+
+def with_user_context(view):
+    """Resolve user_id to g.user_context (404 if there is no such user).
+
+    Place it below response_cache.cached, so the context is read after the cache key's version.
+    """
+    @functools.wraps(view)
+    def wrapper(user_id, **kwargs):
+        g.user_context = user_contexts.get(user_id)
+        if g.user_context is None:
+            return jsonify({'message': 'User not found'}), 404
+        return view(user_id, **kwargs)
+    return wrapper
 
 # --- Custom Flask CLI Command for Database Initialization ---
-# Register the init_db_command with the Flask app's CLI
-app.cli.add_command(click.command("init-db")(init_db_command))
+# Register the init_db_command with the Flask app's CLI; with sharding they run on every shard
+@commands.cli.command('init-db')
+def init_db():
+    """Clear existing data and create new tables."""
+    shards.create_directory()
+    shards.fan_out(init_db_command)()
+    for _ in shards.each():
+        shards.interleave_activity_ids()
+
+@commands.cli.command('migrate-db')
+def migrate_db():
+    """Bring an existing database up to date with the models without touching data."""
+    shards.create_directory()
+    shards.fan_out(migrate_db_command)()
+    for _ in shards.each():
+        shards.interleave_activity_ids()
+
+@commands.cli.command('renumber-activities')
+def renumber_activities():
+    """Make activity ids unique across shards again: renumber the activities each shard
+    stored before ids were interleaved. Run it with the server stopped."""
+    if not shards.enabled:
+        raise click.ClickException('Sharding is not enabled; activity ids are already unique')
+    for key in shards.each():
+        click.echo(f'[{key}] renumbered {shards.renumber_activities()} activities')
+    click.echo('Run `flask rebuild-rankings` before starting the server.')
+
+commands.cli.add_command(click.command("migrate-split-paces")(shards.fan_out(migrate_split_paces_command)))
+commands.cli.add_command(click.command("backfill-change-seq")(shards.fan_out(backfill_change_seq_command)))
+
+# --- Post-write work ---
+# Upper bound on how long a read waits for the user's queued work
+POST_WRITE_WAIT_SECONDS = 5
+
+def wait_for_post_write(view):
+    """Make a per-user GET view read-your-writes: wait for that user's queued work first."""
+    @functools.wraps(view)
+    def wrapper(user_id, **kwargs):
+        post_write_queue.wait_for_user(user_id, timeout=POST_WRITE_WAIT_SECONDS)
+        return view(user_id, **kwargs)
+    wrapper.waits_for_post_write = True
+    return wrapper
+
+# --- Activity listing helpers ---
+
+ACTIVITY_REQUIRED_FIELDS = ['start_time', 'duration_seconds', 'distance_km', 'average_pace_seconds_per_km']
+
+# Numeric activity fields: required ones may not be null, optional ones may be
+ACTIVITY_NUMBER_FIELDS = {
+    'duration_seconds': True,
+    'distance_km': True,
+    'average_pace_seconds_per_km': True,
+    'end_latitude': False,
+    'end_longitude': False,
+    'goal_dist': False,
+    'goal_pace': False,
+}
+
+# Upper bound on items accepted by POST /activities/batch
+MAX_BATCH_SIZE = 1000
+
+def is_user_id(value):
+    """Whether value is a user id as sent in JSON bodies (an int, but not a bool)."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def activity_field_error(item):
+    """Message for the first field of an activity that can't be stored, or None."""
+    for field, required in ACTIVITY_NUMBER_FIELDS.items():
+        value = item.get(field)
+        if value is None and not required:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            return f'Invalid value for {field}: expected a number'
+    if not isinstance(item.get('goal_state'), (str, type(None))):
+        return 'Invalid value for goal_state: expected a string'
+    if not isinstance(item.get('split_paces', []), list):
+        return 'Invalid value for split_paces: expected a list'
+    return None
+
+# Page size for GET /activities/<user_id> when a limit or cursor is given
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Response field -> columns that back it
+ACTIVITY_FIELD_COLUMNS = {
+    'id': [Activity.id],
+    'user_id': [Activity.user_id],
+    'start_time': [Activity.start_time],
+    'duration_seconds': [Activity.duration_seconds],
+    'distance_km': [Activity.distance_km],
+    'end_latitude': [Activity.end_latitude],
+    'end_longitude': [Activity.end_longitude],
+    'average_pace_seconds_per_km': [Activity.average_pace_seconds_per_km],
+    'split_paces': [Activity.split_paces_blob, Activity.split_paces_json],
+    'goal_state': [Activity.goal_state],
+    'goal_dist': [Activity.goal_dist],
+    'goal_pace': [Activity.goal_pace],
+}
+
+def split_paces_or_empty(split_paces_blob, split_paces_json):
+    return decode_split_paces(split_paces_blob, split_paces_json) or []
+
+# Response field -> function of its columns' values; other fields are their column's value
+ACTIVITY_FIELD_CONVERTERS = {
+    'start_time': datetime.isoformat,
+    'split_paces': split_paces_or_empty,
+}
+
+# /activities/past_week keeps the layout of Activity.to_dict(): splits under
+# split_paces_json, null when there are none
+PAST_WEEK_FIELD_OVERRIDES = {'split_paces': ('split_paces_json', decode_split_paces)}
+
+def activity_serializer(columns, fields, overrides=None):
+    """Compiled function building the response dict of fields from a row of columns;
+    splits are only decoded if requested. overrides: field -> (response name, convert)."""
+    specs = []
+    for field in fields:
+        name, convert = (overrides or {}).get(field, (field, ACTIVITY_FIELD_CONVERTERS.get(field)))
+        specs.append((name, tuple(column.key for column in ACTIVITY_FIELD_COLUMNS[field]), convert))
+    return row_serializer(tuple(column.key for column in columns), tuple(specs))
+
+def local_day_range(target_date, tz_offset_minutes=0):
+    """Half-open [start, end) bounds on stored start_time covering one calendar day.
+
+    start_time is compared as stored. Pass the caller's UTC offset in minutes when
+    the stored times are UTC and the day should be the caller's local day.
+    """
+    start = datetime.combine(target_date, datetime.min.time()) - timedelta(minutes=tz_offset_minutes)
+    return start, start + timedelta(days=1)
+
+def first_of_next_month(day):
+    if day.month == 12:
+        return date(day.year + 1, 1, 1)
+    return date(day.year, day.month + 1, 1)
+
+def encode_activity_cursor(start_time, activity_id):
+    raw = f"{start_time.isoformat()}|{activity_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_activity_cursor(cursor):
+    """Inverse of encode_activity_cursor. Raises ValueError on malformed input."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        time_str, id_str = raw.rsplit('|', 1)
+        return datetime.fromisoformat(time_str), int(id_str)
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
 
 # --- API Endpoints ---
 
-@app.route('/register', methods=['POST'])
+@api.route('/register', methods=['POST'])
 def register():
     data = request.get_json()
     username = data.get('username')
@@ -48,59 +389,109 @@ def register():
     if not username or not password:
         return jsonify({'message': 'Username and password are required'}), 400
 
-    if User.query.filter_by(username=username).first():
+    if shards.enabled:
+        # Usernames are global: they are checked and claimed in the user directory
+        conflict = shards.directory_conflict(username, third_party_id)
+    else:
+        conflict = 'username' if User.query.filter_by(username=username).first() else None
+        if not conflict and third_party_id and User.query.filter_by(third_party_id=third_party_id).first():
+            conflict = 'third_party_id'
+    if conflict == 'username':
         return jsonify({'message': 'Username already exists'}), 409
-
-    if third_party_id and User.query.filter_by(third_party_id=third_party_id).first():
+    if conflict == 'third_party_id':
         return jsonify({'message': 'Third-party ID already linked to an account'}), 409
 
     new_user = User(username=username, third_party_id=third_party_id)
-    new_user.set_password(password)
-    db.session.add(new_user)
-    db.session.commit()
+    new_user.password_hash = password_hasher.hash(password)
+
+    if shards.enabled:
+        try:
+            new_user.id = shards.allocate_user_id(username, third_party_id)
+        except IntegrityError:
+            # Registered concurrently since the check above
+            return jsonify({'message': 'Username already exists'}), 409
+        shards.activate(new_user.id)
+        try:
+            db.session.add(new_user)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            shards.release_user_id(new_user.id)
+            raise
+    else:
+        db.session.add(new_user)
+        db.session.commit()
     
     return jsonify({'message': 'User registered successfully'}), 201
 
 
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
     username = data.get('username')
     password = data.get('password')
 
-    user = User.query.filter_by(username=username).first()
-
-    if user and user.check_password(password):
-        # In a real application, you would return a JWT or session token here
-        return jsonify({'message': 'Login successful', 'user_id': user.id}), 200
+    if shards.enabled:
+        user_id = shards.user_id_for(username)
+        user = None
+        if user_id is not None:
+            shards.activate(user_id)
+            user = db.session.get(User, user_id)
+    else:
+        user = User.query.filter_by(username=username).first()
+
+    if user and password_hasher.verify(user.password_hash, password):
+        # Upgrade hashes made with older cost parameters while we have the password
+        if password_hasher.needs_rehash(user.password_hash):
+            try:
+                user.password_hash = password_hasher.hash(password)
+                db.session.commit()
+            except HasherBusy:
+                pass  # try again at the next login
+        return jsonify({'message': 'Login successful', 'user_id': user.id, 'token': session_tokens.issue(user.id)}), 200
     return jsonify({'message': 'Invalid credentials'}), 401
 
 # add one act at once
-@app.route('/activities', methods=['POST'])
+@api.route('/activities', methods=['POST'])
 def add_activity():
     data = request.get_json()
 
-    # In a real app, authenticate the user and get their user_id from the session/token
-    # For simplicity, we'll assume user_id is provided in the request body for now.
-    # You'd likely get this from a JWT or session.
+    # user_id comes from the body; a session token, if sent, must match it
     user_id = data.get('user_id')
-    
-    if not user_id or not User.query.get(user_id):
+    if user_id is not None:
+        # Older app builds send it as a string
+        try:
+            if isinstance(user_id, bool):
+                raise ValueError(user_id)
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return jsonify({'message': 'Invalid user_id'}), 400
+    denied = authorize(user_id)
+    if denied:
+        return denied
+
+    if user_id:
+        shards.activate(user_id)
+    if not user_id or not user_contexts.get(user_id):
         return jsonify({'message': 'User not found or not authenticated'}), 404
     
     # Validate required fields
-    required_fields = ['start_time', 'duration_seconds', 'distance_km', 'average_pace_seconds_per_km']
-    for field in required_fields:
+    for field in ACTIVITY_REQUIRED_FIELDS:
         if field not in data:
             return jsonify({'message': f'Missing field: {field}'}), 400
 
     try:
         # Convert start_time string to datetime object
         start_time = datetime.fromisoformat(data['start_time'])
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid date format for start_time. Use ISO format (YYYY-MM-DDTHH:MM:SS)'}), 400
+    field_error = activity_field_error(data)
+    if field_error:
+        return jsonify({'message': field_error}), 400
 
-        # Convert split_paces list to JSON string
-        split_paces_json_data = data.get('split_paces', [])
-        split_paces_json_string = json.dumps(split_paces_json_data)
+    try:
+        cell = end_cell(data.get('end_latitude'), data.get('end_longitude'))
+        change_seq = reserve_change_seqs(user_id)
 
         new_activity = Activity(
             user_id=user_id,
@@ -110,346 +501,806 @@ def add_activity():
             end_latitude=data.get('end_latitude'),
             end_longitude=data.get('end_longitude'),
             average_pace_seconds_per_km=data['average_pace_seconds_per_km'],
-            split_paces_json=split_paces_json_string,
+            # Packed binary when possible, JSON string otherwise
+            **split_paces_columns(data.get('split_paces', [])),
             goal_state = data.get('goal_state'),
             goal_dist = data.get('goal_dist'),
-            goal_pace = data.get('goal_pace')
+            goal_pace = data.get('goal_pace'),
+            change_seq = change_seq,
+            end_cell = cell
         )
+        # After reserve_change_seqs above (see Shards.new_activity_ids)
+        new_ids = shards.new_activity_ids(1)
+        if new_ids:
+            new_activity.id = new_ids[0]
         db.session.add(new_activity)
+        db.session.flush()
+        activity_id = new_activity.id
+        record_daily_summary(user_id, start_time, new_activity.goal_state, new_activity.distance_km, new_activity.duration_seconds)
+        record_end_cell(cell)
         db.session.commit()
+        response_cache.bump(user_id)
+        rankings.after_insert(shards.shard_of(user_id))
 
-        # update goal
-        if data['distance_km'] != 0 and data['average_pace_seconds_per_km'] != 0:
-            update_trait_after_run(user_id, data.get('goal_dist'), data.get('goal_pace'))
+        # update goal in the background
+        post_write_queue.submit(user_id, [change_seq])
 
-        return jsonify({'message': 'Activity added successfully', 'activity_id': new_activity.id}), 201
-    except ValueError:
-        return jsonify({'message': 'Invalid date format for start_time. Use ISO format (YYYY-MM-DDTHH:MM:SS)'}), 400
-    except Exception as e:
+        return jsonify({'message': 'Activity added successfully', 'activity_id': activity_id}), 201
+    except Exception:
         db.session.rollback()
-        return jsonify({'message': f'Error adding activity: {str(e)}'}), 500
-
-@app.route('/activities/<int:user_id>', methods=['GET'])
-def get_user_activities(user_id):
-    user = User.query.get(user_id)
-    if not user:
-        return jsonify({'message': 'User not found'}), 404
-
-    activities = Activity.query.filter_by(user_id=user_id).order_by(Activity.start_time.desc()).all()
-
-    output = []
-    for activity in activities:
-        # Convert split_paces_json back to list/object for frontend
-        split_paces = json.loads(activity.split_paces_json) if activity.split_paces_json else []
-
-        output.append({
-            'id': activity.id,
-            'user_id': activity.user_id,
-            'start_time': activity.start_time.isoformat(),  # Convert datetime to ISO string
-            'duration_seconds': activity.duration_seconds,
-            'distance_km': activity.distance_km,
-            'end_latitude': activity.end_latitude,
-            'end_longitude': activity.end_longitude,
-            'average_pace_seconds_per_km': activity.average_pace_seconds_per_km,
-            'split_paces': split_paces,
-            'goal_state': activity.goal_state, # Include goal_state
-            'goal_dist': activity.goal_dist,   # Include goal_dist
-            'goal_pace': activity.goal_pace    # Include goal_pace
+        # The details (SQL, parameters) go to the log, not to the client
+        logger.exception('Error adding activity for user %s', user_id)
+        return jsonify({'message': 'Error adding activity'}), 500
+
+def insert_activity_rows(rows):
+    """Insert activity rows (column dicts) with change sequence numbers, daily rollups and
+    heatmap counters. Returns the new ids in row order. Caller commits."""
+    # Sequence numbers per user, by start_time: the order goal adaptation folds them in.
+    # Users locked in id order
+    rows_by_user = {}
+    for row in rows:
+        rows_by_user.setdefault(row['user_id'], []).append(row)
+    for user_id in sorted(rows_by_user):
+        user_rows = sorted(rows_by_user[user_id], key=lambda row: row['start_time'])
+        first_seq = reserve_change_seqs(user_id, len(user_rows)) - len(user_rows) + 1
+        for offset, row in enumerate(user_rows):
+            row['change_seq'] = first_seq + offset
+    # Interleaved ids when sharded on SQLite, else numbered by the database
+    new_ids = shards.new_activity_ids(len(rows))
+    if new_ids:
+        for row, activity_id in zip(rows, new_ids):
+            row['id'] = activity_id
+    for row in rows:
+        row['end_cell'] = end_cell(row['end_latitude'], row['end_longitude'])
+
+    # One executemany for all rows, ids come back in parameter order
+    activity_ids = db.session.scalars(
+        insert(Activity).returning(Activity.id, sort_by_parameter_order=True), rows
+    ).all()
+
+    summary_deltas = {}
+    for row in rows:
+        add_daily_delta(summary_deltas, row['user_id'], row['start_time'], row['goal_state'],
+                        row['distance_km'], row['duration_seconds'])
+    add_daily_summary_deltas(summary_deltas)
+
+    cell_deltas = {}
+    for row in rows:
+        add_cell_deltas(cell_deltas, row['end_cell'])
+    add_cell_count_deltas(cell_deltas)
+    return activity_ids
+
+# add many acts at once (offline sync, watch imports)
+@api.route('/activities/batch', methods=['POST'])
+def add_activities_batch():
+    data = request.get_json()
+    items = data.get('activities') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'activities must be a non-empty list'}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({'message': f'At most {MAX_BATCH_SIZE} activities per batch'}), 400
+
+    # Validate everything up front; a bad item only fails itself
+    results = [None] * len(items)
+    user_ids = {item.get('user_id') for item in items if isinstance(item, dict) and is_user_id(item.get('user_id'))}
+    known_users = set()
+    for shard, shard_user_ids in shards.group(user_ids).items():
+        with shards.use(shard):
+            known_users.update(row.id for row in db.session.query(User.id).filter(User.id.in_(shard_user_ids)))
+    # With a session token, only the token's user may be written to
+    token_user_id = None
+    token = token_from_request()
+    if token is not None:
+        token_user_id = session_tokens.user_id(token)
+        if token_user_id is None:
+            return jsonify({'message': 'Invalid or expired token'}), 401
+    elif session_tokens.required:
+        return jsonify({'message': 'Missing session token'}), 401
+
+    rows = []
+    row_indexes = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {'index': index, 'status': 400, 'message': 'Activity must be an object'}
+            continue
+        if not is_user_id(item.get('user_id')) or item['user_id'] not in known_users:
+            results[index] = {'index': index, 'status': 404, 'message': 'User not found or not authenticated'}
+            continue
+        if token_user_id is not None and item['user_id'] != token_user_id:
+            results[index] = {'index': index, 'status': 403, 'message': 'Token does not belong to this user'}
+            continue
+        missing = [field for field in ACTIVITY_REQUIRED_FIELDS if field not in item]
+        if missing:
+            results[index] = {'index': index, 'status': 400, 'message': f'Missing field: {missing[0]}'}
+            continue
+        try:
+            start_time = datetime.fromisoformat(item['start_time'])
+        except (TypeError, ValueError):
+            results[index] = {'index': index, 'status': 400, 'message': 'Invalid date format for start_time. Use ISO format (YYYY-MM-DDTHH:MM:SS)'}
+            continue
+        field_error = activity_field_error(item)
+        if field_error:
+            results[index] = {'index': index, 'status': 400, 'message': field_error}
+            continue
+
+        rows.append({
+            'user_id': item['user_id'],
+            'start_time': start_time,
+            'duration_seconds': item['duration_seconds'],
+            'distance_km': item['distance_km'],
+            'end_latitude': item.get('end_latitude'),
+            'end_longitude': item.get('end_longitude'),
+            'average_pace_seconds_per_km': item['average_pace_seconds_per_km'],
+            **split_paces_columns(item.get('split_paces', [])),
+            'goal_state': item.get('goal_state'),
+            'goal_dist': item.get('goal_dist'),
+            'goal_pace': item.get('goal_pace'),
         })
-    return jsonify(output), 200
+        row_indexes.append(index)
+
+    # One transaction per shard (a single one when not sharded)
+    rows_by_shard = {}
+    for index, row in zip(row_indexes, rows):
+        rows_by_shard.setdefault(shards.shard_of(row['user_id']), []).append((index, row))
+
+    created = 0
+    error = None
+    for shard, shard_items in rows_by_shard.items():
+        shard_rows = [row for _, row in shard_items]
+        with shards.use(shard):
+            try:
+                activity_ids = insert_activity_rows(shard_rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # The details (SQL, parameters) go to the log, not to the client
+                logger.exception('Error adding activities to shard %s', shard)
+                error = 'Error adding activities'
+                for index, _ in shard_items:
+                    results[index] = {'index': index, 'status': 500, 'message': error}
+                continue
+            finally:
+                # Row ids repeat across shards; don't let loaded objects meet in the identity map
+                db.session.close()
+
+        # Goal adaptation runs once per user over their runs in chronological order
+        # (their change_seq order, see insert_activity_rows), as if posted one by one
+        change_seqs_by_user = {}
+        for row in shard_rows:
+            change_seqs_by_user.setdefault(row['user_id'], []).append(row['change_seq'])
+        for user_id, change_seqs in change_seqs_by_user.items():
+            response_cache.bump(user_id)
+            post_write_queue.submit(user_id, change_seqs)
+        rankings.after_insert(shard)
+
+        for (index, _), activity_id in zip(shard_items, activity_ids):
+            results[index] = {'index': index, 'status': 201, 'activity_id': activity_id}
+        created += len(shard_rows)
+
+    if error and not created:
+        return jsonify({'message': error}), 500
 
-@app.route('/activities/past_week/<int:user_id>', methods=['GET'])
-def get_past_week_activities(user_id):
-    user = User.query.get(user_id)
-    if not user:
-        return jsonify({'message': 'User not found'}), 404
+    return jsonify({
+        'created': created,
+        'failed': len(items) - created,
+        'results': results
+    }), 201 if created == len(items) else 207
+
+# --- Activity reads ---
+# Each read endpoint is split into a statement and a render step so that the async
+# serving mode (asgi.py) runs the same queries and builds the same bodies. The *_read
+# functions validate the arguments (BadArgument -> 400) and return (statement, render);
+# render(result) turns the executed statement's result into the response body.
+
+class BadArgument(Exception):
+    """Invalid query argument or URL part of a read endpoint; answered with 400."""
+
+@api.app_errorhandler(BadArgument)
+def bad_argument(error):
+    return jsonify({'message': str(error)}), 400
+
+def activities_read(user_id, args):
+    # Optional projection, e.g. ?fields=start_time,goal_state
+    fields_arg = args.get('fields')
+    if fields_arg:
+        fields = [f.strip() for f in fields_arg.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in ACTIVITY_FIELD_COLUMNS]
+        if unknown:
+            raise BadArgument(f'Unknown field: {unknown[0]}')
+    else:
+        fields = list(ACTIVITY_FIELD_COLUMNS)
+
+    # Without limit/cursor the full history is returned as a plain list (older app builds rely on it).
+    paginate = 'limit' in args or 'cursor' in args
+    if paginate:
+        try:
+            limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            raise BadArgument('Invalid limit')
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    # id and start_time are always loaded since the cursor is built from them
+    columns = [Activity.id, Activity.start_time]
+    columns += [column for f in fields if f not in ('id', 'start_time') for column in ACTIVITY_FIELD_COLUMNS[f]]
+
+    cursor = args.get('cursor')
+    if cursor:
+        try:
+            cursor_time, cursor_id = decode_activity_cursor(cursor)
+        except ValueError:
+            raise BadArgument('Invalid cursor')
+
+    def build(model):
+        statement = select(*same_columns(model, columns)).where(model.user_id == user_id)
+        if cursor:
+            # Keyset: rows strictly after (start_time, id) in descending order
+            statement = statement.where(or_(
+                model.start_time < cursor_time,
+                and_(model.start_time == cursor_time, model.id < cursor_id)
+            ))
+        return statement
+
+    # History reaches back to the first run, archived ones included.
+    # Paginated, one extra row is fetched to know whether another page exists.
+    statement = activities_select(build, order_by=('-start_time', '-id'), limit=limit + 1 if paginate else None)
+
+    def render(result):
+        rows = result.all()
+        next_cursor = None
+        if paginate and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_activity_cursor(rows[-1].start_time, rows[-1].id)
+
+        serialize = activity_serializer(columns, fields)
+        output = [serialize(row) for row in rows]
+        if paginate:
+            return {'activities': output, 'next_cursor': next_cursor}
+        return output
+    return statement, render
+
+def activity_changes_read(user_id, args):
+    """Activities inserted or modified after the since cursor, oldest change first."""
+    try:
+        since = int(args.get('since', 0))
+        limit = int(args.get('limit', MAX_PAGE_SIZE))
+    except ValueError:
+        raise BadArgument('Invalid since or limit')
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    fields = list(ACTIVITY_FIELD_COLUMNS)
+    columns = [column for f in fields for column in ACTIVITY_FIELD_COLUMNS[f]] + [Activity.change_seq]
+    # Per-user sequence numbers commit in order (see reserve_change_seqs), so nothing
+    # below the returned cursor can show up later. Archived activities keep theirs.
+    statement = activities_select(
+        lambda model: select(*same_columns(model, columns)).where(model.user_id == user_id, model.change_seq > since),
+        order_by=('change_seq',), limit=limit + 1
+    )
 
+    def render(result):
+        rows = result.all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        serialize = activity_serializer(columns, fields)
+        return {
+            'activities': [serialize(row) for row in rows],
+            'cursor': rows[-1].change_seq if rows else since,
+            'has_more': has_more
+        }
+    return statement, render
+
+def past_week_read(user_id, args):
+    # Well within ARCHIVE_MIN_AGE_DAYS: only reads Activity
     seven_days_ago = datetime.utcnow() - timedelta(days=7)
 
-    activities = Activity.query.filter_by(user_id=user_id)\
-        .filter(Activity.start_time >= seven_days_ago)\
-        .order_by(desc(Activity.start_time)).all()
+    fields = list(ACTIVITY_FIELD_COLUMNS)
+    columns = [column for f in fields for column in ACTIVITY_FIELD_COLUMNS[f]]
+    statement = select(*columns).where(Activity.user_id == user_id)\
+        .where(Activity.start_time >= seven_days_ago)\
+        .order_by(desc(Activity.start_time))
 
-    output = [activity.to_dict() for activity in activities]
-    print("📦 Returned Activities:", output)
-    return jsonify(output), 200
-
-# NEW API: Get activities for a specific user and date
-@app.route('/activities_by_date/<int:user_id>/<string:date_str>', methods=['GET'])
-def get_activities_by_date(user_id, date_str):
-    user = User.query.get(user_id)
-    if not user:
-        return jsonify({'message': 'User not found'}), 404
+    def render(result):
+        serialize = activity_serializer(columns, fields, PAST_WEEK_FIELD_OVERRIDES)
+        output = [serialize(row) for row in result]
+        log_sampled(logger, logging.DEBUG, 0.01, 'past_week for user %s: %d activities', user_id, len(output))
+        return output
+    return statement, render
 
+def activities_by_date_read(user_id, date_str, args):
     try:
         # Parse the date string into a datetime object for comparison
         # Assuming date_str is in 'YYYY-MM-DD' format
         target_date = datetime.strptime(date_str, '%Y-%m-%d').date()
     except ValueError:
-        return jsonify({'message': 'Invalid date format. Use ISO-MM-DD'}), 400
+        raise BadArgument('Invalid date format. Use ISO-MM-DD')
+
+    try:
+        tz_offset_minutes = int(args.get('tz_offset_minutes', 0))
+    except ValueError:
+        raise BadArgument('Invalid tz_offset_minutes')
+
+    # Range predicate on the raw column so the (user_id, start_time) index is used;
+    # days older than ARCHIVE_MIN_AGE_DAYS are looked up in the archive too
+    day_start, day_end = local_day_range(target_date, tz_offset_minutes)
+    fields = list(ACTIVITY_FIELD_COLUMNS)
+    columns = [column for f in fields for column in ACTIVITY_FIELD_COLUMNS[f]]
+    statement = activities_select(
+        lambda model: select(*same_columns(model, columns)).where(
+            model.user_id == user_id,
+            model.start_time >= day_start,
+            model.start_time < day_end
+        ),
+        since=day_start, order_by=('-start_time',)
+    )
+
+    def render(result):
+        serialize = activity_serializer(columns, fields)
+        return [serialize(row) for row in result]
+    return statement, render
+
+def calendar_read(user_id, args):
+    try:
+        # month is 'YYYY-MM', defaults to the current month
+        month_str = args.get('month') or datetime.now().strftime('%Y-%m')
+        month_start = datetime.strptime(month_str, '%Y-%m').date()
+    except ValueError:
+        raise BadArgument('Invalid month format. Use YYYY-MM')
+
+    next_month_start = first_of_next_month(month_start)
+
+    # Reads at most one rollup row per day of the month
+    statement = select(DailyActivitySummary).where(
+        DailyActivitySummary.user_id == user_id,
+        DailyActivitySummary.day >= month_start,
+        DailyActivitySummary.day < next_month_start
+    ).order_by(DailyActivitySummary.day)
+
+    def render(result):
+        return {
+            'month': month_start.strftime('%Y-%m'),
+            'days': [summary.to_dict() for summary in result.scalars()]
+        }
+    return statement, render
+
+def run_read(statement, render):
+    return jsonify(render(db.session.execute(statement))), 200
+
+@api.route('/activities/<int:user_id>', methods=['GET'])
+@with_user_context
+def get_user_activities(user_id):
+    return run_read(*activities_read(user_id, request.args))
+
+@api.route('/activities/<int:user_id>/changes', methods=['GET'])
+@response_cache.cached('changes')
+@with_user_context
+def get_activity_changes(user_id):
+    return run_read(*activity_changes_read(user_id, request.args))
+
+@api.route('/activities/past_week/<int:user_id>', methods=['GET'])
+@response_cache.cached('past_week', bucket_seconds=60)
+@with_user_context
+def get_past_week_activities(user_id):
+    return run_read(*past_week_read(user_id, request.args))
 
-    # Query activities for the specific user and date
-    activities = Activity.query.filter(
+# NEW API: Get activities for a specific user and date
+@api.route('/activities_by_date/<int:user_id>/<string:date_str>', methods=['GET'])
+@with_user_context
+def get_activities_by_date(user_id, date_str):
+    return run_read(*activities_by_date_read(user_id, date_str, request.args))
+
+
+@api.route('/activities/calendar/<int:user_id>', methods=['GET'])
+@with_user_context
+def get_activity_calendar(user_id):
+    return run_read(*calendar_read(user_id, request.args))
+
+
+def sum_daily_summaries(user_id, first_day, end_day=None):
+    """(runs, distance_km, duration_seconds, last_start_time) of the user's rollup days in [first_day, end_day)."""
+    query = db.session.query(
+        func.coalesce(func.sum(DailyActivitySummary.completed_count + DailyActivitySummary.missed_count
+                               + DailyActivitySummary.other_count), 0),
+        func.coalesce(func.sum(DailyActivitySummary.distance_km), 0.0),
+        func.coalesce(func.sum(DailyActivitySummary.duration_seconds), 0),
+        func.max(DailyActivitySummary.last_start_time)
+    ).filter(DailyActivitySummary.user_id == user_id, DailyActivitySummary.day >= first_day)
+    if end_day is not None:
+        query = query.filter(DailyActivitySummary.day < end_day)
+    return query.one()
+
+def sum_monthly_summaries(user_id, first_month, end_month):
+    """Like sum_daily_summaries for the whole months in [first_month, end_month)."""
+    return db.session.query(
+        func.coalesce(func.sum(MonthlyActivitySummary.completed_count + MonthlyActivitySummary.missed_count
+                               + MonthlyActivitySummary.other_count), 0),
+        func.coalesce(func.sum(MonthlyActivitySummary.distance_km), 0.0),
+        func.coalesce(func.sum(MonthlyActivitySummary.duration_seconds), 0),
+        func.max(MonthlyActivitySummary.last_start_time)
+    ).filter(MonthlyActivitySummary.user_id == user_id, MonthlyActivitySummary.month >= first_month,
+             MonthlyActivitySummary.month < end_month).one()
+
+def sum_summaries(user_id, first_day, end_day):
+    """sum_daily_summaries over [first_day, end_day), with the whole months in it read from the monthly rollup."""
+    first_month = first_day if first_day.day == 1 else first_of_next_month(first_day)
+    end_month = end_day.replace(day=1)
+    if first_month >= end_month:
+        return sum_daily_summaries(user_id, first_day, end_day)
+
+    parts = [sum_monthly_summaries(user_id, first_month, end_month)]
+    if first_day < first_month:
+        parts.append(sum_daily_summaries(user_id, first_day, first_month))
+    if end_month < end_day:
+        parts.append(sum_daily_summaries(user_id, end_month, end_day))
+    last_times = [part[3] for part in parts if part[3] is not None]
+    return (sum(part[0] for part in parts), sum(part[1] for part in parts), sum(part[2] for part in parts),
+            max(last_times) if last_times else None)
+
+def window_totals(runs, distance_km, duration_seconds, last_start_time):
+    """Analytics response body; the same figures analysis.dart used to compute on the device."""
+    return {
+        'runs': runs,
+        'distance_km': round(distance_km, 3),
+        'duration_seconds': duration_seconds,
+        'avg_pace_seconds_per_km': round(duration_seconds / distance_km) if distance_km > 0 else 0,
+        'last_run_time': last_start_time.isoformat() if last_start_time else None,
+    }
+
+@api.route('/analytics/week/<int:user_id>', methods=['GET'])
+@response_cache.cached('analytics_week', bucket_seconds=60)
+@with_user_context
+def get_week_analytics(user_id):
+    # Same trailing window as /activities/past_week
+    since = datetime.utcnow() - timedelta(days=7)
+
+    # Whole days after the cutoff come from the daily rollup (at most 7 rows);
+    # only the runs on the cutoff's own day are read from Activity
+    runs, distance_km, duration_seconds, last_start_time = sum_daily_summaries(user_id, since.date() + timedelta(days=1))
+    _, cutoff_day_end = local_day_range(since.date())
+    partial = db.session.query(
+        func.count(Activity.id),
+        func.coalesce(func.sum(Activity.distance_km), 0.0),
+        func.coalesce(func.sum(Activity.duration_seconds), 0),
+        func.max(Activity.start_time)
+    ).filter(
         Activity.user_id == user_id,
-        func.date(Activity.start_time) == target_date
-    ).order_by(Activity.start_time.desc()).all()
-
-    output = []
-    for activity in activities:
-        split_paces = json.loads(activity.split_paces_json) if activity.split_paces_json else []
-
-        output.append({
-            'id': activity.id,
-            'user_id': activity.user_id,
-            'start_time': activity.start_time.isoformat(),
-            'duration_seconds': activity.duration_seconds,
-            'distance_km': activity.distance_km,
-            'end_latitude': activity.end_latitude,
-            'end_longitude': activity.end_longitude,
-            'average_pace_seconds_per_km': activity.average_pace_seconds_per_km,
-            'split_paces': split_paces,
-            'goal_state': activity.goal_state,
-            'goal_dist': activity.goal_dist,
-            'goal_pace': activity.goal_pace
-        })
-    return jsonify(output), 200
+        Activity.start_time >= since,
+        Activity.start_time < cutoff_day_end
+    ).one()
+
+    last_times = [t for t in (last_start_time, partial[3]) if t is not None]
+    totals = window_totals(runs + partial[0], distance_km + partial[1], duration_seconds + partial[2],
+                           max(last_times) if last_times else None)
+    return jsonify(dict(totals, start=since.isoformat())), 200
+
+@api.route('/analytics/window/<int:user_id>', methods=['GET'])
+@response_cache.cached('analytics_window', bucket_seconds=60)
+@with_user_context
+def get_window_analytics(user_id):
+    # Calendar-day windows, summed from the monthly and daily rollups only
+    today = datetime.now().date()
+    args = request.args
+    try:
+        if 'days' in args:
+            # Last N days including today, e.g. days=28 for four weeks
+            days = int(args['days'])
+            if days < 1:
+                raise ValueError
+            first_day, end_day = today - timedelta(days=days - 1), today + timedelta(days=1)
+        elif 'month' in args:
+            first_day = datetime.strptime(args['month'], '%Y-%m').date()
+            end_day = first_of_next_month(first_day)
+        elif 'year' in args:
+            year = int(args['year'])
+            first_day, end_day = date(year, 1, 1), date(year + 1, 1, 1)
+        elif 'start' in args and 'end' in args:
+            first_day = date.fromisoformat(args['start'])
+            end_day = date.fromisoformat(args['end']) + timedelta(days=1)
+        else:
+            return jsonify({'message': 'Give days, month, year, or start and end'}), 400
+    except (ValueError, OverflowError):
+        return jsonify({'message': 'Invalid window'}), 400
+
+    totals = window_totals(*sum_summaries(user_id, first_day, end_day))
+    return jsonify(dict(totals, start=first_day.isoformat(), end=(end_day - timedelta(days=1)).isoformat())), 200
+
+
+# --- Rankings ---
+DEFAULT_TOP_LIMIT = 10
+MAX_TOP_LIMIT = 100
+
+def ranking_week(args):
+    """Week of ?week= (any day of it, default the current week) as week_of() gives it."""
+    try:
+        day = date.fromisoformat(args['week']) if 'week' in args else datetime.now().date()
+    except ValueError:
+        raise BadArgument('Invalid week. Use YYYY-MM-DD')
+    week = week_of(day)
+    if not rankings.first_week() <= week <= week_of(datetime.now().date()):
+        raise BadArgument(f'Rankings cover the current week and the {rankings.weeks - 1} before it')
+    return week
+
+@api.route('/rank/<int:user_id>', methods=['GET'])
+@with_user_context
+def get_rank(user_id):
+    trait = g.user_context.trait
+    if not trait or not trait['user_type']:
+        return jsonify({'message': 'Trait not found'}), 404
+    week = ranking_week(request.args)
+    body = rankings.standing(user_id, trait['user_type'], week)
+    return jsonify(dict(body, user_type=trait['user_type'], week=date.fromordinal(week).isoformat())), 200
+
+@api.route('/rank/top/<string:user_type>', methods=['GET'])
+def get_rank_top(user_type):
+    week = ranking_week(request.args)
+    metric = request.args.get('metric', 'distance')
+    if metric not in METRICS:
+        return jsonify({'message': f'metric must be one of {", ".join(METRICS)}'}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', DEFAULT_TOP_LIMIT)), MAX_TOP_LIMIT))
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify({'message': 'Invalid limit or offset'}), 400
+
+    ranked, entries = rankings.top(user_type, week, metric, offset, limit)
+    return jsonify({
+        'user_type': user_type,
+        'week': date.fromordinal(week).isoformat(),
+        'metric': metric,
+        'of': ranked,
+        'entries': [{'rank': rank, 'user_id': entry_user_id, 'value': value} for rank, entry_user_id, value in entries]
+    }), 200
+
+
+# --- Geo ---
+# Upper bound on the radius of /activities/nearby
+MAX_NEARBY_RADIUS_KM = 20.0
+DEFAULT_NEARBY_LIMIT = 50
+# No user_id: the endpoint is public, and end points are often where the runner lives
+NEARBY_FIELDS = ['id', 'start_time', 'distance_km', 'end_latitude', 'end_longitude']
+
+@api.route('/activities/nearby', methods=['GET'])
+def get_nearby_activities():
+    """Activities of all users ending within radius_km of (lat, lon), nearest first. End
+    points are snapped to their NEARBY_SNAP_ZOOM tile, distances measured from there."""
+    try:
+        latitude = float(request.args['lat'])
+        longitude = float(request.args['lon'])
+        radius_km = float(request.args.get('radius_km', 1.0))
+        limit = int(request.args.get('limit', DEFAULT_NEARBY_LIMIT))
+    except (KeyError, ValueError):
+        return jsonify({'message': 'lat and lon are required; lat, lon, radius_km and limit must be numbers'}), 400
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return jsonify({'message': 'lat must be within -90..90 and lon within -180..180'}), 400
+    if not 0 < radius_km <= MAX_NEARBY_RADIUS_KM:
+        return jsonify({'message': f'radius_km must be greater than 0 and at most {MAX_NEARBY_RADIUS_KM:g}'}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    columns = [column for f in NEARBY_FIELDS for column in ACTIVITY_FIELD_COLUMNS[f]]
+    found = []
+    for _ in shards.each():
+        for _, row in nearby_activities(latitude, longitude, radius_km, columns):
+            end_latitude, end_longitude = snap_to_tile(row.end_latitude, row.end_longitude)
+            found.append((haversine_km(latitude, longitude, end_latitude, end_longitude), row, end_latitude, end_longitude))
+    found.sort(key=lambda item: (item[0], item[1].start_time, item[1].id))
+
+    serialize = activity_serializer(columns, NEARBY_FIELDS)
+    return jsonify({'activities': [
+        dict(serialize(row), end_latitude=end_latitude, end_longitude=end_longitude,
+             distance_from_point_km=round(distance_km, 3))
+        for distance_km, row, end_latitude, end_longitude in found[:limit]
+    ]}), 200
+
+@api.route('/heatmap/<int:zoom>/<int:x>/<int:y>', methods=['GET'])
+def get_heatmap_tile(zoom, x, y):
+    """Activity end points in map tile zoom/x/y, counted per bin from the per-cell counters."""
+    if not HEATMAP_MIN_ZOOM <= zoom <= HEATMAP_MAX_ZOOM:
+        return jsonify({'message': f'zoom must be within {HEATMAP_MIN_ZOOM}..{HEATMAP_MAX_ZOOM}'}), 400
+    if x >= 1 << zoom or y >= 1 << zoom:
+        return jsonify({'message': 'No such tile'}), 404
+
+    bins = {}
+    for _ in shards.each():
+        for position, count in heatmap_bins(zoom, x, y).items():
+            bins[position] = bins.get(position, 0) + count
+
+    return jsonify({
+        'zoom': zoom,
+        'x': x,
+        'y': y,
+        'bins_per_side': 1 << HEATMAP_BIN_SHIFT,
+        # Row by row, top left first
+        'bins': [{'x': bin_x, 'y': bin_y, 'count': count}
+                 for (bin_x, bin_y), count in sorted(bins.items(), key=lambda item: (item[0][1], item[0][0]))],
+        'max_count': max(bins.values(), default=0)
+    }), 200
+
+
+@api.route('/export/activities/<int:user_id>', methods=['GET'])
+@with_user_context
+def export_user_activities(user_id):
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'message': 'format must be ndjson or csv'}), 400
+    try:
+        # Resume: id of the last row received, plus the split column count of the CSV header already received
+        after_id = int(request.args.get('after_id', 0))
+        split_columns = request.args.get('split_columns')
+        split_columns = int(split_columns) if split_columns is not None else None
+    except ValueError:
+        return jsonify({'message': 'after_id and split_columns must be integers'}), 400
+
+    rows = iter_activity_rows(user_id, after_id)
+    if export_format == 'csv':
+        header = split_columns is None
+        if header:
+            split_columns = max_split_count(user_id)
+        lines = csv_lines(rows, split_columns, header=header)
+        mimetype = 'text/csv'
+    else:
+        lines = ndjson_lines(rows)
+        mimetype = 'application/x-ndjson'
+
+    # The body is produced after the request's teardown, which deselects the shard
+    return Response(stream_with_context(shards.stream(user_id, lines)), mimetype=mimetype)
 
 
-@app.route('/finish_questionare', methods=['POST'])
+@api.route('/finish_questionare', methods=['POST'])
 def finish_questionare():
     data = request.json
     user_id = int(data.get('user_id'))
 
     if not user_id:
         return jsonify({'error': 'Missing user_id'}), 400
-
-    # If trait exists, delete old.
-    old_trait = Trait.query.filter_by(user_id=user_id).first()
-    if old_trait:
-        db.session.delete(old_trait)
-        db.session.commit()
-
-    long_goal = {"dist": 21.0, "pace": 300, "weight": 60.0}
-    
-    curr_goal = {"dist": 5.0, "pace": 420, "weight": 70.0, "freq": 3.0} # Added 'freq' with a default
-
-    usually_quit = False
-    now_quit = False # This field is typically updated by the performance logic in update_trait_after_run, not directly from questionnaire
-    believe_ai = False
-
-    # Helper function to parse additional input from answers string
-    def parse_additional_input(answer_string):
-        """Parses additional key=value pairs from an answer string like '(Additional: key1=val1, key2=val2)'."""
-        match = re.search(r'\(Additional: (.*)\)', answer_string)
-        if match:
-            params_str = match.group(1)
-            params = {}
-            for pair in params_str.split(', '):
-                key_val = pair.split('=')
-                if len(key_val) == 2:
-                    key, val = key_val[0], key_val[1]
-                    try:
-                        # Attempt to convert to float or int for numeric values
-                        if key in ['distance', 'goal', 'weight']:
-                            params[key] = float(val)
-                        elif key == 'speed':
-                            params[key] = int(val) # Speed is min/km, will be converted to seconds later
-                        else:
-                            params[key] = val # Keep as string if not numeric
-                    except ValueError:
-                        params[key] = val # Fallback to string if conversion fails
-            return params
-        return {}
-
-    # --- Process answers from the questionnaire ---
-
-    # g1: Why do you run?
-    g1_answer = data.get('g1')
-    
-    user_type = g1_answer.split()[0].lower()
-        
-
-    # g2: Do you have a long term goal?
-    g2_answer = data.get('g2')
-    if g2_answer and g2_answer.startswith('Yes'):
-        # User has a specific long-term goal
-        g2_additional_input = parse_additional_input(g2_answer)
-        if g1_answer == 'Faster speed':
-            if 'distance' in g2_additional_input:
-                long_goal['dist'] = g2_additional_input['distance']
-            if 'speed' in g2_additional_input:
-                # Convert min/km to seconds/km (e.g., 5 min/km -> 300 sec/km)
-                long_goal['pace'] = int(g2_additional_input['speed'] * 60)
-            long_goal['weight'] = curr_goal['weight'] # Keep current weight for speed goal unless specified
-        elif g1_answer == 'Longer distance':
-            if 'goal' in g2_additional_input:
-                long_goal['dist'] = g2_additional_input['goal']
-            # Set a reasonable default pace for longer distance goals if not explicitly given
-            long_goal['pace'] = 360 # 6 min/km pace
-            long_goal['weight'] = curr_goal['weight'] # Keep current weight for distance goal unless specified
-        elif g1_answer == 'Healthier shape':
-            if 'weight' in g2_additional_input:
-                long_goal['weight'] = g2_additional_input['weight']
-            # Set generic distance/pace goals for healthier shape if not specified
-            long_goal['dist'] = 10.0 # A common distance for general health
-            long_goal['pace'] = 420 # 7 min/km pace
-
-    elif g2_answer == 'No':
-        # User does not have a specific long-term goal, infer from g1
-        if g1_answer == 'Faster speed':
-            long_goal['pace'] = min(270, long_goal['pace']) # Aim for slightly faster than default (4.5 min/km)
-            long_goal['dist'] = 10.0 # A good distance to work on speed
-            long_goal['weight'] = curr_goal['weight'] # Keep current weight for speed goal
-        elif g1_answer == 'Longer distance':
-            long_goal['dist'] = max(10, long_goal['dist']) # Aim for longer than default (25 km)
-            long_goal['pace'] = 390 # A bit slower pace for longer runs (6.5 min/km)
-            long_goal['weight'] = curr_goal['weight'] # Keep current weight for distance goal
-        elif g1_answer == 'Healthier shape':
-            long_goal['dist'] = 10.0 # Keep general 10km goal
-            long_goal['pace'] = 450 # Moderate pace (7.5 min/km)
-            long_goal['weight'] = 65.0 # A general healthy weight goal
-
-    # Determine a base current distance based on last run performance
-    base_curr_dist_from_h2 = curr_goal['dist'] # Default to initialized curr_goal['dist']
-    h2_answer = data.get('h2')
-    if h2_answer == 'Less than 3km':
-        base_curr_dist_from_h2 = 3.0
-    elif h2_answer == '3~10km':
-        base_curr_dist_from_h2 = 5.0
-    elif h2_answer == 'More than 10km':
-        base_curr_dist_from_h2 = 8.0
-
-    # h1: How long has it been since you last ran? (Influences current goal's difficulty)
-    h1_answer = data.get('h1')
-    if h1_answer == 'More than a month':
-        curr_goal['dist'] = 2.0
-        curr_goal['pace'] = 570 
-        curr_goal['freq'] = 1.0 
-    elif h1_answer == 'Within a month':
-        curr_goal['dist'] = max(3.0, base_curr_dist_from_h2 * 0.75) # At least 3km, or 75% of last run if long
-        curr_goal['pace'] = max(480, curr_goal['pace']) # At least 8 min/km, or existing pace
-        curr_goal['freq'] = 2.0
-    else: # Within a week
-        curr_goal['dist'] = base_curr_dist_from_h2 # Use last run's distance as a strong indicator
-        curr_goal['freq'] = 3.0 
-
-    if long_goal['dist'] > 10.0 and curr_goal['dist'] < long_goal['dist'] * 0.2: # If long goal is high and current is too low
-        curr_goal['dist'] = max(curr_goal['dist'], long_goal['dist'] * 0.2) # Ensure at least 20% of long goal
-    if long_goal['dist'] > 5.0 and curr_goal['dist'] < long_goal['dist'] * 0.5 and h1_answer != 'More than a month':
-         curr_goal['dist'] = max(curr_goal['dist'], long_goal['dist'] * 0.3) # If active, aim for at least 30% of long goal
-
-    # h3: how fast
-    h3_answer = data.get('h3')
-    if h3_answer == 'Less than 5':
-        curr_goal['pace'] = min(curr_goal['pace'], 300) 
-    elif h3_answer == '5~7':
-        curr_goal['pace'] = max(curr_goal['pace'], 300) 
-        curr_goal['pace'] = min(curr_goal['pace'], 420) 
-    elif h3_answer == 'More than 7':
-        curr_goal['pace'] = max(curr_goal['pace'], 480) 
-    
-    long_goal['pace'] = min(long_goal['pace'], MAX_PACE_SECONDS_PER_KM)
-    curr_goal['pace'] = min(curr_goal['pace'], MAX_PACE_SECONDS_PER_KM)
-
-
-    # h4: curr weight
-    h4_answer = data.get('h4')
-    if h4_answer and h4_answer.startswith('kg'):
-        h4_additional_input = parse_additional_input(h4_answer)
-        if 'weight' in h4_additional_input:
-            curr_goal['weight'] = h4_additional_input['weight']
-            if curr_goal['weight'] > 90: # adjust for obese users
-                curr_goal['dist'] = min(curr_goal['dist'], 3.0) 
-                curr_goal['pace'] = max(curr_goal['pace'], 540) 
-                curr_goal['pace'] = min(curr_goal['pace'], MAX_PACE_SECONDS_PER_KM) # Ensure within max allowed
-
-    m1_answer = data.get('m1')
-    if m1_answer == 'Yes':
-        usually_quit = True
-    elif m1_answer == 'No':
-        usually_quit = False
-
-    # m2: Do you believe in the idea: "Don't think. Just run as AI tells you"?
-    m2_answer = data.get('m2')
-    if m2_answer == 'Yes':
-        believe_ai = True
-    elif m2_answer == 'No':
-        believe_ai = False
-
-    # Final consistency checks to ensure curr_goal is not harder than long_goal
-    # Current distance should be less than or equal to long-term distance
-    curr_goal['dist'] = min(curr_goal['dist'], long_goal['dist'])
-    # Current pace should be slower than or equal to long-term pace (higher seconds/km means slower)
-    curr_goal['pace'] = max(curr_goal['pace'], long_goal['pace'])
-    # Current weight should be higher than or equal to long-term target weight
-    curr_goal['weight'] = max(curr_goal['weight'], long_goal['weight'])
-    
-    # Ensure current pace does not exceed the overall MAX_PACE_SECONDS_PER_KM
-    curr_goal['pace'] = min(curr_goal['pace'], MAX_PACE_SECONDS_PER_KM)
-
-    # Create Trait instance
-    trait = Trait(
-        user_id=user_id,
-        long_goal=long_goal,
-        curr_goal=curr_goal,
-        usually_quit=usually_quit,
-        now_quit=now_quit,
-        believe_ai=believe_ai,
-        user_type=user_type # Store the determined user type
-    )
-    # Save to database
-    db.session.add(trait)
+    denied = authorize(user_id)
+    if denied:
+        return denied
+    shards.activate(user_id)
+
+    # Let queued goal updates land first so the run window carried over below is complete
+    post_write_queue.wait_for_user(user_id, timeout=POST_WRITE_WAIT_SECONDS)
+
+    # The run window is carried over to the new trait, rebuilt if runs were never folded in
+    trait = db.session.execute(
+        select(Trait.recent_runs, Trait.adapted_change_seq).where(Trait.user_id == user_id)).first()
+    change_seq = db.session.scalar(select(User.change_seq).where(User.id == user_id)) or 0
+    recent_runs = trait.recent_runs if trait else None
+    if recent_runs is None or (trait.adapted_change_seq or 0) < change_seq:
+        recent_runs = recent_runs_from_activities(user_id)
+
+    # Replace the trait in one statement, one transaction; the new goal starts after the runs so far
+    traits = questionnaire_rules.traits(data)
+    upsert_traits([dict(traits, user_id=user_id, recent_runs=recent_runs, adapted_change_seq=change_seq)])
     db.session.commit()
+    response_cache.bump(user_id)
+    rankings.set_cohort(user_id, traits['user_type'])
 
     return jsonify({'message': 'Trait created successfully'}), 201
 
 
-def update_trait_after_run(user_id, curr_goal_dist, curr_goal_pace):
-    trait = Trait.query.filter_by(user_id=user_id).first()
-    if not trait or not trait.curr_goal:
+def recent_runs_from_activities(user_id, exclude_ids=()):
+    """Build the Trait.recent_runs window from the activity tables."""
+    statement = activities_select(
+        lambda model: select(model.start_time, model.average_pace_seconds_per_km, model.distance_km)
+        .where(model.user_id == user_id, model.id.notin_(list(exclude_ids))),
+        order_by=('-start_time',), limit=PAST_ACCESS_ACT_NUM
+    )
+    activities = db.session.execute(statement).all()
+    return [[act.start_time.isoformat(), act.average_pace_seconds_per_km, act.distance_km] for act in activities]
+
+def push_recent_run(trait, start_time, pace, dist):
+    """Add a new run to trait.recent_runs, keeping the PAST_ACCESS_ACT_NUM latest by start_time."""
+    if trait.recent_runs is None:
+        # Not backfilled yet; the pending activity is flushed by the query and included
+        trait.recent_runs = recent_runs_from_activities(trait.user_id)
         return
 
+    entry = [start_time.isoformat(), pace, dist]
+    runs = list(trait.recent_runs)
+    # Usually index 0; late uploads of older runs slot in by start_time
+    position = 0
+    while position < len(runs) and runs[position][0] > entry[0]:
+        position += 1
+    runs.insert(position, entry)
+    # Reassign so the JSON column is marked dirty
+    trait.recent_runs = runs[:PAST_ACCESS_ACT_NUM]
+
+def unadapted_runs(user_id, above):
+    """What goal adaptation needs to know about user_id's activities whose change_seq is
+    above `above`, in change_seq order."""
+    statement = activities_select(
+        lambda model: select(model.id, model.change_seq, model.start_time, model.average_pace_seconds_per_km,
+                             model.distance_km, model.goal_dist, model.goal_pace)
+        .where(model.user_id == user_id, model.change_seq > above),
+        order_by=('change_seq',)
+    )
+    return [{
+        'activity_id': row.id,
+        'change_seq': row.change_seq,
+        'start_time': row.start_time,
+        'pace': row.average_pace_seconds_per_km,
+        'dist': row.distance_km,
+        'goal_dist': row.goal_dist,
+        'goal_pace': row.goal_pace,
+    } for row in db.session.execute(statement)]
+
+def update_trait_after_run(user_id, change_seqs=()):
+    """Post-write job: fold the user's activities above Trait.adapted_change_seq into the
+    trait in order, then commit once. Runs whose job was lost (process killed with work
+    queued) are folded in by the next one. change_seqs are those of the runs queued;
+    they only say where to start for a trait from before adapted_change_seq existed."""
+    with shards.use_for_user(user_id):
+        # On PostgreSQL the lock makes another process's job for this user wait for this one
+        trait = Trait.query.filter_by(user_id=user_id).with_for_update().first()
+        if not trait:
+            return
+        if trait.adapted_change_seq is None:
+            if not change_seqs:
+                return
+            trait.adapted_change_seq = min(change_seqs) - 1
+        runs = unadapted_runs(user_id, trait.adapted_change_seq)
+        if not runs:
+            db.session.commit()
+            return
+
+        if trait.recent_runs is None:
+            # Build the window as it was before these runs, they are pushed below
+            trait.recent_runs = recent_runs_from_activities(user_id, exclude_ids=[run['activity_id'] for run in runs])
+
+        for run in runs:
+            push_recent_run(trait, run['start_time'], run['pace'], run['dist'])
+            if run['dist'] != 0 and run['pace'] != 0:
+                adapt_goal(trait, run['goal_dist'], run['goal_pace'])
+        trait.adapted_change_seq = runs[-1]['change_seq']
+
+        db.session.commit()
+    response_cache.bump(user_id)
+
+def adapt_goal(trait, curr_goal_dist, curr_goal_pace):
+    """Adjust trait.curr_goal after a run. Returns True if the goal was evaluated. Caller commits."""
+    if not trait.curr_goal:
+        return False
+
     new_goal = trait.curr_goal
 
     long_goal_pace = trait.long_goal['pace']
     long_goal_dist = trait.long_goal['dist']
 
     if curr_goal_pace is None or curr_goal_dist is None:
-        return
-
-    # Fetch recent activities
-    activities = Activity.query.filter_by(user_id=user_id)\
-        .order_by(desc(Activity.start_time)).limit(PAST_ACCESS_ACT_NUM).all()
+        return False
 
-    if not activities:
-        return
+    # Recent runs are kept on the trait by add_activity, so the Activity table isn't read here
+    if trait.recent_runs is None:
+        trait.recent_runs = recent_runs_from_activities(trait.user_id)
+    runs = trait.recent_runs
 
     faster_count = []
     longer_count = []
 
-    for act in activities:
-        if act.average_pace_seconds_per_km and act.distance_km:
-            if act.average_pace_seconds_per_km < curr_goal_pace: # Faster means lower pace value
+    for _, pace, dist in runs:
+        if pace and dist:
+            if pace < curr_goal_pace: # Faster means lower pace value
                 faster_count.append(1)
             else:
                 faster_count.append(0)
-            if act.distance_km >= curr_goal_dist: # Longer means greater or equal distance
+            if dist >= curr_goal_dist: # Longer means greater or equal distance
                 longer_count.append(1)
             else:
                 longer_count.append(0)
 
+    if not faster_count:
+        return False
+
     # Adjusting Algorithm
     # Upgrade conditions
     # Pace
     if (sum(faster_count) / len(faster_count) >= RATIO_UPGRADE_SPEED) and (faster_count[0] == 1):
         # If today completed and success rate more than RATIO_UPGRADE_SPEED.
-        # Reduce 15s until long-term goal is achieved.
-        new_goal['pace'] = max(curr_goal_pace - 15, long_goal_pace)
+        # Reduce PACE_UPGRADE_STEP (15s) until long-term goal is achieved.
+        new_goal['pace'] = max(curr_goal_pace - PACE_UPGRADE_STEP, long_goal_pace)
     # Distance
     if (sum(longer_count) / len(longer_count) >= RATIO_UPGRADE_LENGTH) and (longer_count[0] == 1):
         # If today completed and success rate more than RATIO_UPGRADE_LENGTH.
-        # Add 1km until long-term goal is achieved.
-        new_goal['dist'] = min(round(curr_goal_dist + 1.0, 1), long_goal_dist)
+        # Add DIST_UPGRADE_STEP (1km) until long-term goal is achieved.
+        new_goal['dist'] = min(round(curr_goal_dist + DIST_UPGRADE_STEP, 1), long_goal_dist)
 
     # Downgrade conditions
     # Pace
@@ -460,7 +1311,7 @@ def update_trait_after_run(user_id, curr_goal_dist, curr_goal_pace):
         else: break
     if(consecutive_failures_pace > 1):
         # Increase pace (slower) by 10s for each consecutive failure after the first
-        new_goal['pace'] = min(curr_goal_pace + (consecutive_failures_pace - 1) * 10, MAX_PACE_SECONDS_PER_KM) # Cap at 9 min 59 sec/km
+        new_goal['pace'] = min(curr_goal_pace + (consecutive_failures_pace - 1) * PACE_DOWNGRADE_STEP, MAX_PACE_SECONDS_PER_KM) # Cap at 9 min 59 sec/km
 
     # Distance
     # If fail continuously, be downgraded gradually.
@@ -470,60 +1321,474 @@ def update_trait_after_run(user_id, curr_goal_dist, curr_goal_pace):
         else: break
     if(consecutive_failures_dist > 1):
         # Decrease distance by 0.5km for each consecutive failure after the first
-        new_goal['dist'] = max(curr_goal_dist - (consecutive_failures_dist - 1) * 0.5, 1.0) # Minimum 1km
+        new_goal['dist'] = max(curr_goal_dist - (consecutive_failures_dist - 1) * DIST_DOWNGRADE_STEP, MIN_GOAL_DIST) # Minimum 1km
+
+    logger.debug('Goal for user %s: %skm %s -> %s', trait.user_id, curr_goal_dist, curr_goal_pace, new_goal)
+    return True
+
+def goal_state_bucket(goal_state):
+    """Daily rollup bucket of an activity's goal_state: 'completed', 'missed' or 'other'."""
+    return goal_state if goal_state in ('completed', 'missed') else 'other'
+
+def add_daily_delta(deltas, user_id, start_time, goal_state, distance_km, duration_seconds):
+    """Accumulate one activity into {(user_id, day): delta} for add_daily_summary_deltas."""
+    key = (user_id, start_time.date())
+    delta = deltas.get(key)
+    if delta is None:
+        delta = deltas[key] = {'completed': 0, 'missed': 0, 'other': 0, 'distance_km': 0.0,
+                               'duration_seconds': 0, 'last_start_time': start_time}
+    delta[goal_state_bucket(goal_state)] += 1
+    delta['distance_km'] += distance_km or 0
+    delta['duration_seconds'] += duration_seconds or 0
+    delta['last_start_time'] = max(delta['last_start_time'], start_time)
+
+def record_daily_summary(user_id, start_time, goal_state, distance_km, duration_seconds):
+    """Count one activity in the user's daily and monthly rollups. Caller commits."""
+    deltas = {}
+    add_daily_delta(deltas, user_id, start_time, goal_state, distance_km, duration_seconds)
+    add_daily_summary_deltas(deltas)
+
+def monthly_deltas(deltas):
+    """{(user_id, day): delta} -> {(user_id, first day of the month): delta}."""
+    months = {}
+    for (user_id, day), delta in deltas.items():
+        key = (user_id, day.replace(day=1))
+        month = months.get(key)
+        if month is None:
+            months[key] = dict(delta)
+            continue
+        for name in ('completed', 'missed', 'other', 'distance_km', 'duration_seconds'):
+            month[name] += delta[name]
+        month['last_start_time'] = max(month['last_start_time'], delta['last_start_time'])
+    return months
+
+def add_daily_summary_deltas(deltas):
+    """Add {(user_id, day): delta} (see add_daily_delta) to the daily and monthly rollups. Caller commits."""
+    add_summary_deltas(DailyActivitySummary, DailyActivitySummary.day, deltas)
+    add_summary_deltas(MonthlyActivitySummary, MonthlyActivitySummary.month, monthly_deltas(deltas))
+
+def add_summary_deltas(model, period_column, deltas):
+    """Add {(user_id, period): delta} to the rollup model, keyed by period_column. Caller commits."""
+    if not deltas:
+        return
+    # Two first runs of a user on the same day can both find no row: insert and
+    # increment in one upsert, as for the heatmap counters (geo.add_cell_count_deltas)
+    statement = dialect_insert(db.session.get_bind().dialect.name)(model)
+    excluded = statement.excluded
+    statement = statement.on_conflict_do_update(
+        index_elements=[model.user_id, period_column],
+        set_={
+            'completed_count': model.completed_count + excluded.completed_count,
+            'missed_count': model.missed_count + excluded.missed_count,
+            'other_count': model.other_count + excluded.other_count,
+            'distance_km': func.coalesce(model.distance_km, 0) + excluded.distance_km,
+            'duration_seconds': func.coalesce(model.duration_seconds, 0) + excluded.duration_seconds,
+            'last_start_time': case(
+                (or_(model.last_start_time.is_(None),
+                     model.last_start_time < excluded.last_start_time), excluded.last_start_time),
+                else_=model.last_start_time
+            ),
+        }
+    )
+    # executemany; sorted so concurrent writers take the row locks in the same order
+    db.session.execute(statement, [{
+        'user_id': user_id,
+        period_column.key: period,
+        'completed_count': delta['completed'],
+        'missed_count': delta['missed'],
+        'other_count': delta['other'],
+        'distance_km': delta['distance_km'],
+        'duration_seconds': delta['duration_seconds'],
+        'last_start_time': delta['last_start_time'],
+    } for (user_id, period), delta in sorted(deltas.items())])
+
+def rebuild_daily_summaries(user_id=None):
+    """Recompute the daily and monthly rollups from the activities, archived ones
+    included, with a single GROUP BY. Returns the number of days. Caller commits."""
+    def build(model):
+        statement = select(model.user_id, model.start_time, model.goal_state, model.distance_km, model.duration_seconds)
+        return statement if user_id is None else statement.where(model.user_id == user_id)
+    activities = all_activities(build)
+
+    day_col = func.date(activities.c.start_time)
+    query = db.session.query(
+        activities.c.user_id,
+        day_col,
+        func.sum(case((activities.c.goal_state == 'completed', 1), else_=0)),
+        func.sum(case((activities.c.goal_state == 'missed', 1), else_=0)),
+        func.sum(case((or_(activities.c.goal_state.is_(None),
+                           activities.c.goal_state.notin_(['completed', 'missed'])), 1), else_=0)),
+        func.sum(activities.c.distance_km),
+        func.sum(activities.c.duration_seconds),
+        func.max(activities.c.start_time),
+    )
+    for model in (DailyActivitySummary, MonthlyActivitySummary):
+        delete_query = model.query
+        if user_id is not None:
+            delete_query = delete_query.filter_by(user_id=user_id)
+        delete_query.delete(synchronize_session=False)
+
+    deltas = {}
+    for row_user_id, day, completed, missed, other, distance_km, duration_seconds, last_start_time in \
+            query.group_by(activities.c.user_id, day_col).all():
+        # SQLite returns date() as a string, and max() of a union as one too
+        day = date.fromisoformat(day) if isinstance(day, str) else day
+        if isinstance(last_start_time, str):
+            last_start_time = datetime.fromisoformat(last_start_time)
+        deltas[(row_user_id, day)] = {'completed': completed, 'missed': missed, 'other': other, 'distance_km': distance_km,
+                                      'duration_seconds': duration_seconds, 'last_start_time': last_start_time}
+
+    for model, period_column, period_deltas in ((DailyActivitySummary, 'day', deltas),
+                                                (MonthlyActivitySummary, 'month', monthly_deltas(deltas))):
+        db.session.bulk_insert_mappings(model, [
+            {
+                'user_id': row_user_id,
+                period_column: period,
+                'completed_count': delta['completed'],
+                'missed_count': delta['missed'],
+                'other_count': delta['other'],
+                'distance_km': delta['distance_km'],
+                'duration_seconds': delta['duration_seconds'],
+                'last_start_time': delta['last_start_time'],
+            }
+            for (row_user_id, period), delta in period_deltas.items()
+        ])
+    return len(deltas)
+
+@commands.cli.command('db-settings')
+def db_settings_command():
+    """Show the settings each database connection effectively runs with."""
+    report, problems = dbprofile.collect_settings(current_app, db)
+    click.echo(f"Profile: {current_app.config['DATABASE_PROFILE']}")
+    for key, settings in report.items():
+        click.echo(f"{key}: " + ', '.join(f'{name}={value}' for name, value in settings.items()))
+    for problem in problems:
+        click.echo(f"Warning: {problem}", err=True)
+
+@commands.cli.command('rebuild-calendar')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user.')
+def rebuild_calendar_command(user_id):
+    """Rebuild the daily calendar and monthly rollups from the activity tables."""
+    count = 0
+    for _ in shards.each(None if user_id is None else [user_id]):
+        count += rebuild_daily_summaries(user_id)
+        db.session.commit()
+    print(f"Rebuilt {count} daily summaries and their monthly totals.")
+
+def recent_runs_by_user(user_ids=None):
+    """{user_id: Trait.recent_runs window} from the activity tables, for user_ids (None:
+    everyone). Users without activities are left out."""
+    def build(model):
+        statement = select(model.user_id, model.start_time, model.average_pace_seconds_per_km, model.distance_km)
+        return statement if user_ids is None else statement.where(model.user_id.in_(list(user_ids)))
+    activities = all_activities(build)
+    # One windowed query for all users instead of one query per user
+    rank = func.row_number().over(partition_by=activities.c.user_id, order_by=desc(activities.c.start_time)).label('rank')
+    ranked = db.session.query(
+        activities.c.user_id, activities.c.start_time, activities.c.average_pace_seconds_per_km,
+        activities.c.distance_km, rank
+    ).subquery()
+    rows = db.session.query(ranked).filter(ranked.c.rank <= PAST_ACCESS_ACT_NUM)\
+        .order_by(ranked.c.user_id, ranked.c.rank).all()
+
+    runs_by_user = {}
+    for row in rows:
+        runs_by_user.setdefault(row.user_id, []).append(
+            [row.start_time.isoformat(), row.average_pace_seconds_per_km, row.distance_km])
+    return runs_by_user
+
+def backfill_recent_runs():
+    """Build Trait.recent_runs for every trait from the activity tables. Caller commits."""
+    runs_by_user = recent_runs_by_user()
+    traits = Trait.query.all()
+    for trait in traits:
+        trait.recent_runs = runs_by_user.get(trait.user_id, [])
+    return len(traits)
+
+@commands.cli.command('archive-activities')
+@click.option('--older-than-days', type=int, default=None,
+              help='Archive activities that started more than this many days ago (default: ARCHIVE_AFTER_DAYS).')
+def archive_activities_command(older_than_days):
+    """Move old activities to the archive table; reads merge it back in."""
+    days = current_app.config['ARCHIVE_AFTER_DAYS'] if older_than_days is None else older_than_days
+    if days < ARCHIVE_MIN_AGE_DAYS:
+        raise click.BadParameter(f'must be at least {ARCHIVE_MIN_AGE_DAYS}', param_hint='--older-than-days')
+    before = datetime.utcnow() - timedelta(days=days)
+    moved = 0
+    for _ in shards.each():
+        moved += archive_activities(before)
+    print(f"Archived {moved} activities that started before {before:%Y-%m-%d %H:%M}.")
+
+@commands.cli.command('rebuild-rankings')
+def rebuild_rankings_command():
+    """Recompute the cohort rankings from the activity tables and save them as the
+    snapshot the server loads on start."""
+    index = RankingIndex(shards, weeks=current_app.config['RANKING_WEEKS'], snapshot_seconds=0)
+    index.load(from_snapshot=False)
+    index.save()
+    print(f"Rebuilt rankings from {len(index.totals)} weekly totals "
+          f"of {len({user_id for user_id, _ in index.totals})} users.")
+
+@commands.cli.command('check-rankings')
+@click.option('--top', 'top_n', type=int, default=10, help='Length of the top lists compared.')
+def check_rankings_command(top_n):
+    """Load the rankings the way the server does (snapshot, then the activities added
+    since) and compare them with a brute-force recomputation."""
+    index = RankingIndex(shards, weeks=current_app.config['RANKING_WEEKS'], snapshot_seconds=0)
+    index.load()
+    problems = index.check(top_n)
+    for problem in problems[:20]:
+        click.echo(problem)
+    if problems:
+        raise click.ClickException(f'{len(problems)} differences')
+    print(f"Rankings match: {len(index.totals)} weekly totals, {sum(len(tree) for tree in index.trees.values())} ranks.")
+
+@commands.cli.command('rebuild-geo')
+def rebuild_geo_command():
+    """Set the end point cell of every activity and recount the heatmap counters."""
+    activities = cells = 0
+    for _ in shards.each():
+        shard_activities, shard_cells = rebuild_geo_cells()
+        activities += shard_activities
+        cells += shard_cells
+    print(f"Indexed {activities} activity end points into {cells} heatmap cells.")
+
+@commands.cli.command('backfill-recent-runs')
+def backfill_recent_runs_command():
+    """Build Trait.recent_runs for every trait from the activity table."""
+    count = 0
+    for _ in shards.each():
+        count += backfill_recent_runs()
+        db.session.commit()
+    print(f"Backfilled recent runs for {count} traits.")
+
+@commands.cli.command('catch-up-goals')
+def catch_up_goals_command():
+    """Fold the runs goal adaptation never saw into the traits (work queued by a process
+    that died). After upgrading, first marks every trait as caught up."""
+    started = caught_up = 0
+    user_change_seq = func.coalesce(select(User.change_seq).where(User.id == Trait.user_id).scalar_subquery(), 0)
+    for _ in shards.each():
+        started += db.session.execute(
+            db.update(Trait).where(Trait.adapted_change_seq.is_(None)).values(adapted_change_seq=user_change_seq)
+        ).rowcount
+        db.session.commit()
+        behind = db.session.scalars(select(Trait.user_id).where(Trait.adapted_change_seq < user_change_seq)).all()
+        db.session.commit()
+        for user_id in behind:
+            update_trait_after_run(user_id)
+        caught_up += len(behind)
+    print(f"Started tracking {started} traits, caught up {caught_up}.")
+
+# Users per query and upsert in onboard-questionnaires
+ONBOARD_CHUNK_SIZE = 500
+
+@commands.cli.command('onboard-questionnaires')
+@click.argument('input_file', type=click.File('r'))
+@click.option('--format', 'input_format', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+def onboard_questionnaires_command(input_file, input_format):
+    """Set the traits of many users from questionnaire results in INPUT_FILE ('-' for
+    stdin), one transaction per database. Each NDJSON line or CSV row holds user_id and
+    the answers g1 .. m2, like the body of /finish_questionare."""
+    rows = {}
+    try:
+        for line, answers in read_questionnaires(input_file, input_format):
+            try:
+                user_id = int(answers['user_id'])
+                rows[user_id] = dict(questionnaire_rules.traits(answers), user_id=user_id)
+            except (KeyError, TypeError, ValueError, AttributeError, IndexError) as error:
+                raise click.ClickException(f'line {line}: invalid questionnaire ({error!r})')
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+    # Nothing is written unless every user exists
+    groups = shards.group(rows)
+    missing = []
+    for key in shards.each(rows):
+        user_ids = groups[key]
+        for start in range(0, len(user_ids), ONBOARD_CHUNK_SIZE):
+            chunk = user_ids[start:start + ONBOARD_CHUNK_SIZE]
+            found = set(db.session.scalars(select(User.id).where(User.id.in_(chunk))))
+            missing += [user_id for user_id in chunk if user_id not in found]
+    if missing:
+        raise click.ClickException(f'{len(missing)} unknown user ids: {", ".join(map(str, missing[:10]))}')
+
+    for key in shards.each(rows):
+        user_ids = groups[key]
+        for start in range(0, len(user_ids), ONBOARD_CHUNK_SIZE):
+            chunk = user_ids[start:start + ONBOARD_CHUNK_SIZE]
+            # Run windows are carried over as in /finish_questionare
+            traits = {row.user_id: row for row in db.session.execute(
+                select(Trait.user_id, Trait.recent_runs, Trait.adapted_change_seq).where(Trait.user_id.in_(chunk)))}
+            change_seqs = dict(db.session.execute(select(User.id, User.change_seq).where(User.id.in_(chunk))).all())
+            recent_runs = {user_id: trait.recent_runs for user_id, trait in traits.items()}
+            without_runs = [user_id for user_id in chunk
+                            if recent_runs.get(user_id) is None
+                            or (traits[user_id].adapted_change_seq or 0) < (change_seqs.get(user_id) or 0)]
+            from_activities = recent_runs_by_user(without_runs) if without_runs else {}
+            for user_id in without_runs:
+                recent_runs[user_id] = from_activities.get(user_id, [])
+            upsert_traits([dict(rows[user_id], recent_runs=recent_runs[user_id],
+                                adapted_change_seq=change_seqs.get(user_id) or 0) for user_id in chunk])
+        db.session.commit()
+    for user_id in rows:
+        response_cache.bump(user_id)
+    print(f"Onboarded {len(rows)} users.")
+
+@commands.cli.command('export-activities')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'export_format', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+@click.option('--user-id', type=int, default=None, help='Only export this user (default: everyone).')
+@click.option('--resume', is_flag=True, help='Continue an interrupted export into the same file.')
+def export_activities_command(output, export_format, user_id, resume):
+    """Stream activity history to OUTPUT ('-' for stdout) as NDJSON or CSV."""
+    user_ids = None if user_id is None else [user_id]
+    if resume and shards.enabled and user_id is None:
+        # Activity ids are per shard, so the last id doesn't say where to continue
+        raise click.UsageError('--resume needs --user-id when sharding is enabled')
+
+    after_id, split_columns = 0, None
+    if resume and output != '-' and os.path.exists(output):
+        after_id, split_columns = read_resume_state(output, export_format)
+
+    header = split_columns is None
+    if export_format == 'csv' and header:
+        split_columns = max(max_split_count(user_id) for _ in shards.each(user_ids))
+
+    count = 0
+    with click.open_file(output, 'a' if after_id or not header else 'w', encoding='utf-8') as f:
+        # One shard after the other when sharded
+        for _ in shards.each(user_ids):
+            rows = iter_activity_rows(user_id, after_id)
+            lines = csv_lines(rows, split_columns, header=header) if export_format == 'csv' else ndjson_lines(rows)
+            for line in lines:
+                f.write(line)
+                count += 1
+            header = False
+    click.echo(f"Exported {count} lines after activity id {after_id}.", err=True)
+
+@commands.cli.command('replay-goals')
+@click.option('--grid', multiple=True, metavar='NAME=V1,V2',
+              help='Values to try for an adaptation parameter (repeatable; every combination is replayed).')
+@click.option('--recorded-goals', is_flag=True,
+              help='Evaluate each run against the goal stored on it instead of the simulated goal.')
+@click.option('--user-id', type=int, default=None, help='Only replay this user.')
+@click.option('--chunk-size', type=int, default=None, help='Activities per simulated chunk.')
+@click.option('--trajectories', type=click.Path(dir_okay=False), help='Write the goal after every evaluated run as CSV.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the summary as JSON.')
+@click.option('--check', is_flag=True, help='Count users whose replayed goal differs from the stored one (first parameter set).')
+def replay_goals_command(grid, recorded_goals, user_id, chunk_size, trajectories, output, check):
+    """Replay goal adaptation over the stored activities for one or more parameter sets."""
+    # NumPy is only needed for this command
+    import csv
+    from replay import GoalReplay, parameter_grid, iter_user_chunks, load_goals, format_summary, REPLAY_CHUNK_SIZE
+
+    defaults = {
+        'window': PAST_ACCESS_ACT_NUM,
+        'ratio_upgrade_speed': RATIO_UPGRADE_SPEED,
+        'ratio_upgrade_length': RATIO_UPGRADE_LENGTH,
+        'pace_upgrade_step': PACE_UPGRADE_STEP,
+        'dist_upgrade_step': DIST_UPGRADE_STEP,
+        'pace_downgrade_step': PACE_DOWNGRADE_STEP,
+        'dist_downgrade_step': DIST_DOWNGRADE_STEP,
+        'max_pace': MAX_PACE_SECONDS_PER_KM,
+        'min_dist': MIN_GOAL_DIST,
+    }
+    try:
+        params = parameter_grid(defaults, grid)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--grid')
 
-    print(f"Original Goal: {curr_goal_dist}km {curr_goal_pace}, New Goal: {new_goal}")
-    db.session.commit()
+    trajectory_file = open(trajectories, 'w', newline='') if trajectories else None
+    try:
+        writer = None
+        if trajectory_file:
+            writer = csv.writer(trajectory_file)
+            writer.writerow(['param_set', 'user_id', 'activity_id', 'goal_dist', 'goal_pace'])
+        user_ids = None if user_id is None else [user_id]
+        goals = {}
+        for _ in shards.each(user_ids):
+            goals.update(load_goals())
+        replay = GoalReplay(params, goals, recorded_goals=recorded_goals, trajectory_writer=writer)
+        started = datetime.now()
+        for _ in shards.each(user_ids):
+            replay.run(iter_user_chunks(chunk_size or REPLAY_CHUNK_SIZE, user_id))
+        elapsed = (datetime.now() - started).total_seconds()
+    finally:
+        if trajectory_file:
+            trajectory_file.close()
+
+    summary = replay.summary()
+    click.echo(format_summary(summary))
+    click.echo(f"\nReplayed {len(params)} parameter sets in {elapsed:.1f}s.")
+    if check:
+        click.echo(f"{replay.mismatches} of {replay.users} users end on a different goal than stored.")
+    if output:
+        with open(output, 'w') as f:
+            json.dump(summary, f, indent=2)
 
 # get today goal
-@app.route('/goal/<int:user_id>', methods=['GET'])
+@api.route('/goal/<int:user_id>', methods=['GET'])
+@wait_for_post_write
+@response_cache.cached('goal')
+@with_user_context
 def get_goal(user_id):
-    user = User.query.get(user_id)
-    if not user:
-        return jsonify({'message': 'User not found'}), 404
+    return jsonify(goal_body(g.user_context)), 200
+    
+@api.route('/user_type/<int:user_id>', methods=['GET'])
+@response_cache.cached('user_type')
+@with_user_context
+def get_user_type(user_id):
+    body = user_type_body(g.user_context)
+    if body is None:
+        return jsonify({'message': 'Trait not found'}), 404
+    return jsonify(body), 200
 
-    goal = Trait.query.filter_by(user_id=user_id).first()
+def goal_body(user_context):
+    trait = user_context.trait
 
-    if goal and goal.curr_goal:
-        dist = goal.curr_goal.get('dist', -1)
-        pace = goal.curr_goal.get('pace', -1)
+    if trait and trait['curr_goal']:
+        dist = trait['curr_goal'].get('dist', -1)
+        pace = trait['curr_goal'].get('pace', -1)
     else:
         # if not finish questionare
         dist = -1
         pace = -1
 
-    return jsonify({
+    return {
         'goal_dist': dist,
         'goal_pace': pace
-    }), 200
-    
-@app.route('/user_type/<int:user_id>', methods=['GET'])
-def get_user_type(user_id):
-    user = User.query.get(user_id)
-    if not user:
-        return jsonify({'message': 'User not found'}), 404
+    }
 
-    trait = Trait.query.filter_by(user_id=user_id).first()
+def user_type_body(user_context):
+    """None if the user has no trait yet."""
+    trait = user_context.trait
     if not trait:
-        return jsonify({'message': 'Trait not found'}), 404
+        return None
 
     weight = None
     freq = None # Initialize freq
-    if trait.curr_goal and isinstance(trait.curr_goal, dict):
-        weight = trait.curr_goal.get('weight')
-        freq = trait.curr_goal.get('freq') # Retrieve freq
+    if trait['curr_goal'] and isinstance(trait['curr_goal'], dict):
+        weight = trait['curr_goal'].get('weight')
+        freq = trait['curr_goal'].get('freq') # Retrieve freq
 
-    return jsonify({
-        'user_type': trait.user_type,
+    return {
+        'user_type': trait['user_type'],
         'weight': weight,
         'freq': freq
-    }), 200
+    }
     
 
+post_write_queue = PostWriteQueue(update_trait_after_run)
+
 if __name__ == '__main__':
     # Use Power Shell：run_server.ps1
     # Use CMD         ：run_backend.bat 
 
+    app = create_app()
+    # Log the effective database settings (profile, journal mode, pool)
+    dbprofile.check_settings(app, db)
+
     # For Local 
     app.run(host="127.0.0.1", port="5000", debug=True)
     # For Workshop
@@ -0,0 +1,210 @@
+# sharding.py
+# Opt-in sharding of per-user data across several databases.
+#
+# With SHARD_DATABASE_URLS set, each user and everything keyed by their user_id
+# (activities, trait, daily summaries) lives on shard user_id % N, a database of its
+# own configured as SQLAlchemy bind 'shard<i>'. SQLite allows one writer per file, so
+# writes of users on different shards no longer wait for each other.
+#
+# The default database (DATABASE_URL) then only holds the user directory: usernames
+# and third-party ids, and the globally unique user ids handed out at /register.
+#
+# Statements go to the shard selected with use() / activate(); see RoutingSession in
+# database.py. Without SHARD_DATABASE_URLS no shard is ever selected and everything
+# stays on the default database.
+#
+# Each shard numbers its own activities, so the ids are interleaved to stay unique
+# across shards: shard i of N only uses ids congruent to i + 1 modulo N. On SQLite the
+# insert paths pick them (new_activity_ids); on PostgreSQL the shard's id sequence
+# steps by N (interleave_activity_ids, run by init-db and migrate-db).
+import functools
+from contextlib import contextmanager
+
+import click
+import sqlalchemy as sa
+
+from database import db, current_shard, current_engine, Activity, ArchivedActivity, Trait, RankingSnapshot
+
+directory_metadata = sa.MetaData()
+
+user_directory = sa.Table(
+    'user_directory', directory_metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('username', sa.String(80), unique=True, nullable=False),
+    sa.Column('third_party_id', sa.String(128), unique=True, nullable=True),
+    # Ids of deleted entries are never handed out again
+    sqlite_autoincrement=True,
+)
+
+
+class Shards:
+    def __init__(self, urls=()):
+        self.urls = list(urls)
+        self.keys = [f'shard{index}' for index in range(len(self.urls))]
+
+    def init_app(self, app):
+        """Shard over app's SHARD_DATABASE_URLS (a list of URLs), if it is set."""
+        if 'SHARD_DATABASE_URLS' in app.config:
+            self.urls = list(app.config['SHARD_DATABASE_URLS'])
+            self.keys = [f'shard{index}' for index in range(len(self.urls))]
+        if self.keys:
+            app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, **dict(zip(self.keys, self.urls)))
+        app.teardown_request(self._deactivate)
+
+    @property
+    def enabled(self):
+        return bool(self.keys)
+
+    def shard_of(self, user_id):
+        """Bind key of the shard holding user_id, None when not sharded."""
+        if not self.keys:
+            return None
+        return self.keys[user_id % len(self.keys)]
+
+    def group(self, user_ids):
+        """{shard key: sorted user ids on that shard}."""
+        groups = {}
+        for user_id in sorted(user_ids):
+            groups.setdefault(self.shard_of(user_id), []).append(user_id)
+        return groups
+
+    @contextmanager
+    def use(self, key):
+        """Send statements to shard key inside the block."""
+        token = current_shard.set(key)
+        try:
+            yield
+        finally:
+            current_shard.reset(token)
+
+    def use_for_user(self, user_id):
+        return self.use(self.shard_of(user_id))
+
+    def stream(self, user_id, iterable):
+        """Iterate iterable with user_id's shard selected, for streamed response bodies."""
+        with self.use_for_user(user_id):
+            yield from iterable
+
+    def activate(self, user_id):
+        """Send statements to user_id's shard for the rest of the request."""
+        current_shard.set(self.shard_of(user_id))
+
+    def _deactivate(self, exc):
+        current_shard.set(None)
+
+    def each(self, user_ids=None):
+        """Fan-out helper: yields every shard key (or only those holding user_ids) with that
+        shard selected, closing the session in between. Commit inside the loop body.
+        Yields None once when not sharded."""
+        keys = list(self.group(user_ids)) if user_ids is not None else (self.keys or [None])
+        for key in keys:
+            with self.use(key):
+                try:
+                    yield key
+                finally:
+                    db.session.close()
+
+    def fan_out(self, command):
+        """Wrap a database CLI command so it runs once per shard."""
+        @functools.wraps(command)
+        def wrapper(*args, **kwargs):
+            for key in self.each():
+                if key is not None:
+                    click.echo(f'[{key}]')
+                command(*args, **kwargs)
+        return wrapper
+
+    # --- Activity ids (sharded mode only) ---
+
+    def activity_id_residue(self, key):
+        """Activity ids of shard key are congruent to this modulo the shard count."""
+        return (self.keys.index(key) + 1) % len(self.keys)
+
+    def next_activity_id(self, key, above):
+        """Smallest id of shard key greater than above."""
+        count = len(self.keys)
+        return above + ((self.activity_id_residue(key) - above) % count or count)
+
+    def new_activity_ids(self, count):
+        """Ids for count new activities on the selected shard, or None to let the database
+        number them (not sharded, or PostgreSQL). Call after reserve_change_seqs: its
+        UPDATE holds SQLite's write lock, so no other insert can take the same ids."""
+        key = current_shard.get()
+        if len(self.keys) < 2 or key is None or current_engine().dialect.name != 'sqlite':
+            return None
+        # The archive never moves the row holding the highest id (see archive.py)
+        first = self.next_activity_id(key, db.session.scalar(sa.select(sa.func.max(Activity.id))) or 0)
+        return list(range(first, first + count * len(self.keys), len(self.keys)))
+
+    def interleave_activity_ids(self):
+        """On PostgreSQL, make the selected shard's activity id sequence hand out only
+        that shard's ids, above every existing one."""
+        key = current_shard.get()
+        engine = current_engine()
+        if len(self.keys) < 2 or key is None or engine.dialect.name != 'postgresql':
+            return
+        with engine.begin() as conn:
+            sequence = conn.execute(sa.text("SELECT pg_get_serial_sequence('activity', 'id')")).scalar()
+            conn.execute(sa.text(f'ALTER SEQUENCE {sequence} INCREMENT BY {len(self.keys)}'))
+            max_id = max(conn.execute(sa.select(sa.func.max(model.id))).scalar() or 0
+                         for model in (Activity, ArchivedActivity))
+            conn.execute(sa.text('SELECT setval(:sequence, :next, false)'),
+                         {'sequence': sequence, 'next': self.next_activity_id(key, max_id)})
+
+    def renumber_activities(self):
+        """Give the selected shard's activities whose ids belong to another shard (created
+        before ids were interleaved) new ids of this shard, above every existing one.
+        Returns the number renumbered. Clears the shard's Trait.recent_runs (rebuilt from
+        the activities on next use) and ranking snapshot, which hold activity ids."""
+        key = current_shard.get()
+        if len(self.keys) < 2 or key is None:
+            return 0
+        count, residue = len(self.keys), self.activity_id_residue(key)
+        max_id = max(db.session.scalar(sa.select(sa.func.max(model.id))) or 0 for model in (Activity, ArchivedActivity))
+        # id -> base + id * count keeps distinct ids distinct, in this shard's residue class
+        base = self.next_activity_id(key, max_id)
+        renumbered = 0
+        for model in (Activity, ArchivedActivity):
+            renumbered += db.session.execute(
+                sa.update(model).where(model.id % count != residue).values(id=base + model.id * count)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+        if renumbered:
+            db.session.execute(sa.update(Trait).values(recent_runs=sa.null()).execution_options(synchronize_session=False))
+            db.session.execute(sa.delete(RankingSnapshot))
+        db.session.commit()
+        self.interleave_activity_ids()
+        return renumbered
+
+    # --- User directory (sharded mode only) ---
+
+    def create_directory(self):
+        """Create the user directory on the default database when sharding is enabled."""
+        if self.enabled:
+            directory_metadata.create_all(db.engine)
+
+    def user_id_for(self, username):
+        with db.engine.connect() as conn:
+            return conn.execute(sa.select(user_directory.c.id).where(user_directory.c.username == username)).scalar()
+
+    def directory_conflict(self, username, third_party_id=None):
+        """'username' or 'third_party_id' if already registered, else None."""
+        with db.engine.connect() as conn:
+            if conn.execute(sa.select(user_directory.c.id).where(user_directory.c.username == username)).first():
+                return 'username'
+            if third_party_id and conn.execute(
+                    sa.select(user_directory.c.id).where(user_directory.c.third_party_id == third_party_id)).first():
+                return 'third_party_id'
+        return None
+
+    def allocate_user_id(self, username, third_party_id=None):
+        """Claim username and return a new global user id. Raises IntegrityError if it is taken."""
+        with db.engine.begin() as conn:
+            return conn.execute(
+                user_directory.insert().values(username=username, third_party_id=third_party_id)
+            ).inserted_primary_key[0]
+
+    def release_user_id(self, user_id):
+        """Undo allocate_user_id when the user couldn't be created on its shard."""
+        with db.engine.begin() as conn:
+            conn.execute(user_directory.delete().where(user_directory.c.id == user_id))
@@ -0,0 +1,12 @@
+# wsgi.py
+# Production entry point. `python server.py` runs Flask's development server; behind a
+# real WSGI server, point it at wsgi:app instead:
+#   gunicorn -c gunicorn.conf.py wsgi:app       (Linux/macOS, see gunicorn.conf.py)
+#   waitress-serve --port=5000 wsgi:app         (Windows)
+#
+# Settings come from the environment as for server.py (DATABASE_URL, SECRET_KEY, ...).
+# Set SECRET_KEY when running more than one worker, or a token issued by one worker is
+# rejected by the others.
+from server import create_app
+
+app = create_app()